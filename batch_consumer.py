@@ -0,0 +1,254 @@
+
+import itertools
+import json
+import os
+import threading
+import time
+import_started = time.time()
+
+from call_deadlines import budget
+from cold_start import prewarm
+from errors import exit_with_error
+from idempotency import default_lease, get_store, incident_key
+from nsg_resiliency import default_site, failover_operations, failover_pass, incident_window, topology_names, wait_for_standby_refills
+from site_runner import load_sites, print_sites
+
+# SQS batch consumer for EC2 state-change events. The state-change rule can
+# target an SQS queue instead of the failover function; Lambda then polls the
+# queue and hands this handler batches of messages, so a burst of events (a
+# whole AZ going down) is one invocation and one failover pass instead of one
+# cold invocation per event, all competing for the same API rate limit.
+#
+# A batch is handled in one pass:
+#   - events are deduplicated by instance, so the stopping and shutting-down
+#     events of an instance, and redeliveries, count once
+#   - sites are matched to events by the instance ID of their old NSG, from
+#     one topology lookup for all sites; in an impaired region, where that
+#     lookup fails, a site matches any event from the region
+#   - each event's incident is locked like a direct invocation's (see
+#     idempotency), so an incident handled elsewhere is not handled again
+#   - the matched sites fail over together, each journaled under its event's
+#     incident
+# Messages of events whose sites did not fail over are reported as batch item
+# failures, so SQS delivers them again; the event source mapping needs
+# ReportBatchItemFailures. Unreadable messages and events that match no site
+# are dropped.
+#
+# Sites come from the JSON file named by SITES_FILE, shipped with the
+# function (or 'sites'/'sites_file' next to 'Records' in a test event), or
+# the default site.
+#
+# LocalQueue is an in-memory stand-in for the queue: consume() receives a
+# batch from it, runs the handler on it and deletes the handled messages.
+
+# Most messages taken from a LocalQueue at once
+default_batch_size = 100
+
+# In-memory stand-in for an SQS queue. Received messages are in flight until
+# they are deleted, or released to be received again.
+class LocalQueue(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.ids = itertools.count(1)
+        self.messages = []
+        self.in_flight = {}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.messages)
+
+    # Queue a message; the body is an event or its JSON
+    def send(self, body):
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+        with self.lock:
+            message = {'messageId': 'message-%d' % next(self.ids), 'body': body, 'receives': 0}
+            self.messages.append(message)
+            self.available.notify_all()
+        return message['messageId']
+
+    # Wait up to timeout seconds for a message; True if there is one
+    def wait(self, timeout = None):
+        with self.lock:
+            if not self.messages:
+                self.available.wait(timeout)
+            return bool(self.messages)
+
+    # Take up to max_messages messages, as Lambda's SQS event records
+    def receive(self, max_messages = default_batch_size):
+        records = []
+        with self.lock:
+            batch, self.messages = self.messages[:max_messages], self.messages[max_messages:]
+            for message in batch:
+                message['receives'] += 1
+                receipt_handle = message['messageId'] + '/%d' % message['receives']
+                self.in_flight[receipt_handle] = message
+                records.append({
+                    'messageId': message['messageId'],
+                    'receiptHandle': receipt_handle,
+                    'body': message['body'],
+                    'attributes': {'ApproximateReceiveCount': str(message['receives'])},
+                    'eventSource': 'aws:sqs',
+                })
+        return records
+
+    def delete(self, receipt_handle):
+        with self.lock:
+            self.in_flight.pop(receipt_handle, None)
+
+    # Make an in-flight message visible again, as when its visibility
+    # timeout expires
+    def release(self, receipt_handle):
+        with self.lock:
+            message = self.in_flight.pop(receipt_handle, None)
+            if message is not None:
+                self.messages.append(message)
+                self.available.notify_all()
+
+
+# Sites of an invocation: the event's for test events, else SITES_FILE's
+def batch_sites(event):
+    if 'sites' not in event and 'sites_file' not in event and os.environ.get('SITES_FILE'):
+        event = {'sites_file': os.environ['SITES_FILE']}
+    return load_sites(event, default_site)
+
+
+# State-change events of the records, one per instance, in the order first
+# received, as [(event, [message IDs])]
+def dedupe_events(records):
+    events = []
+    by_instance = {}
+    unreadable = 0
+    for record in records:
+        try:
+            event = json.loads(record['body'])
+            instance_id = event['detail']['instance-id']
+            event['detail']['state']
+        except (ValueError, TypeError, KeyError) as e:
+            print "Dropping message " + record['messageId'] + ", not a state-change event: " + str(e)
+            unreadable += 1
+            continue
+        if instance_id not in by_instance:
+            by_instance[instance_id] = len(events)
+            events.append((event, []))
+        events[by_instance[instance_id]][1].append(record['messageId'])
+
+    duplicates = len(records) - unreadable - len(events)
+    msg = "Batch of " + str(len(records)) + " messages: " + str(len(events)) + " instances, " + \
+          str(duplicates) + " duplicates ... [ SUCCESS ]"
+    print msg
+    return events
+
+
+# Events of a site: those naming its old NSG, or any from its region if the
+# region is impaired
+def site_events(site, events, topologies):
+    topology = topologies.get(site['region'])
+    if topology is None:
+        return [e for e in events if e.get('region', default_site['region']) == site['region']]
+    instance = topology.instances.get(site['old_nsg_name'])
+    if instance is None:
+        return []
+    return [e for e in events if e['detail']['instance-id'] == instance['InstanceId']]
+
+
+# Lambda callback for the SQS event source
+def lambda_handler(event, context):
+    try:
+        return handle_batch(event, context)
+    finally:
+        wait_for_standby_refills(context)
+
+
+# Fail over the sites of a batch of SQS records in one pass. Returns the
+# batch item failures and the sites' results.
+def handle_batch(event, context):
+    sites = batch_sites(event)
+    records = event.get('Records', [])
+    events = dedupe_events(records)
+    if not events:
+        return {'batchItemFailures': []}
+
+    store = get_store(default_site['region'])
+    owner = getattr(context, 'aws_request_id', None)
+    if owner is None:
+        import uuid # Slow to import, and Lambda always gives a request ID
+        owner = str(uuid.uuid4())
+    lease = default_lease
+    if context is not None:
+        lease = context.get_remaining_time_in_millis() / 1000.0
+
+    incidents = dict((e['detail']['instance-id'], incident_key(e, incident_window)) for e, message_ids in events)
+    locked = {}
+    site_incidents = {}
+
+    # Lock the incident of each site's first event, once per incident
+    def select(topologies, impaired):
+        selected = []
+        for site in sites:
+            matched = site_events(site, [e for e, message_ids in events], topologies)
+            if not matched:
+                continue
+            incident = incidents[matched[0]['detail']['instance-id']]
+            if incident not in locked:
+                locked[incident] = store.acquire(incident, owner, lease)
+                if not locked[incident]:
+                    print "Incident " + incident + " already handled ... [ SKIPPED ]"
+            if locked[incident]:
+                site_incidents[site['name']] = incident
+                selected.append((site, incident))
+        return selected
+
+    with budget(context):
+        try:
+            results = failover_pass(sites, [e for e, message_ids in events], select)
+        except BaseException: # exit_with_error raises SystemExit
+            for incident in sorted(i for i in locked if locked[i]):
+                store.complete(incident, owner, 'failed', None)
+            raise
+    print_sites(results)
+
+    failed_incidents = set()
+    for incident in sorted(i for i in locked if locked[i]):
+        incident_results = [r for r in results if site_incidents[r['site']] == incident]
+        status = 'succeeded'
+        if any(r['status'] != 'succeeded' for r in incident_results):
+            status = 'failed'
+            failed_incidents.add(incident)
+        store.complete(incident, owner, status, {'sites': incident_results})
+
+    failures = []
+    for event, message_ids in events:
+        if incidents[event['detail']['instance-id']] in failed_incidents:
+            failures.extend({'itemIdentifier': message_id} for message_id in message_ids)
+    return {'batchItemFailures': failures, 'sites': results}
+
+
+# Handle one batch from a LocalQueue, as the SQS event source would: handled
+# messages are deleted and failed ones released. Extra event keys (such as
+# 'sites') are passed along with the records. Standby pool refills are left
+# running in the background. Returns the handler's response, or None if the
+# queue is empty.
+def consume(queue, context = None, event = None, batch_size = default_batch_size):
+    records = queue.receive(batch_size)
+    if not records:
+        return None
+    try:
+        response = handle_batch(dict(event or {}, Records = records), context)
+    except BaseException:
+        for record in records:
+            queue.release(record['receiptHandle'])
+        raise
+    failed = set(f['itemIdentifier'] for f in response['batchItemFailures'])
+    for record in records:
+        if record['messageId'] in failed:
+            queue.release(record['receiptHandle'])
+        else:
+            queue.delete(record['receiptHandle'])
+    return response
+
+
+# Lambda INIT phase: get the default site's client ready before the first batch
+prewarm(__name__, default_site['region'], failover_operations, *topology_names([default_site]), import_started = import_started)
@@ -0,0 +1,222 @@
+
+import os
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+
+# Deadlines for the failover and every EC2 API call it makes, and hedged
+# reads. During an EC2 incident a single slow call could otherwise hold a
+# step for botocore's 60 s read timeout and its retries, until the Lambda is
+# killed before exit_with_error can report anything.
+#
+# The failover handler runs within a budget: the invocation's remaining time
+# less a reserve to report and record the outcome (FAILOVER_BUDGET seconds
+# when there is no Lambda context). A step is not started once the budget is
+# spent, waiters give up when it runs out, and every API call attempt gets
+# the smaller of its own limit (read_call_timeout or mutate_call_timeout)
+# and what is left of the budget. An attempt that has not answered by then
+# fails with DeadlineExceeded; ec2_throttle retries it only if the budget
+# allows the backoff.
+#
+# Idempotent reads (hedged_operations) are hedged: if the first request has
+# not answered after hedge_factor times the operation's p95 latency, over
+# its last window_size answers, an identical duplicate is sent and whichever
+# answers first is used. Until there are min_samples answers the duplicate
+# goes out after default_hedge_delay.
+#
+# Calls run on a shared pool so the caller can stop waiting; a call left
+# behind finishes in the background within the client's read timeout.
+#
+# A block of work can also get a deadline of its own (deadline_after), such
+# as a site's timeout in a multi-site failover. It holds for the thread
+# running the block and for the work it hands to other threads through
+# bind(); the budget and the block's deadline both apply, whichever is
+# first.
+
+default_budget = 600
+reserve = 5
+
+connect_timeout = 5
+read_call_timeout = 10
+mutate_call_timeout = 30
+
+hedged_operations = ('DescribeInstances', 'DescribeNetworkInterfaces', 'DescribeAddresses')
+hedge_factor = 1.5
+default_hedge_delay = 1.0
+min_hedge_delay = 0.05
+window_size = 200
+min_samples = 20
+
+call_workers = 128
+
+lock = threading.Lock()
+deadline = None
+latencies = {}
+executor = None
+thread_local = threading.local()
+
+# Thread-local state the hooks of a call read, copied to the pool thread
+# that makes it
+carried_locals = []
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# Copy a threading.local of the caller to the pool threads making its calls
+def carry(local):
+    carried_locals.append(local)
+
+
+# Forget the latencies seen so far
+def reset():
+    with lock:
+        latencies.clear()
+
+
+# Run the block within a budget taken from the Lambda context. Budgets do not
+# nest; an inner one runs within the outer.
+@contextmanager
+def budget(context):
+    global deadline
+    if context is not None:
+        seconds = context.get_remaining_time_in_millis() / 1000.0 - reserve
+    else:
+        seconds = float(os.environ.get('FAILOVER_BUDGET', default_budget))
+    outer = deadline
+    if outer is None:
+        deadline = time.time() + seconds
+    try:
+        yield
+    finally:
+        deadline = outer
+
+
+# Run the block within seconds from now, as well as within any deadline
+# the calling thread already has
+@contextmanager
+def deadline_after(seconds):
+    outer = getattr(thread_local, 'deadline', None)
+    thread_local.deadline = time.time() + seconds
+    if outer is not None:
+        thread_local.deadline = min(outer, thread_local.deadline)
+    try:
+        yield
+    finally:
+        thread_local.deadline = outer
+
+
+# fn bound to the calling thread's deadline, to be run on another thread
+def bind(fn):
+    bound = getattr(thread_local, 'deadline', None)
+
+    def run(*args, **kwargs):
+        outer = getattr(thread_local, 'deadline', None)
+        thread_local.deadline = bound
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            thread_local.deadline = outer
+    return run
+
+
+# Seconds left of the budget or of the calling thread's deadline, whichever
+# ends first, or None if there is neither
+def remaining():
+    deadlines = [d for d in (deadline, getattr(thread_local, 'deadline', None)) if d is not None]
+    if not deadlines:
+        return None
+    return min(deadlines) - time.time()
+
+
+# The timeout capped by what is left of the budget
+def budgeted(timeout):
+    left = remaining()
+    if left is None:
+        return timeout
+    return max(0, min(timeout, left))
+
+
+def call_timeout(operation_name):
+    if operation_name.startswith('Describe') or operation_name.startswith('Get'):
+        return budgeted(read_call_timeout)
+    return budgeted(mutate_call_timeout)
+
+
+def record_latency(operation_name, seconds):
+    with lock:
+        samples = latencies.get(operation_name)
+        if samples is None:
+            samples = latencies[operation_name] = deque(maxlen = window_size)
+        samples.append(seconds)
+
+
+def p95(operation_name):
+    with lock:
+        samples = sorted(latencies.get(operation_name, ()))
+    if len(samples) < min_samples:
+        return None
+    return samples[int(len(samples) * 0.95)]
+
+
+# Seconds to wait for an answer before sending a duplicate
+def hedge_delay(operation_name):
+    latency = p95(operation_name)
+    if latency is None:
+        return default_hedge_delay
+    return max(min_hedge_delay, latency * hedge_factor)
+
+
+def get_executor():
+    global executor
+    with lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers = call_workers)
+        return executor
+
+
+def submit(operation_name, request):
+    carried = [(local, dict(local.__dict__)) for local in carried_locals]
+
+    def run():
+        for local, values in carried:
+            local.__dict__.clear()
+            local.__dict__.update(values)
+        started = time.time()
+        try:
+            return request()
+        finally:
+            record_latency(operation_name, time.time() - started)
+
+    return get_executor().submit(run)
+
+
+# Make one attempt of an API call with request() within its deadline. A
+# hedged read is sent again, if may_hedge() allows, when it is slow to answer.
+def call(operation_name, request, may_hedge = None):
+    timeout = call_timeout(operation_name)
+    if (timeout <= 0):
+        raise DeadlineExceeded("Failover budget spent before " + operation_name)
+
+    started = time.time()
+    futures = [submit(operation_name, request)]
+    if operation_name in hedged_operations:
+        delay = hedge_delay(operation_name)
+        if (delay < timeout):
+            done, pending = wait_futures(futures, timeout = delay)
+            if not done and (may_hedge is None or may_hedge()):
+                print "No answer to " + operation_name + " after %.2fs, sending a hedged request" % delay
+                futures.append(submit(operation_name, request))
+
+    done, pending = wait_futures(futures, timeout = max(0, started + timeout - time.time()),
+                                 return_when = FIRST_COMPLETED)
+    if not done:
+        raise DeadlineExceeded(operation_name + " did not answer within %.2fs" % timeout)
+    answered = sorted(done, key = lambda f: f.exception() is not None)
+    return answered[0].result()
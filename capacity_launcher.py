@@ -0,0 +1,203 @@
+
+import hashlib
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from call_deadlines import bind
+from ec2_pool import get_client
+from errors import exit_with_error
+
+# Capacity fallback for the new NSG. A site can rank instance types: the
+# first is tried first, and on a capacity error the launch falls back to the
+# next at once. Types the AMI's architecture or the interfaces' AZ do not
+# support are dropped up front, and types that ran out of capacity in a zone
+# are tried last for the next few minutes, so later failovers of the same
+# outage do not pay for them again.
+#
+# With hedge set to N > 1, capacity for the next N types is requested at once
+# as On-Demand Capacity Reservations, and the NSG is launched into the best
+# ranked reservation that was granted; the others are cancelled right away.
+# Launches themselves cannot race, since the interfaces attach to only one
+# instance. The reservation is cancelled once the NSG runs in it; the NSG
+# keeps running as a regular On-Demand instance.
+
+# Errors that mean "no capacity for this type here"
+capacity_codes = (
+    'InsufficientInstanceCapacity', 'InsufficientHostCapacity', 'InsufficientCapacity',
+    'InsufficientReservedInstanceCapacity', 'Unsupported',
+)
+
+# Seconds a capacity failure of a type in a zone is remembered
+failure_memory = 300
+
+lock = threading.Lock()
+recent_failures = {}
+compatibility = {}
+
+def error_code(e):
+    return getattr(e, 'response', {}).get('Error', {}).get('Code')
+
+
+def remember_failure(region_name, zone, instance_type):
+    with lock:
+        recent_failures[(region_name, zone, instance_type)] = time.time() + failure_memory
+
+
+def recently_failed(region_name, zone, instance_type):
+    with lock:
+        return recent_failures.get((region_name, zone, instance_type), 0) > time.time()
+
+
+# Ranked types with those that recently ran out of capacity last
+def launch_order(region_name, zone, instance_types):
+    fresh = [t for t in instance_types if not recently_failed(region_name, zone, t)]
+    known_bad = [t for t in instance_types if t not in fresh]
+    for instance_type in known_bad:
+        print "Instance type " + instance_type + " ran out of capacity in " + zone + " recently, trying it last"
+    return fresh + known_bad
+
+
+# Types offered in the zone that support the AMI's architecture, in rank
+# order. Offerings do not change, so they are looked up once per container.
+# If they cannot be looked up, all types are tried.
+def compatible_types(region_name, ami_id, zone, instance_types):
+    key = (region_name, ami_id, zone, tuple(instance_types))
+    with lock:
+        if key in compatibility:
+            return compatibility[key]
+
+    ec2 = get_client('ec2', region_name)
+    try:
+        architecture = ec2.describe_images(ImageIds = [ami_id])['Images'][0].get('Architecture', 'x86_64')
+        offered = set(o['InstanceType'] for o in ec2.describe_instance_type_offerings(
+            LocationType = 'availability-zone',
+            Filters = [
+                {'Name': 'location', 'Values': [zone]},
+                {'Name': 'instance-type', 'Values': list(instance_types)}
+            ]
+        )['InstanceTypeOfferings'])
+        architectures = dict((t['InstanceType'], t['ProcessorInfo']['SupportedArchitectures']) for t in
+                             ec2.describe_instance_types(InstanceTypes = list(instance_types))['InstanceTypes'])
+    except Exception as e:
+        print "Unable to check instance types " + ", ".join(instance_types) + " in " + zone + ". Exception: " + str(e)
+        return list(instance_types)
+
+    compatible = []
+    for instance_type in instance_types:
+        if instance_type not in offered:
+            print "Instance type " + instance_type + " is not offered in " + zone + ", skipped"
+        elif architecture not in architectures.get(instance_type, []):
+            print "Instance type " + instance_type + " does not support " + architecture + ", skipped"
+        else:
+            compatible.append(instance_type)
+    with lock:
+        compatibility[key] = compatible
+    return compatible
+
+
+# Reserve capacity for one instance of a type; returns the reservation ID,
+# or None if there is no capacity
+def reserve(region_name, zone, instance_type):
+    ec2 = get_client('ec2', region_name)
+    try:
+        return ec2.create_capacity_reservation(
+            InstanceType = instance_type,
+            InstancePlatform = 'Linux/UNIX',
+            AvailabilityZone = zone,
+            InstanceCount = 1,
+            InstanceMatchCriteria = 'targeted',
+            EndDateType = 'unlimited',
+            ClientToken = hashlib.sha1(os.urandom(20)).hexdigest()
+        )['CapacityReservation']['CapacityReservationId']
+    except Exception as e:
+        if error_code(e) not in capacity_codes:
+            raise
+        remember_failure(region_name, zone, instance_type)
+        print "No capacity for " + instance_type + " in " + zone + ": " + str(error_code(e))
+        return None
+
+
+def cancel(region_name, reservation_id):
+    ec2 = get_client('ec2', region_name)
+    try:
+        ec2.cancel_capacity_reservation(CapacityReservationId = reservation_id)
+    except Exception as e:
+        print "Unable to cancel capacity reservation " + reservation_id + ". Exception: " + str(e)
+
+
+# Reserve capacity for the types at once; returns (type, reservation ID) of
+# the best ranked one granted, or (None, None). A type whose reservation fails
+# for any reason is not granted. Every other reservation that was granted is
+# cancelled, also when the hedge is cut short (e.g. by the deadline).
+def hedge_reservations(region_name, zone, instance_types):
+    executor = ThreadPoolExecutor(max_workers = len(instance_types))
+    futures = [executor.submit(bind(reserve), region_name, zone, t) for t in instance_types]
+    chosen = None
+    try:
+        granted = []
+        for instance_type, future in zip(instance_types, futures):
+            try:
+                reservation_id = future.result()
+            except Exception as e:
+                if error_code(e) is None:
+                    raise
+                print "Unable to reserve capacity for " + instance_type + " in " + zone + ": " + str(error_code(e))
+                continue
+            if reservation_id is not None:
+                granted.append((instance_type, reservation_id))
+        if granted:
+            chosen = granted[0]
+    finally:
+        executor.shutdown(wait = True)
+        for instance_type, future in zip(instance_types, futures):
+            if future.exception() is None and future.result() is not None and (instance_type, future.result()) != chosen:
+                cancel(region_name, future.result())
+
+    if chosen is None:
+        return None, None
+    msg = "Reserve capacity for " + chosen[0] + " in " + zone + " (of " + ", ".join(instance_types) + ") ... [ SUCCESS ]"
+    print msg
+    return chosen
+
+
+# Launch with the first instance type that has capacity. run(instance_type,
+# reservation_id) makes the launch (reservation_id is None unless hedging)
+# and its result is returned. Errors other than capacity errors are raised
+# at once; if no type has capacity, the last capacity error is raised.
+def launch(region_name, zone, ami_id, instance_types, run, hedge = 0):
+    instance_types = [t for n, t in enumerate(instance_types) if t not in instance_types[:n]]
+    if (len(instance_types) > 1):
+        instance_types = launch_order(region_name, zone, compatible_types(region_name, ami_id, zone, instance_types))
+    if not instance_types:
+        exit_with_error("None of the instance types can run AMI " + ami_id + " in " + zone)
+
+    last_error = None
+    batch = max(1, hedge)
+    for i in range(0, len(instance_types), batch):
+        candidates = instance_types[i:i + batch]
+        reservation_id = None
+        if (len(candidates) > 1):
+            instance_type, reservation_id = hedge_reservations(region_name, zone, candidates)
+            if instance_type is None:
+                continue
+        else:
+            instance_type = candidates[0]
+
+        try:
+            return run(instance_type, reservation_id)
+        except Exception as e:
+            if error_code(e) not in capacity_codes:
+                raise
+            remember_failure(region_name, zone, instance_type)
+            print "Launch of " + instance_type + " in " + zone + " failed: " + str(error_code(e)) + ", falling back"
+            last_error = e
+        finally:
+            if reservation_id is not None:
+                cancel(region_name, reservation_id)
+
+    if last_error is None:
+        exit_with_error("No capacity for " + ", ".join(instance_types) + " in " + zone)
+    raise last_error
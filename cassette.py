@@ -0,0 +1,380 @@
+
+import argparse
+import datetime
+import gzip
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from botocore.awsrequest import AWSResponse
+
+# Record/replay of EC2 traffic. With CASSETTE_RECORD=<file> set, every EC2
+# call made through the pooled session is appended to the cassette, one JSON
+# line per call with its parameters, parsed response and observed latency
+# (gzip compressed if the file name ends in .gz). Record a real failover and
+# reset, e.g. from a workstation with the lab's credentials, then replay them
+# offline against the same handlers:
+#
+#   python cassette.py lab.jsonl.gz                        # as recorded
+#   python cassette.py lab.jsonl.gz --speed 10             # 10x faster
+#   python cassette.py lab.jsonl.gz --sites 2000 --speed 0 # 2000 sites, no sleeps
+#
+# With --sites, the recorded site is cloned into synthetic sites, each with
+# its own instance, interface and address IDs, names and public IPs, and each
+# replaying its own copy of the recorded history. Describe calls batched over
+# many sites are split per site and the answers merged, so the handlers,
+# the rate limiter and the thread pools all work as they would for a real
+# outage of that size. Only failover runs are scaled; other runs (such as
+# lab_reset, whose lab is hard-coded) are replayed for a single site only.
+# Scaled replays are paced by the ec2_throttle rate limits, as a real outage
+# of that size would be; the handlers' own waits are not accelerated.
+# NOTE: Timestamps in responses are replayed as ISO 8601 strings
+
+# Per-site resource IDs; AMIs, snapshots, subnets and security groups are
+# shared by all sites
+site_id_pattern = re.compile(r'^(i|r|eni|eni-attach|eipalloc|eipassoc)-[0-9a-f]+$')
+
+# Tags whose values are per-site names
+name_tags = ('Name', 'StandbyPool')
+
+# Parameters that are lists of per-site values, and can be split by site
+split_parameters = ('InstanceIds', 'NetworkInterfaceIds', 'AllocationIds', 'PublicIps', 'Values', 'Resources')
+
+# Handlers a recorded run can be replayed with
+handlers = ('nsg_resiliency', 'lab_reset', 'health_detector')
+
+# Parameters that differ on every run, such as random client tokens, and do
+# not tell requests apart
+run_parameters = ('ClientToken',)
+
+
+def open_cassette(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+# Parsed responses carry datetimes, which JSON does not
+def to_json(value):
+    if isinstance(value, dict):
+        return dict((k, to_json(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [to_json(v) for v in value]
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def params_key(params):
+    return json.dumps(dict((k, v) for k, v in params.items() if k not in run_parameters), sort_keys = True)
+
+
+# Appends every EC2 call of a session to a cassette file
+class CassetteRecorder(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.runs = {}
+
+    def install(self, session):
+        events = session.events
+        events.register('before-parameter-build.ec2', self.capture_params)
+        events.register('before-call.ec2', self.start)
+        events.register('after-call.ec2', self.record)
+
+    def capture_params(self, params, model, context, **kwargs):
+        context['cassette_params'] = to_json(dict(params))
+
+    def start(self, model, context, **kwargs):
+        context['cassette_started'] = time.time()
+
+    # Calls are grouped into runs, one per recorded handler invocation
+    def current_run(self):
+        import failover_metrics
+        recorder = failover_metrics.recorder
+        if recorder is None:
+            return 0, None
+        with self.lock:
+            run = self.runs.setdefault(id(recorder), len(self.runs) + 1)
+        return run, recorder.handler_name
+
+    def record(self, http_response, parsed, model, context, **kwargs):
+        run, handler_name = self.current_run()
+        response = dict((k, v) for k, v in parsed.items() if k != 'ResponseMetadata')
+        interaction = {
+            'run': run,
+            'handler': handler_name,
+            'operation': model.name,
+            'params': context.get('cassette_params', {}),
+            'status': getattr(http_response, 'status_code', 200),
+            'response': to_json(response),
+            'latency': round(time.time() - context.get('cassette_started', time.time()), 4),
+        }
+        line = json.dumps(interaction, sort_keys = True) + "\n"
+        with self.lock:
+            with open_cassette(self.path, 'ab') as f:
+                f.write(line)
+
+
+def load(path):
+    with open_cassette(path, 'rb') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# Strings of a request or response, recursively
+def strings(value):
+    if isinstance(value, basestring):
+        yield value
+    elif isinstance(value, dict):
+        for v in value.values():
+            for s in strings(v):
+                yield s
+    elif isinstance(value, list):
+        for v in value:
+            for s in strings(v):
+                yield s
+
+
+def translate(value, mapping):
+    if isinstance(value, basestring):
+        return mapping.get(value, value)
+    if isinstance(value, dict):
+        return dict((k, translate(v, mapping)) for k, v in value.items())
+    if isinstance(value, list):
+        return [translate(v, mapping) for v in value]
+    return value
+
+
+# Per-site values of the recording: resource IDs, names and public IPs
+def site_values(interactions):
+    ids = set()
+    names = set()
+    public_ips = set()
+
+    def visit(value):
+        if isinstance(value, dict):
+            if value.get('Key') in name_tags and 'Value' in value:
+                names.add(value['Value'])
+            if value.get('Name', '').startswith('tag:') and value['Name'][4:] in name_tags:
+                names.update(value.get('Values', []))
+            if (value.get('Name') == 'public-ip'):
+                public_ips.update(value.get('Values', []))
+            if 'PublicIp' in value:
+                public_ips.add(value['PublicIp'])
+            for v in value.values():
+                visit(v)
+        elif isinstance(value, list):
+            for v in value:
+                visit(v)
+        elif isinstance(value, basestring) and site_id_pattern.match(value):
+            ids.add(value)
+
+    for interaction in interactions:
+        visit(interaction['params'])
+        visit(interaction['response'])
+    return sorted(ids), sorted(names), sorted(public_ips)
+
+
+# Answers EC2 calls from a cassette, for one or more synthetic sites.
+# is_poll, if given, tells whether the calling thread is polling for a
+# waiter, and is noted with each call like the bench stand-in does.
+class Replayer(object):
+
+    def __init__(self, interactions, sites = 1, speed = 1.0, is_poll = None):
+        self.interactions = interactions
+        self.speed = speed
+        self.is_poll = is_poll
+        self.lock = threading.Lock()
+        self.calls = []
+        self.run = None
+        self.cursors = {}
+
+        # mappings[n] maps recorded values to those of synthetic site n
+        ids, names, public_ips = site_values(interactions)
+        self.mappings = []
+        for n in range(sites):
+            mapping = {}
+            if (sites > 1):
+                mapping.update((i, i + '-%d' % n) for i in ids)
+                mapping.update((name, name + '-%d' % n) for name in names)
+                mapping.update((ip, '100.%d.%d.%d' % (k % 256, n // 256, n % 256)) for k, ip in enumerate(public_ips))
+            self.mappings.append(mapping)
+        self.reverse = {}
+        self.reverse_mappings = []
+        for n, mapping in enumerate(self.mappings):
+            self.reverse_mappings.append(dict((v, k) for k, v in mapping.items()))
+            for original, synthetic in mapping.items():
+                self.reverse[synthetic] = (n, original)
+
+        # Recorded interactions by run and operation, in recorded order
+        self.recorded = {}
+        for interaction in interactions:
+            key = (interaction['run'], interaction['operation'])
+            self.recorded.setdefault(key, []).append(interaction)
+
+    def runs(self):
+        return sorted(set((i['run'], i['handler']) for i in self.interactions))
+
+    # Answer from the interactions recorded in a run
+    def start_run(self, run):
+        with self.lock:
+            self.run = run
+            self.cursors = {}
+
+    def install(self, session):
+        events = session.events
+        events.register('before-parameter-build.ec2', self.capture_params)
+        events.register_last('before-call.ec2', self.answer)
+
+    def capture_params(self, params, model, context, **kwargs):
+        context['cassette_params'] = to_json(dict(params))
+
+    # Site definition of synthetic site n, from the recorded site's
+    def site(self, n, definition):
+        site = translate(dict(definition), self.mappings[n])
+        site['name'] = definition['name'] + ('-%d' % n if len(self.mappings) > 1 else '')
+        return site
+
+    def sites_of(self, params):
+        return sorted(set(self.reverse[s][0] for s in strings(params) if s in self.reverse))
+
+    # The part of a request that concerns site n
+    def restrict(self, value, n):
+        if isinstance(value, dict):
+            restricted = {}
+            for k, v in value.items():
+                if k in split_parameters and isinstance(v, list):
+                    v = [s for s in v if s not in self.reverse or self.reverse[s][0] == n]
+                restricted[k] = self.restrict(v, n)
+            return restricted
+        if isinstance(value, list):
+            return [self.restrict(v, n) for v in value]
+        return value
+
+    # Next recorded interaction of a site for a request, in recorded order:
+    # the same request if it was recorded, else the same operation. Once a
+    # request's recordings run out, the last one is repeated (waiters).
+    def next_interaction(self, n, operation_name, params):
+        key = params_key(params)
+        recorded = self.recorded.get((self.run, operation_name), [])
+        exact = [i for i in recorded if params_key(i['params']) == key]
+        candidates, cursor_key = (exact, (n, key)) if exact else (recorded, (n, operation_name))
+        if not candidates:
+            return None
+        with self.lock:
+            position = self.cursors.get(cursor_key, 0)
+            self.cursors[cursor_key] = position + 1
+        return candidates[min(position, len(candidates) - 1)]
+
+    # botocore before-call hook
+    def answer(self, model, context, **kwargs):
+        params = context.get('cassette_params', {})
+        sites = self.sites_of(params) or [0]
+
+        answers = []
+        for n in sites:
+            original = translate(self.restrict(params, n) if len(sites) > 1 else params, self.reverse_mappings[n])
+            interaction = self.next_interaction(n, model.name, original)
+            if interaction is None:
+                return self.error(400, 'CassetteMiss', model.name + ' was not recorded in run ' + str(self.run))
+            answers.append((interaction, translate(interaction['response'], self.mappings[n])))
+
+        latency = max(interaction['latency'] for interaction, response in answers)
+        poll = self.is_poll is not None and self.is_poll()
+        with self.lock:
+            self.calls.append((model.name, latency, poll))
+        if self.speed:
+            time.sleep(latency / self.speed)
+
+        interaction, parsed = answers[0]
+        if (interaction['status'] >= 300):
+            return self.error(interaction['status'], parsed['Error']['Code'], parsed['Error'].get('Message', ''))
+        for other_interaction, other in answers[1:]:
+            for k, v in other.items():
+                if isinstance(v, list):
+                    parsed[k] = parsed.get(k, []) + v
+        parsed['ResponseMetadata'] = {'HTTPStatusCode': 200, 'RetryAttempts': 0}
+        return AWSResponse(None, 200, {}, None), parsed
+
+    def error(self, status_code, code, message):
+        parsed = {
+            'Error': {'Code': code, 'Message': message},
+            'ResponseMetadata': {'HTTPStatusCode': status_code, 'RetryAttempts': 0},
+        }
+        return AWSResponse(None, status_code, {}, None), parsed
+
+
+# Record EC2 traffic of a session if CASSETTE_RECORD is set
+def install_from_environment(session):
+    if os.environ.get('CASSETTE_RECORD'):
+        CassetteRecorder(os.environ['CASSETTE_RECORD']).install(session)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Replay a recorded failover cassette offline")
+    parser.add_argument('cassette')
+    parser.add_argument('--sites', type = int, default = 1,
+                        help = "number of synthetic sites to clone the recorded site into")
+    parser.add_argument('--speed', type = float, default = 1.0,
+                        help = "divide recorded latencies by this factor; 0 answers without waiting")
+    parser.add_argument('--site', default = '{}',
+                        help = "JSON of the recorded site's keys that differ from the defaults")
+    args = parser.parse_args()
+
+    # Nothing may leave the machine
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'replay')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'replay')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.pop('CASSETTE_RECORD', None)
+    import tempfile
+    os.environ['IDEMPOTENCY_DIR'] = tempfile.mkdtemp(prefix = 'cassette-')
+
+    import ec2_pool
+    import failover_metrics
+    import nsg_resiliency
+
+    replayer = Replayer(load(args.cassette), args.sites, args.speed)
+    replayer.install(ec2_pool.get_session())
+    recorded_site = dict(nsg_resiliency.default_site, **json.loads(args.site))
+
+    failed = False
+    for run, handler_name in replayer.runs():
+        if handler_name not in handlers:
+            continue
+        if (args.sites > 1) and (handler_name != 'nsg_resiliency'):
+            print "Run %d (%s) ... [ SKIPPED ] only failovers are scaled" % (run, handler_name)
+            continue
+
+        event = {}
+        if (handler_name == 'nsg_resiliency'):
+            event = {'sites': [replayer.site(n, recorded_site) for n in range(args.sites)]}
+        handler = __import__(handler_name).lambda_handler
+
+        replayer.start_run(run)
+        del replayer.calls[:]
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        error = None
+        started = time.time()
+        try:
+            handler(event, None)
+        except BaseException as e: # exit_with_error raises SystemExit
+            error = e
+        finally:
+            sys.stdout = stdout
+        wall_time = time.time() - started
+
+        status = "FAILED" if error is not None else "SUCCESS"
+        failed = failed or error is not None
+        print "Run %d (%s, %d sites): rto %.3fs  wall %.3fs  calls %d ... [ %s ]" % (
+            run, handler_name, args.sites if handler_name == 'nsg_resiliency' else 1,
+            failover_metrics.recorder.rto, wall_time, len(replayer.calls), status)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+
+import os
+import time
+
+import failover_metrics
+
+from ec2_pool import get_client, get_session
+from ec2_topology import Topology
+
+# Work done during the Lambda INIT phase, before the first event arrives, so
+# a cold start does not pay for it inside the failover. prewarm() builds the
+# pooled EC2 client (botocore loads the service model), resolves the
+# execution role credentials, loads the models of the operations the handler
+# calls and opens the TLS connection with a cheap describe call. With
+# PREWARM_PREFETCH set, it also takes the handler's topology snapshot, which
+# the first invocation uses if it is recent enough. With INVENTORY=1, it
+# loads or builds the inventory index instead.
+#
+# Prewarming only happens for the module that is the function's handler
+# inside Lambda, not when a handler module is imported by another one, and
+# can be turned off with PREWARM=0. The import, init and first API call times
+# are reported with the first invocation's metrics.
+
+# Seconds a prefetched topology may be used for
+prefetch_max_age = 30
+
+prefetched = {}
+
+
+# Lambda sets _HANDLER to "<module>.<function>" of the function's handler
+def prewarm_enabled(module_name):
+    if os.environ.get('PREWARM', '1') == '0':
+        return False
+    return os.environ.get('_HANDLER', '').rsplit('.', 1)[0] == module_name
+
+
+def prefetch_key(region_name, instance_names, interface_names, elastic_ips):
+    return (region_name, tuple(sorted(instance_names)), tuple(sorted(interface_names)), tuple(sorted(elastic_ips)))
+
+
+# Prewarm the EC2 client of a region for the given operations, and optionally
+# prefetch a topology, if module_name is the function's handler module.
+# import_started is when the handler module started importing; pass it to
+# have import time reported.
+def prewarm(module_name, region_name, operation_names, instance_names = (), interface_names = (), elastic_ips = (),
+            import_started = None):
+    started = time.time()
+    if not prewarm_enabled(module_name):
+        return
+
+    try:
+        ec2 = get_client('ec2', region_name)
+        credentials = get_session().get_credentials()
+        if credentials is not None:
+            credentials.get_frozen_credentials()
+        for operation_name in operation_names:
+            ec2.meta.service_model.operation_model(operation_name)
+
+        if os.environ.get('INVENTORY', '0') != '0':
+            import inventory # Only loaded if the index is enabled (see inventory.enabled)
+            inventory.get_inventory(region_name)
+        elif os.environ.get('PREWARM_PREFETCH'):
+            key = prefetch_key(region_name, instance_names, interface_names, elastic_ips)
+            prefetched[key] = (time.time(), Topology(region_name, instance_names, interface_names, elastic_ips))
+        else:
+            ec2.describe_availability_zones()
+    except BaseException as e: # Never fail INIT; the handler retries it all
+        print "Prewarm of " + region_name + " failed, continuing cold. Exception: " + str(e)
+        return
+
+    import_time = started - import_started if import_started is not None else None
+    failover_metrics.record_cold_start(import_time, time.time() - started)
+
+
+# Take the prefetched topology matching a snapshot request, if it is recent
+def take_prefetched(region_name, instance_names, interface_names, elastic_ips, max_age = prefetch_max_age):
+    entry = prefetched.pop(prefetch_key(region_name, instance_names, interface_names, elastic_ips), None)
+    if entry is None or time.time() - entry[0] > max_age:
+        return None
+    return entry[1]
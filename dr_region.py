@@ -0,0 +1,148 @@
+
+import threading
+
+from ec2_pool import get_client
+from ec2_topology import Topology
+from errors import exit_with_error
+from site_runner import load_sites
+
+# Cross-region disaster recovery. A site with a 'dr_region' can be failed over
+# to that region when its own region is impaired: the new NSG is launched in
+# the DR region from a copy of the site's AMI, on interfaces created there
+# ahead of time, and the DR Elastic IP is associated with its uplink. Nothing
+# is done in the impaired region, so the old NSG is left as it is.
+#
+# Everything the DR failover needs is staged ahead of time, so a region-wide
+# outage costs one launch and not an AMI copy. Run the lambda_handler on a
+# schedule and after every AMI rotation, with the same sites as the failover:
+# it copies each site's AMI to its DR region (tagging the copy with its
+# source) and reports DR interfaces and Elastic IPs that are missing.
+#
+# A region is impaired when the event says so (an AWS Health event for the
+# region, or "impaired_regions": [...]), or when the failover cannot describe
+# the site's resources there.
+# NOTE: The DR Elastic IP is a different public IP, so clients have to find
+#       the NSG through DNS or a global endpoint
+# NOTE: Incident records and journals live in the default site's region (see
+#       idempotency); use a DynamoDB global table if that region can fail
+
+# Tag of AMI copies, "<source region>/<source AMI ID>"
+source_tag = 'DrSourceAmi'
+
+lock = threading.Lock()
+copied_ami_ids = {}
+
+# Regions the event reports as impaired
+def impaired_regions(event):
+    regions = set(event.get('impaired_regions', []))
+    if (event.get('source') == 'aws.health') and event.get('region'):
+        regions.add(event['region'])
+    return regions
+
+
+# Interface names and Elastic IP of a site in its DR region
+def dr_names(site):
+    return (site['dr_uplink_name'] or site['uplink_name'],
+            site['dr_access_interface_name'] or site['access_interface_name'],
+            site['dr_elastic_ip'])
+
+
+# Copies of an AMI in a DR region, as [(image ID, state)]
+def find_copies(dr_region, region_name, ami_id):
+    ec2 = get_client('ec2', dr_region)
+    try:
+        images = ec2.describe_images(
+            Owners = ['self'],
+            Filters = [
+                {
+                    'Name': 'tag:' + source_tag,
+                    'Values': [region_name + '/' + ami_id]
+                }
+            ]
+        )['Images']
+    except Exception as e:
+        error = "Unable to look up copies of AMI " + ami_id + " in " + dr_region + ". Exception: " + str(e)
+        exit_with_error(error)
+    return sorted((image['ImageId'], image['State']) for image in images)
+
+
+# ID of the available copy of an AMI in a DR region. Copies never change, so
+# they are only looked up once per container.
+def copied_ami_id(dr_region, region_name, ami_id):
+    key = (dr_region, region_name, ami_id)
+    with lock:
+        if key in copied_ami_ids:
+            return copied_ami_ids[key]
+
+    available = [image_id for image_id, state in find_copies(dr_region, region_name, ami_id) if state == 'available']
+    if not available:
+        exit_with_error("No available copy of AMI " + ami_id + " in " + dr_region + ". Run dr_region ahead of time")
+    with lock:
+        copied_ami_ids[key] = available[0]
+    return available[0]
+
+
+# Copy an AMI to a DR region unless a copy exists. Returns (image ID, state).
+def prestage(region_name, dr_region, ami_id):
+    copies = find_copies(dr_region, region_name, ami_id)
+    if copies:
+        image_id, state = copies[0]
+    else:
+        ec2 = get_client('ec2', dr_region)
+        try:
+            image_id = ec2.copy_image(
+                Name = 'nsg-dr-' + region_name + '-' + ami_id,
+                Description = "Copy of " + ami_id + " from " + region_name + " for DR failover",
+                SourceImageId = ami_id,
+                SourceRegion = region_name
+            )['ImageId']
+            ec2.create_tags(
+                Resources = [image_id],
+                Tags = [
+                    {
+                        'Key': source_tag,
+                        'Value': region_name + '/' + ami_id
+                    }
+                ]
+            )
+        except Exception as e:
+            error = "Unable to copy AMI " + ami_id + " to " + dr_region + ". Exception: " + str(e)
+            exit_with_error(error)
+        state = 'pending'
+
+    msg = "Copy of AMI " + ami_id + " in " + dr_region + ": " + image_id + " ... [ " + state.upper() + " ]"
+    print msg
+    return image_id, state
+
+
+# Check the DR interfaces and Elastic IPs of sites sharing a DR region.
+# Returns the names that do not exist.
+def check_resources(dr_region, sites):
+    names = [dr_names(site) for site in sites]
+    topology = Topology(dr_region, (), [n for uplink, access, eip in names for n in (uplink, access)],
+                        [eip for uplink, access, eip in names if eip])
+    missing = []
+    for site, (uplink, access, eip) in zip(sites, names):
+        site_missing = [n for n in (uplink, access) if n not in topology.interfaces]
+        if not eip or eip not in topology.addresses:
+            site_missing.append(eip or 'dr_elastic_ip')
+        status = "MISSING " + ", ".join(site_missing) if site_missing else "READY"
+        print "DR resources of site " + site['name'] + " in " + dr_region + " ... [ " + status + " ]"
+        missing.extend(site_missing)
+    return missing
+
+
+# Lambda callback: stage the DR region of every site that has one
+def lambda_handler(event, context):
+    import nsg_resiliency # Only for the site defaults
+    sites = [site for site in load_sites(event, nsg_resiliency.default_site) if site['dr_region']]
+
+    copies = {}
+    for region, dr_region, ami_id in sorted(set((s['region'], s['dr_region'], s['snapshot_ami_id']) for s in sites)):
+        image_id, state = prestage(region, dr_region, ami_id)
+        copies[dr_region + '/' + ami_id] = {'image_id': image_id, 'state': state}
+
+    missing = {}
+    for dr_region in sorted(set(site['dr_region'] for site in sites)):
+        missing[dr_region] = check_resources(dr_region, [site for site in sites if site['dr_region'] == dr_region])
+    return {'copies': copies, 'missing': missing}
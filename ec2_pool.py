@@ -0,0 +1,82 @@
+
+import os
+import threading
+
+import boto3
+import botocore.config
+
+import call_deadlines
+import ec2_throttle
+
+from failover_metrics import instrument
+
+# Pooled boto3 clients, created once per Lambda container and reused by every
+# warm invocation. Building a client reloads the service model and opens a
+# new TLS connection, so helpers must get theirs from here instead of calling
+# boto3.client() directly. Clients are thread safe and shared by all threads.
+#
+# EC2 clients are rate limited and retried by ec2_throttle, which replaces
+# botocore's own retries so the retry budget covers every attempt, and their
+# sockets time out once no call deadline (call_deadlines) could still wait. With
+# CASSETTE_RECORD set, EC2 traffic is recorded for offline replay (cassette).
+
+max_pool_connections = 32
+
+lock = threading.RLock()
+sessions = {}
+clients = {}
+
+
+# Client configuration shared by every pooled client of a service
+def client_config(service_name):
+    options = {'max_pool_connections': max_pool_connections}
+    if (service_name == 'ec2'):
+        options['retries'] = {'max_attempts': 0}
+        options['connect_timeout'] = call_deadlines.connect_timeout
+        options['read_timeout'] = call_deadlines.mutate_call_timeout
+    # TCP keep-alive needs a recent botocore; HTTP keep-alive is on regardless
+    if 'tcp_keepalive' in botocore.config.Config.OPTION_DEFAULTS:
+        options['tcp_keepalive'] = True
+    return botocore.config.Config(**options)
+
+
+# Get the session for a profile. The default (None) profile resolves
+# credentials the usual way, which is the Lambda execution role.
+def get_session(profile_name = None):
+    with lock:
+        session = sessions.get(profile_name)
+        if session is None:
+            session = boto3.session.Session(profile_name = profile_name)
+            instrument(session)
+            ec2_throttle.install(session)
+            if os.environ.get('CASSETTE_RECORD'):
+                import cassette # Only loaded when recording
+                cassette.install_from_environment(session)
+            sessions[profile_name] = session
+        return session
+
+
+# Pool key for a service/region pair under the session's current credentials
+def pool_key(session, service_name, region_name):
+    credentials = session.get_credentials()
+    access_key = credentials.access_key if credentials is not None else None
+    return (service_name, region_name, session.profile_name, access_key)
+
+
+# Get a pooled client
+def get_client(service_name, region_name, profile_name = None):
+    session = get_session(profile_name)
+    with lock:
+        key = pool_key(session, service_name, region_name)
+        client = clients.get(key)
+        if client is None:
+            client = session.client(service_name, region_name = region_name, config = client_config(service_name))
+            clients[key] = client
+        return client
+
+
+# Drop every pooled session and client
+def reset():
+    with lock:
+        sessions.clear()
+        clients.clear()
@@ -0,0 +1,488 @@
+
+import itertools
+import threading
+import time
+
+from botocore.awsrequest import AWSResponse
+
+# In-memory EC2 stand-in hooked into botocore's own event system. Requests are
+# still validated and serialized by botocore, but answered from local state,
+# so the handlers run unchanged and without network access.
+#
+# latency maps an operation name (or '*') to the seconds each call takes, and
+# throttle maps an operation name (or '*') to the number of its first calls
+# answered with RequestLimitExceeded. Every call is counted and its modeled
+# latency recorded; with sleep=False the latency is recorded but not waited.
+#
+# transitions gives the seconds an instance spends in pending, stopping or
+# shutting-down after a 'launch', 'start', 'stop' or 'terminate', so waiters
+# see the intermediate states like they do against EC2.
+#
+# All regions share the same resources; calls to a region in
+# unavailable_regions fail with Unavailable, as during a regional outage.
+# Launches and capacity reservations of instance types in no_capacity fail
+# with InsufficientInstanceCapacity; capacity reservations of types in
+# unreservable fail with InvalidParameterValue. stall() makes the next calls of an
+# operation hang, like the slow tail of EC2 during an incident. Types ending in 'g' families (c6g, ...)
+# are arm64, all others x86_64.
+#
+# is_poll, if given, tells whether the calling thread is polling for a
+# waiter; such calls are counted apart (poll_counts), as how many polls a
+# wait takes depends on timing.
+class EC2StandIn(object):
+
+    def __init__(self, latency = None, throttle = None, transitions = None, sleep = True, is_poll = None):
+        self.latency = latency or {}
+        self.throttle = throttle or {}
+        self.transitions = transitions or {}
+        self.sleep = sleep
+        self.is_poll = is_poll
+        self.settling = {}
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.instances = {}
+        self.interfaces = {}
+        self.addresses = {}
+        self.calls = []
+        self.attempts = {}
+        self.impaired = {}
+        self.images = {}
+        self.fast_restores = {}
+        self.client_tokens = {}
+        self.unavailable_regions = set()
+        self.no_capacity = set()
+        self.unreservable = set()
+        self.reservations = {}
+        self.stalls = {}
+
+    # Install on a boto3/botocore session. Clients created from the session
+    # afterwards are answered by the stand-in.
+    def install(self, session):
+        events = session.events
+        events.register('before-parameter-build.ec2', self.capture_params)
+        events.register_last('before-call.ec2', self.answer)
+
+    def capture_params(self, params, model, context, **kwargs):
+        context['stand_in_params'] = dict(params)
+
+    def new_id(self, prefix):
+        return prefix + '-%017x' % next(self.ids)
+
+    # Topology builders
+    def add_instance(self, name, state = 'running', instance_type = 'c4.xlarge', zone = 'us-east-1a', tags = None):
+        with self.lock:
+            instance_id = self.new_id('i')
+            self.instances[instance_id] = {
+                'InstanceId': instance_id,
+                'InstanceType': instance_type,
+                'State': {'Name': state},
+                'Placement': {'AvailabilityZone': zone},
+                'Tags': [{'Key': 'Name', 'Value': name}] + [{'Key': k, 'Value': v} for k, v in sorted((tags or {}).items())],
+            }
+            return instance_id
+
+    def add_interface(self, name, private_ip, zone = 'us-east-1a', subnet_id = 'subnet-0000000000000001',
+                      secondary_ips = ()):
+        with self.lock:
+            interface_id = self.new_id('eni')
+            self.interfaces[interface_id] = {
+                'NetworkInterfaceId': interface_id,
+                'PrivateIpAddress': private_ip,
+                'PrivateIpAddresses': [{'PrivateIpAddress': private_ip, 'Primary': True}] +
+                                      [{'PrivateIpAddress': ip, 'Primary': False} for ip in secondary_ips],
+                'AvailabilityZone': zone,
+                'SubnetId': subnet_id,
+                'Status': 'available',
+                'TagSet': [{'Key': 'Name', 'Value': name}],
+            }
+            return interface_id
+
+    def add_address(self, public_ip):
+        with self.lock:
+            allocation_id = self.new_id('eipalloc')
+            self.addresses[allocation_id] = {'PublicIp': public_ip, 'AllocationId': allocation_id, 'Domain': 'vpc'}
+            return allocation_id
+
+    def attach(self, interface_id, instance_id, device_index = 1):
+        with self.lock:
+            attachment_id = self.new_id('eni-attach')
+            interface = self.interfaces[interface_id]
+            interface['Status'] = 'in-use'
+            interface['Attachment'] = {
+                'AttachmentId': attachment_id,
+                'InstanceId': instance_id,
+                'DeviceIndex': device_index,
+                'Status': 'attached',
+            }
+            return attachment_id
+
+    def associate(self, allocation_id, interface_id):
+        with self.lock:
+            association_id = self.new_id('eipassoc')
+            interface = self.interfaces[interface_id]
+            self.addresses[allocation_id].update({
+                'AssociationId': association_id,
+                'NetworkInterfaceId': interface_id,
+                'PrivateIpAddress': interface['PrivateIpAddress'],
+            })
+            return association_id
+
+    def add_image(self, image_id, snapshot_ids, tags = None):
+        with self.lock:
+            self.images[image_id] = {
+                'ImageId': image_id,
+                'State': 'available',
+                'BlockDeviceMappings': [
+                    {'DeviceName': '/dev/sda%d' % (n + 1), 'Ebs': {'SnapshotId': snapshot_id}}
+                    for n, snapshot_id in enumerate(snapshot_ids)
+                ],
+                'Tags': [{'Key': k, 'Value': v} for k, v in sorted((tags or {}).items())],
+                'Architecture': 'x86_64',
+            }
+
+    # Make the next count calls of an operation take seconds longer
+    def stall(self, operation_name, seconds, count = 1):
+        with self.lock:
+            self.stalls.setdefault(operation_name, []).extend([seconds] * count)
+
+    # Fail the 'instance' or 'system' status check of an instance
+    def impair(self, instance_id, check = 'instance'):
+        with self.lock:
+            self.impaired[instance_id] = check
+
+    # botocore before-call hook
+    def answer(self, model, context, **kwargs):
+        operation_name = model.name
+        params = context.get('stand_in_params', {})
+        delay = self.latency.get(operation_name, self.latency.get('*', 0.0))
+        poll = self.is_poll is not None and self.is_poll()
+        with self.lock:
+            attempt = self.attempts.get(operation_name, 0)
+            self.attempts[operation_name] = attempt + 1
+            self.calls.append((operation_name, delay, poll))
+            throttled = attempt < self.throttle.get(operation_name, self.throttle.get('*', 0))
+            stalls = self.stalls.get(operation_name)
+            if stalls:
+                delay += stalls.pop(0)
+        if self.sleep and delay:
+            time.sleep(delay)
+
+        if context.get('client_region') in self.unavailable_regions:
+            return self.error(503, 'Unavailable', 'The service is unavailable.')
+        if throttled:
+            return self.error(400, 'RequestLimitExceeded', 'Request limit exceeded.')
+        operation = getattr(self, operation_name, None)
+        if operation is None:
+            return self.error(400, 'UnsupportedOperation', operation_name + ' is not supported by the stand-in')
+        try:
+            with self.lock:
+                self.settle()
+                parsed = operation(**params)
+        except StandInError as e:
+            return self.error(400, e.code, e.message)
+        parsed.setdefault('ResponseMetadata', {'HTTPStatusCode': 200, 'RetryAttempts': 0})
+        return AWSResponse(None, 200, {}, None), parsed
+
+    def error(self, status_code, code, message):
+        parsed = {
+            'Error': {'Code': code, 'Message': message},
+            'ResponseMetadata': {'HTTPStatusCode': status_code, 'RetryAttempts': 0},
+        }
+        return AWSResponse(None, status_code, {}, None), parsed
+
+    def call_counts(self):
+        counts = {}
+        for operation_name, delay, poll in self.calls:
+            counts[operation_name] = counts.get(operation_name, 0) + 1
+        return counts
+
+    # Calls made by waiters polling, per operation
+    def poll_counts(self):
+        counts = {}
+        for operation_name, delay, poll in self.calls:
+            if poll:
+                counts[operation_name] = counts.get(operation_name, 0) + 1
+        return counts
+
+    # Time the calls would have taken one after the other
+    def serial_latency(self):
+        return sum(delay for operation_name, delay, poll in self.calls)
+
+    # EC2 operations
+    def DescribeInstances(self, Filters = (), InstanceIds = (), **kwargs):
+        instances = self.select(self.instances, InstanceIds, 'InvalidInstanceID.NotFound')
+        instances = [i for i in instances if matches(i, Filters)]
+        return {'Reservations': [{'Instances': [copy(i)]} for i in instances]}
+
+    def DescribeNetworkInterfaces(self, Filters = (), NetworkInterfaceIds = (), **kwargs):
+        interfaces = self.select(self.interfaces, NetworkInterfaceIds, 'InvalidNetworkInterfaceID.NotFound')
+        return {'NetworkInterfaces': [copy(i) for i in interfaces if matches(i, Filters)]}
+
+    def DescribeAddresses(self, Filters = (), AllocationIds = (), PublicIps = (), **kwargs):
+        addresses = self.select(self.addresses, AllocationIds, 'InvalidAllocationID.NotFound')
+        addresses = [a for a in addresses if matches(a, Filters)]
+        if PublicIps:
+            addresses = [a for a in addresses if a['PublicIp'] in PublicIps]
+        return {'Addresses': [copy(a) for a in addresses]}
+
+    def DescribeAvailabilityZones(self, **kwargs):
+        zones = sorted(set(i['Placement']['AvailabilityZone'] for i in self.instances.values()))
+        return {'AvailabilityZones': [{'ZoneName': zone, 'State': 'available'} for zone in zones]}
+
+    def DescribeInstanceStatus(self, InstanceIds = (), IncludeAllInstances = False, Filters = (), **kwargs):
+        statuses = []
+        for instance in self.select(self.instances, InstanceIds, 'InvalidInstanceID.NotFound'):
+            state = instance['State']['Name']
+            if (state != 'running') and not IncludeAllInstances:
+                continue
+            checks = {}
+            for check in ('instance', 'system'):
+                status = 'not-applicable'
+                if (state == 'running'):
+                    status = 'impaired' if self.impaired.get(instance['InstanceId']) == check else 'ok'
+                checks[check] = {'Status': status}
+            statuses.append({
+                'InstanceId': instance['InstanceId'],
+                'AvailabilityZone': instance['Placement']['AvailabilityZone'],
+                'InstanceState': {'Name': state},
+                'InstanceStatus': checks['instance'],
+                'SystemStatus': checks['system'],
+            })
+        return {'InstanceStatuses': statuses}
+
+    def DescribeImages(self, ImageIds = (), Filters = (), **kwargs):
+        images = self.select(self.images, ImageIds, 'InvalidAMIID.NotFound')
+        return {'Images': [copy(i) for i in images if matches(i, Filters)]}
+
+    def DescribeInstanceTypeOfferings(self, Filters = (), **kwargs):
+        values = dict((f['Name'], f['Values']) for f in Filters)
+        return {'InstanceTypeOfferings': [
+            {'InstanceType': t, 'Location': location, 'LocationType': 'availability-zone'}
+            for t in values.get('instance-type', []) for location in values.get('location', [])
+        ]}
+
+    def DescribeInstanceTypes(self, InstanceTypes = (), **kwargs):
+        return {'InstanceTypes': [
+            {'InstanceType': t, 'ProcessorInfo': {'SupportedArchitectures': [architecture(t)]}}
+            for t in InstanceTypes
+        ]}
+
+    def CreateCapacityReservation(self, InstanceType, AvailabilityZone, InstanceCount, **kwargs):
+        if InstanceType in self.no_capacity:
+            raise StandInError('InsufficientInstanceCapacity', 'Insufficient capacity for ' + InstanceType)
+        if InstanceType in self.unreservable:
+            raise StandInError('InvalidParameterValue', 'Capacity reservations are not supported for ' + InstanceType)
+        reservation_id = self.new_id('cr')
+        self.reservations[reservation_id] = {
+            'CapacityReservationId': reservation_id,
+            'InstanceType': InstanceType,
+            'AvailabilityZone': AvailabilityZone,
+            'State': 'active',
+        }
+        return {'CapacityReservation': copy(self.reservations[reservation_id])}
+
+    def CancelCapacityReservation(self, CapacityReservationId, **kwargs):
+        self.get(self.reservations, CapacityReservationId, 'InvalidCapacityReservationId.NotFound')['State'] = 'cancelled'
+        return {'Return': True}
+
+    def CopyImage(self, SourceImageId, SourceRegion, Name, **kwargs):
+        source = self.get(self.images, SourceImageId, 'InvalidAMIID.NotFound')
+        image_id = self.new_id('ami')
+        self.add_image(image_id, [m['Ebs']['SnapshotId'] for m in source['BlockDeviceMappings']])
+        return {'ImageId': image_id}
+
+    def DescribeFastSnapshotRestores(self, Filters = (), **kwargs):
+        restores = [{'SnapshotId': s, 'AvailabilityZone': z, 'State': state}
+                    for (s, z), state in sorted(self.fast_restores.items())]
+        return {'FastSnapshotRestores': [r for r in restores if matches(r, Filters)]}
+
+    def EnableFastSnapshotRestores(self, AvailabilityZones, SourceSnapshotIds, **kwargs):
+        successful = []
+        for snapshot_id in SourceSnapshotIds:
+            for zone in AvailabilityZones:
+                self.fast_restores[(snapshot_id, zone)] = 'enabled'
+                successful.append({'SnapshotId': snapshot_id, 'AvailabilityZone': zone, 'State': 'enabling'})
+        return {'Successful': successful, 'Unsuccessful': []}
+
+    def DetachNetworkInterface(self, AttachmentId, **kwargs):
+        for interface in self.interfaces.values():
+            if interface.get('Attachment', {}).get('AttachmentId') == AttachmentId:
+                del interface['Attachment']
+                interface['Status'] = 'available'
+                return {}
+        raise StandInError('InvalidAttachmentID.NotFound', AttachmentId)
+
+    def AttachNetworkInterface(self, NetworkInterfaceId, InstanceId, DeviceIndex, **kwargs):
+        interface = self.get(self.interfaces, NetworkInterfaceId, 'InvalidNetworkInterfaceID.NotFound')
+        self.get(self.instances, InstanceId, 'InvalidInstanceID.NotFound')
+        if (interface['Status'] != 'available'):
+            raise StandInError('InvalidNetworkInterface.InUse', NetworkInterfaceId)
+        return {'AttachmentId': self.attach(NetworkInterfaceId, InstanceId, DeviceIndex)}
+
+    def DisassociateAddress(self, AssociationId, **kwargs):
+        for address in self.addresses.values():
+            if address.get('AssociationId') == AssociationId:
+                for key in ('AssociationId', 'NetworkInterfaceId', 'PrivateIpAddress', 'InstanceId'):
+                    address.pop(key, None)
+                return {}
+        raise StandInError('InvalidAssociationID.NotFound', AssociationId)
+
+    def AssociateAddress(self, AllocationId, NetworkInterfaceId, AllowReassociation = True, **kwargs):
+        address = self.get(self.addresses, AllocationId, 'InvalidAllocationID.NotFound')
+        self.get(self.interfaces, NetworkInterfaceId, 'InvalidNetworkInterfaceID.NotFound')
+        if address.get('AssociationId') and not AllowReassociation:
+            raise StandInError('Resource.AlreadyAssociated', AllocationId)
+        return {'AssociationId': self.associate(AllocationId, NetworkInterfaceId)}
+
+    def AssignPrivateIpAddresses(self, NetworkInterfaceId, PrivateIpAddresses = (), AllowReassignment = False, **kwargs):
+        target = self.get(self.interfaces, NetworkInterfaceId, 'InvalidNetworkInterfaceID.NotFound')
+        for interface in self.interfaces.values():
+            owned = [ip for ip in interface['PrivateIpAddresses'] if ip['PrivateIpAddress'] in PrivateIpAddresses]
+            if not owned or interface is target:
+                continue
+            if not AllowReassignment or any(ip['Primary'] for ip in owned):
+                raise StandInError('InvalidParameterValue', 'Address is in use: ' + owned[0]['PrivateIpAddress'])
+            interface['PrivateIpAddresses'] = [ip for ip in interface['PrivateIpAddresses'] if ip not in owned]
+        assigned = set(ip['PrivateIpAddress'] for ip in target['PrivateIpAddresses'])
+        target['PrivateIpAddresses'].extend({'PrivateIpAddress': ip, 'Primary': False}
+                                            for ip in PrivateIpAddresses if ip not in assigned)
+        return {}
+
+    def RunInstances(self, ImageId, InstanceType, MinCount, MaxCount, NetworkInterfaces = (), **kwargs):
+        token = kwargs.get('ClientToken')
+        if token in self.client_tokens:
+            return {'Instances': [copy(self.instances[i]) for i in self.client_tokens[token]]}
+        if InstanceType in self.no_capacity:
+            raise StandInError('InsufficientInstanceCapacity', 'Insufficient capacity for ' + InstanceType)
+        instances = []
+        for count in range(MaxCount):
+            instance_id = self.add_instance(None, 'pending', InstanceType)
+            self.transition(instance_id, 'launch', 'pending', 'running')
+            instance = self.instances[instance_id]
+            instance['Tags'] = []
+            instance['ImageId'] = ImageId
+            for spec in NetworkInterfaces:
+                interface = self.get(self.interfaces, spec['NetworkInterfaceId'], 'InvalidNetworkInterfaceID.NotFound')
+                if (interface['Status'] != 'available'):
+                    raise StandInError('InvalidNetworkInterface.InUse', spec['NetworkInterfaceId'])
+                self.attach(spec['NetworkInterfaceId'], instance_id, spec['DeviceIndex'])
+            for spec in kwargs.get('TagSpecifications', []):
+                instance['Tags'].extend(spec['Tags'])
+            instances.append(copy(instance))
+        if token is not None:
+            self.client_tokens[token] = [i['InstanceId'] for i in instances]
+        return {'Instances': instances}
+
+    def CreateTags(self, Resources, Tags, **kwargs):
+        for resource_id in Resources:
+            for store in (self.instances, self.interfaces, self.images):
+                if resource_id in store:
+                    key = 'TagSet' if store is self.interfaces else 'Tags'
+                    names = set(t['Key'] for t in Tags)
+                    store[resource_id][key] = [t for t in store[resource_id][key] if t['Key'] not in names] + list(Tags)
+        return {}
+
+    # Put an instance in its intermediate state for the configured time
+    def transition(self, instance_id, kind, intermediate, final):
+        delay = self.transitions.get(kind, 0.0)
+        if delay:
+            self.instances[instance_id]['State'] = {'Name': intermediate}
+            self.settling[instance_id] = (final, time.time() + delay)
+        else:
+            self.instances[instance_id]['State'] = {'Name': final}
+            self.settling.pop(instance_id, None)
+
+    # Move instances whose transition time is up to their final state
+    def settle(self):
+        now = time.time()
+        for instance_id, (final, ready_at) in list(self.settling.items()):
+            if (ready_at <= now):
+                self.instances[instance_id]['State'] = {'Name': final}
+                del self.settling[instance_id]
+
+    def set_states(self, InstanceIds, kind, intermediate, final, allowed):
+        changes = []
+        for instance_id in InstanceIds:
+            instance = self.get(self.instances, instance_id, 'InvalidInstanceID.NotFound')
+            previous = instance['State']['Name']
+            if previous not in allowed:
+                raise StandInError('IncorrectInstanceState', instance_id)
+            if previous not in (intermediate, final):
+                self.transition(instance_id, kind, intermediate, final)
+            current = instance['State']['Name']
+            changes.append({'InstanceId': instance_id, 'CurrentState': {'Name': current}, 'PreviousState': {'Name': previous}})
+        return changes
+
+    def StopInstances(self, InstanceIds, **kwargs):
+        changes = self.set_states(InstanceIds, 'stop', 'stopping', 'stopped', ('pending', 'running', 'stopping', 'stopped'))
+        return {'StoppingInstances': changes}
+
+    def StartInstances(self, InstanceIds, **kwargs):
+        changes = self.set_states(InstanceIds, 'start', 'pending', 'running', ('pending', 'running', 'stopped'))
+        return {'StartingInstances': changes}
+
+    def TerminateInstances(self, InstanceIds, **kwargs):
+        allowed = ('pending', 'running', 'stopping', 'stopped', 'shutting-down', 'terminated')
+        changes = self.set_states(InstanceIds, 'terminate', 'shutting-down', 'terminated', allowed)
+        for interface in self.interfaces.values():
+            if interface.get('Attachment', {}).get('InstanceId') in InstanceIds:
+                del interface['Attachment']
+                interface['Status'] = 'available'
+        return {'TerminatingInstances': changes}
+
+    def get(self, store, resource_id, code):
+        try:
+            return store[resource_id]
+        except KeyError:
+            raise StandInError(code, resource_id)
+
+    def select(self, store, resource_ids, code):
+        if resource_ids:
+            return [self.get(store, resource_id, code) for resource_id in resource_ids]
+        return list(store.values())
+
+
+class StandInError(Exception):
+
+    def __init__(self, code, message):
+        Exception.__init__(self, code + ': ' + message)
+        self.code = code
+        self.message = message
+
+
+def copy(description):
+    return dict((k, dict(v) if isinstance(v, dict) else list(v) if isinstance(v, list) else v) for k, v in description.items())
+
+
+# Filter values of the EC2 filters the handlers use
+def architecture(instance_type):
+    family = instance_type.split('.')[0]
+    return 'arm64' if family.endswith('g') or family.endswith('gd') or family.endswith('gn') else 'x86_64'
+
+
+def filter_values(description, name):
+    if name.startswith('tag:'):
+        tags = description.get('Tags', []) or description.get('TagSet', [])
+        return [t['Value'] for t in tags if t['Key'] == name[4:]]
+    if (name == 'instance-state-name'):
+        return [description['State']['Name']]
+    if (name == 'public-ip'):
+        return [description.get('PublicIp')]
+    if (name == 'instance-id'):
+        return [description.get('InstanceId')]
+    if (name == 'network-interface-id'):
+        return [description.get('NetworkInterfaceId')]
+    if (name == 'snapshot-id'):
+        return [description.get('SnapshotId')]
+    if (name == 'availability-zone'):
+        return [description.get('AvailabilityZone')]
+    if (name == 'attachment.instance-id'):
+        return [description.get('Attachment', {}).get('InstanceId')]
+    return []
+
+
+def matches(description, filters):
+    for f in filters:
+        if not set(filter_values(description, f['Name'])) & set(f['Values']):
+            return False
+    return True
@@ -0,0 +1,230 @@
+
+import random
+import threading
+import time
+
+import botocore.exceptions
+
+import call_deadlines
+
+# Process-wide client-side rate limiting and throttle-aware retries for EC2.
+#
+# Every EC2 call from a pooled client first takes a token from the describe
+# or the mutate bucket, shared by all threads. When EC2 throttles a call, the
+# bucket's rate is halved and then creeps back up with every success, so a
+# burst of failovers settles close to the account's API rate limit instead
+# of failing. Throttled and transient failures are retried with jittered
+# exponential backoff, within a per-call attempt limit and a process-wide
+# retry budget. Each attempt is made within its deadline by call_deadlines,
+# and there is no retry once the backoff would outlast the failover budget.
+# Waiting for a token also ends with the budget.
+#
+# A timed out attempt may still be applied by EC2: call_deadlines stops
+# waiting for it but cannot take it back. Timeouts and dropped connections
+# are therefore only retried for calls that are safe to repeat: reads, calls
+# that set a state (idempotent_operations), and calls carrying a
+# ClientToken, which EC2 applies once however often they are sent. Other
+# mutations fail on them, and the failover step decides what to do.
+#
+# The buckets default to EC2's documented request token bucket sizes and
+# refill rates for non-mutating and mutating actions.
+
+describe_rate = 20.0
+describe_capacity = 100
+mutate_rate = 5.0
+mutate_capacity = 200
+
+max_attempts = 5
+base_delay = 0.1
+max_delay = 5.0
+
+retry_budget_capacity = 500
+retry_cost = 5
+retry_refund = 1
+
+throttle_codes = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'RequestThrottled')
+transient_codes = ('InternalError', 'InternalFailure', 'ServiceUnavailable', 'Unavailable')
+# The request never reached EC2
+connect_exceptions = (
+    botocore.exceptions.EndpointConnectionError,
+)
+# The request may or may not have been applied
+timeout_exceptions = (
+    botocore.exceptions.ConnectionClosedError,
+    botocore.exceptions.ReadTimeoutError,
+    call_deadlines.DeadlineExceeded,
+)
+
+# Mutations that leave the same state when applied twice
+idempotent_operations = (
+    'StartInstances', 'StopInstances', 'TerminateInstances', 'CreateTags', 'CancelCapacityReservation',
+)
+
+thread_local = threading.local()
+call_deadlines.carry(thread_local)
+
+
+# Token bucket whose refill rate adapts to throttling (AIMD)
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity):
+        self.max_rate = float(rate)
+        self.min_rate = self.max_rate / 8
+        self.rate = self.max_rate
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.last_throttle = 0
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Block until a token is available and take it. Gives up and returns
+    # False after timeout seconds (None waits as long as it takes).
+    def acquire(self, timeout = None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self.lock:
+                self.refill()
+                if (self.tokens >= 1):
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None:
+                if (time.time() + wait > deadline):
+                    return False
+            time.sleep(wait)
+
+    # Take a token if one is available right away
+    def try_acquire(self):
+        with self.lock:
+            self.refill()
+            if (self.tokens >= 1):
+                self.tokens -= 1
+                return True
+            return False
+
+    # Calls throttled together are one signal, so the rate is halved at most
+    # once per second
+    def throttled(self):
+        with self.lock:
+            self.refill()
+            now = time.time()
+            if (now - self.last_throttle >= 1):
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.last_throttle = now
+
+    def succeeded(self):
+        with self.lock:
+            self.refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+# Retry quota shared by all calls: a retry costs retry_cost tokens and a
+# success gives back retry_refund, so retries dry up during a long outage
+class RetryBudget(object):
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tokens = capacity
+        self.lock = threading.Lock()
+
+    def spend(self):
+        with self.lock:
+            if (self.tokens < retry_cost):
+                return False
+            self.tokens -= retry_cost
+            return True
+
+    def refund(self):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + retry_refund)
+
+
+buckets = {}
+retry_budget = None
+
+
+# Start over with full buckets and a full retry budget
+def reset():
+    global retry_budget
+    buckets['describe'] = TokenBucket(describe_rate, describe_capacity)
+    buckets['mutate'] = TokenBucket(mutate_rate, mutate_capacity)
+    retry_budget = RetryBudget(retry_budget_capacity)
+
+reset()
+
+
+def bucket_for(operation_name):
+    if operation_name.startswith('Describe') or operation_name.startswith('Get'):
+        return buckets['describe']
+    return buckets['mutate']
+
+
+# Retry attempt of the call being made by this thread (0 for the first try)
+def current_attempt():
+    return getattr(thread_local, 'attempt', 0)
+
+
+def error_code(e):
+    response = getattr(e, 'response', None) or {}
+    return response.get('Error', {}).get('Code')
+
+
+# Whether the call can be sent again when an attempt's outcome is unknown
+def safe_to_repeat(operation_name, api_params):
+    if operation_name.startswith('Describe') or operation_name.startswith('Get'):
+        return True
+    return operation_name in idempotent_operations or bool(api_params.get('ClientToken'))
+
+
+def retryable(e, operation_name, api_params):
+    code = error_code(e)
+    if code in throttle_codes or code in transient_codes or isinstance(e, connect_exceptions):
+        return True
+    return isinstance(e, timeout_exceptions) and safe_to_repeat(operation_name, api_params)
+
+
+# Mixed into every EC2 client class created from the pooled session
+class RateLimitedClient(object):
+
+    def _make_api_call(self, operation_name, api_params):
+        bucket = bucket_for(operation_name)
+        attempt = 0
+        while True:
+            if not bucket.acquire(call_deadlines.remaining()):
+                raise call_deadlines.DeadlineExceeded("Failover budget spent waiting to call " + operation_name)
+            thread_local.attempt = attempt
+            try:
+                request = lambda: super(RateLimitedClient, self)._make_api_call(operation_name, api_params)
+                response = call_deadlines.call(operation_name, request, bucket.try_acquire)
+            except Exception as e:
+                if error_code(e) in throttle_codes:
+                    bucket.throttled()
+                attempt += 1
+                if not retryable(e, operation_name, api_params) or attempt >= max_attempts:
+                    raise
+                delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+                if (call_deadlines.budgeted(delay) < delay) or not retry_budget.spend():
+                    raise
+                time.sleep(delay)
+                continue
+            finally:
+                thread_local.attempt = 0
+
+            bucket.succeeded()
+            retry_budget.refund()
+            return response
+
+
+def add_rate_limiting(base_classes, **kwargs):
+    base_classes.insert(0, RateLimitedClient)
+
+
+# Rate limit and retry every EC2 client created from the session afterwards.
+# The clients should be created with botocore's own retries turned off.
+def install(session):
+    session.events.register('creating-client-class.ec2', add_rate_limiting)
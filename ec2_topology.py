@@ -0,0 +1,188 @@
+
+from ec2_pool import get_client
+from errors import exit_with_error
+
+# Most values EC2 accepts in one describe filter
+max_filter_values = 200
+
+# Instance states of instances that are gone, or about to be
+gone_states = ('shutting-down', 'terminated')
+
+# Every instance state EC2 reports
+instance_states = ('pending', 'running', 'stopping', 'stopped', 'shutting-down', 'terminated')
+
+# Return the value of the Name tag of an EC2 resource description
+def get_name_tag(description):
+    for tag in description.get('Tags', []) or description.get('TagSet', []):
+        if (tag['Key'] == 'Name'):
+            return tag['Value']
+    return None
+
+
+# Split a list into chunks of at most size items, by default the most a
+# describe filter takes
+def filter_chunks(values, size = max_filter_values):
+    values = list(values)
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+# Snapshot of every named instance, interface and Elastic IP a handler works
+# on. Each resource type is fetched with one describe call carrying all the
+# names (or public IPs) in a single multi-value filter, so a failover pays for
+# three round-trips up front instead of one per lookup. Above 200 names, one
+# call per 200.
+# NOTE: Like get_instance_id/get_interface_id, the first resource found wins
+#       in case of multiple resources with the same name, except that live
+#       instances win over terminated ones
+# NOTE: A topology served from the inventory index is marked indexed; its
+#       attachments and associations may be out of date, so the interfaces
+#       and Elastic IPs are described again before they are changed
+class Topology(object):
+
+    def __init__(self, region_name, instance_names = (), interface_names = (), elastic_ips = ()):
+        self.region_name = region_name
+        self.instances = {}
+        self.interfaces = {}
+        self.addresses = {}
+        self.indexed = False
+
+        ec2 = get_client('ec2', region_name)
+        if instance_names:
+            self.load_instances(ec2, instance_names)
+        if interface_names:
+            self.load_interfaces(ec2, interface_names)
+        if elastic_ips:
+            self.load_addresses(ec2, elastic_ips)
+
+    def load_instances(self, ec2, instance_names):
+        try:
+            paginator = ec2.get_paginator('describe_instances')
+            for names in filter_chunks(instance_names):
+                for page in paginator.paginate(Filters = [{'Name': 'tag:Name', 'Values': names}]):
+                    for reservation in page['Reservations']:
+                        for instance in reservation['Instances']:
+                            self.add_described_instance(instance)
+        except Exception as e:
+            error = "Unable to describe instances " + ", ".join(instance_names) + ". Exception: " + str(e)
+            exit_with_error(error)
+
+    # A live instance wins over a terminated one that had the same name
+    def add_described_instance(self, instance):
+        name = get_name_tag(instance)
+        current = self.instances.get(name)
+        if current is None or (current['State']['Name'] in gone_states and instance['State']['Name'] not in gone_states):
+            self.instances[name] = instance
+
+    def load_interfaces(self, ec2, interface_names):
+        try:
+            paginator = ec2.get_paginator('describe_network_interfaces')
+            for names in filter_chunks(interface_names):
+                for page in paginator.paginate(Filters = [{'Name': 'tag:Name', 'Values': names}]):
+                    for interface in page['NetworkInterfaces']:
+                        self.interfaces.setdefault(get_name_tag(interface), interface)
+        except Exception as e:
+            error = "Unable to describe interfaces " + ", ".join(interface_names) + ". Exception: " + str(e)
+            exit_with_error(error)
+
+    def load_addresses(self, ec2, elastic_ips):
+        try:
+            for public_ips in filter_chunks(elastic_ips):
+                response = ec2.describe_addresses(
+                    Filters = [
+                        {
+                            'Name': 'public-ip',
+                            'Values': public_ips
+                        }
+                    ]
+                )
+                for address in response['Addresses']:
+                    self.addresses.setdefault(address['PublicIp'], address)
+        except Exception as e:
+            error = "Unable to describe Elastic IPs " + ", ".join(elastic_ips) + ". Exception: " + str(e)
+            exit_with_error(error)
+
+    # Copy sharing the descriptions, so a site can record its own instances
+    # in a topology shared by several sites
+    def copy(self):
+        topology = Topology(self.region_name)
+        topology.instances = dict(self.instances)
+        topology.interfaces = dict(self.interfaces)
+        topology.addresses = dict(self.addresses)
+        topology.indexed = self.indexed
+        return topology
+
+    # Describe an interface again by ID, if it came from the inventory index
+    def refresh_interface(self, interface_name):
+        if not self.indexed:
+            return
+        interface_id = self.interface_id(interface_name)
+        ec2 = get_client('ec2', self.region_name)
+        try:
+            response = ec2.describe_network_interfaces(NetworkInterfaceIds = [interface_id])
+            self.interfaces[interface_name] = response['NetworkInterfaces'][0]
+        except Exception as e:
+            error = "Unable to describe interface " + interface_name + " with ID " + interface_id + ". Exception: " + str(e)
+            exit_with_error(error)
+
+    # Describe an Elastic IP again by allocation ID, if it came from the
+    # inventory index
+    def refresh_address(self, elastic_ip):
+        if not self.indexed:
+            return
+        allocation_id = self.allocation_id(elastic_ip)
+        ec2 = get_client('ec2', self.region_name)
+        try:
+            response = ec2.describe_addresses(AllocationIds = [allocation_id])
+            self.addresses[elastic_ip] = response['Addresses'][0]
+        except Exception as e:
+            error = "Unable to describe Elastic IP " + elastic_ip + ". Exception: " + str(e)
+            exit_with_error(error)
+
+    # Record an instance that was created or claimed after the snapshot
+    def add_instance(self, instance_name, description):
+        self.instances[instance_name] = description
+
+    def instance(self, instance_name):
+        try:
+            return self.instances[instance_name]
+        except KeyError:
+            exit_with_error("Unable to get instance " + instance_name + " ID. Instance not found")
+
+    def interface(self, interface_name):
+        try:
+            return self.interfaces[interface_name]
+        except KeyError:
+            exit_with_error("Unable to get interface " + interface_name + " ID. Interface not found")
+
+    def address(self, elastic_ip):
+        try:
+            return self.addresses[elastic_ip]
+        except KeyError:
+            exit_with_error("Unable to find Elastic IP: " + elastic_ip)
+
+    def instance_id(self, instance_name):
+        return self.instance(instance_name)['InstanceId']
+
+    def instance_state(self, instance_name):
+        return self.instance(instance_name)['State']['Name']
+
+    def interface_id(self, interface_name):
+        return self.interface(interface_name)['NetworkInterfaceId']
+
+    def interface_status(self, interface_name):
+        return self.interface(interface_name)['Status']
+
+    def private_ip(self, interface_name):
+        return self.interface(interface_name)['PrivateIpAddress']
+
+    def attachment_id(self, interface_name):
+        return self.interface(interface_name).get('Attachment', {}).get('AttachmentId')
+
+    def allocation_id(self, elastic_ip):
+        return self.address(elastic_ip)['AllocationId']
+
+    def association_id(self, elastic_ip):
+        association_id = self.address(elastic_ip).get('AssociationId')
+        if association_id is None:
+            exit_with_error("Unable to get association ID for Elastic IP: " + elastic_ip + ". Address is not associated")
+        return association_id
@@ -0,0 +1,127 @@
+
+import random
+import threading
+import time
+
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+
+from call_deadlines import bind, budgeted, carry
+from errors import exit_with_error
+
+# Default waiter deadline and backoff, in seconds
+default_timeout = 300
+initial_delay = 0.5
+max_delay = 8
+
+thread_local = threading.local()
+carry(thread_local) # Polls sent from the call pool are still polls
+
+# Poll until ready() returns True or the deadline passes. The delay between
+# polls doubles up to max_delay, with jitter so concurrent waiters do not poll
+# in lockstep. Returns as soon as the target state is observed. The wait
+# also ends with the failover budget or the caller's deadline (call_deadlines),
+# and when a wait it runs alongside in wait_all fails.
+def wait_until(description, ready, timeout = default_timeout):
+    stop = getattr(thread_local, 'stop', None) or threading.Event()
+    timeout = budgeted(timeout)
+    deadline = time.time() + timeout
+    delay = initial_delay
+    while True:
+        thread_local.polling = True
+        try:
+            if ready():
+                return
+        except Exception as e:
+            if not is_not_found(e):
+                error = "Exception while waiting for " + description + ": " + str(e)
+                exit_with_error(error)
+        finally:
+            thread_local.polling = False
+
+        remaining = deadline - time.time()
+        if (remaining <= 0):
+            exit_with_error("Timed out after " + str(timeout) + "s waiting for " + description)
+
+        if stop.wait(min(remaining, delay / 2.0 + random.uniform(0, delay / 2.0))):
+            exit_with_error("Stopped waiting for " + description + " after another wait failed")
+        delay = min(delay * 2, max_delay)
+
+
+# Whether the calling thread is polling for a waiter
+def polling():
+    return getattr(thread_local, 'polling', False)
+
+
+# Freshly created resources can briefly be reported as missing
+def is_not_found(e):
+    response = getattr(e, 'response', None) or {}
+    return response.get('Error', {}).get('Code', '').endswith('NotFound')
+
+
+# Wait until all interfaces have the given status ('available', 'in-use')
+def wait_for_interface_status(ec2, interface_ids, status, timeout = default_timeout):
+    def ready():
+        response = ec2.describe_network_interfaces(NetworkInterfaceIds = list(interface_ids))
+        return all(i['Status'] == status for i in response['NetworkInterfaces'])
+
+    description = "interfaces " + ", ".join(interface_ids) + " to be " + status
+    wait_until(description, ready, timeout)
+
+
+# Wait until all interfaces have an attachment in the given status ('attached')
+def wait_for_interface_attachment(ec2, interface_ids, status = 'attached', timeout = default_timeout):
+    def ready():
+        response = ec2.describe_network_interfaces(NetworkInterfaceIds = list(interface_ids))
+        return all(i.get('Attachment', {}).get('Status') == status for i in response['NetworkInterfaces'])
+
+    description = "interfaces " + ", ".join(interface_ids) + " to be " + status
+    wait_until(description, ready, timeout)
+
+
+# Wait until all instances are in the given state ('running', 'stopped', ...)
+def wait_for_instance_state(ec2, instance_ids, state, timeout = default_timeout):
+    def ready():
+        response = ec2.describe_instances(InstanceIds = list(instance_ids))
+        states = [i['State']['Name'] for r in response['Reservations'] for i in r['Instances']]
+        return len(states) == len(instance_ids) and all(s == state for s in states)
+
+    description = "instances " + ", ".join(instance_ids) + " to be " + state
+    wait_until(description, ready, timeout)
+
+
+# Wait until an Elastic IP is associated with the given interface
+def wait_for_address_association(ec2, allocation_id, interface_id, timeout = default_timeout):
+    def ready():
+        response = ec2.describe_addresses(AllocationIds = [allocation_id])
+        return all(a.get('NetworkInterfaceId') == interface_id for a in response['Addresses'])
+
+    description = "Elastic IP " + allocation_id + " to be associated with " + interface_id
+    wait_until(description, ready, timeout)
+
+
+# Run several waits at once; each argument is a no-argument callable.
+# Returns once every wait is satisfied, and fails as soon as any wait fails.
+# The waits share the caller's deadline; on a failure the others stop at
+# their next poll, and are done polling by the time wait_all returns.
+def wait_all(*waits):
+    if not waits:
+        return
+    stop = threading.Event()
+
+    def run(wait):
+        thread_local.stop = stop
+        try:
+            return wait()
+        finally:
+            thread_local.stop = None
+
+    executor = ThreadPoolExecutor(max_workers = len(waits))
+    try:
+        futures = [executor.submit(bind(run), wait) for wait in waits]
+        done, pending = wait_futures(futures, return_when = FIRST_EXCEPTION)
+        for future in done:
+            future.result()
+    finally:
+        stop.set()
+        executor.shutdown(wait = True)
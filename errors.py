@@ -0,0 +1,9 @@
+
+# How the handlers and their helpers fail: the error is printed for the
+# function's log and the process exits, which raises SystemExit. Lambda
+# reports the invocation as failed; code that carries on after a failure
+# (other steps, other sites) catches SystemExit.
+
+def exit_with_error(error):
+    print "ERROR: " + error
+    exit (1)
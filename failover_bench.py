@@ -0,0 +1,590 @@
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from StringIO import StringIO
+
+# Offline failover benchmark. Runs the Lambda handlers against the in-memory
+# EC2 stand-in with modeled per-API latency and instance state transitions,
+# reports RTO, wall time and EC2 calls per operation, and fails when a change
+# adds API calls or makes a scenario's RTO worse than the recorded baseline
+# allows. The RTO is the time the handler reports in its metrics; wall time
+# also covers work done after that, such as refilling the standby pool.
+# Waiter polls are reported but not gated: how many polls a wait takes
+# depends on thread timing, which differs from run to run.
+#
+#   python failover_bench.py                    # run and compare to baseline
+#   python failover_bench.py --update-baseline  # record a new baseline
+
+baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+# Modeled EC2 control plane latency, in seconds
+default_latency = {
+    '*': 0.15,
+    'DescribeInstances': 0.1,
+    'DescribeNetworkInterfaces': 0.1,
+    'DescribeAddresses': 0.08,
+    'RunInstances': 0.6,
+}
+
+# Modeled instance state transitions, in seconds, scaled down from EC2
+default_transitions = {
+    'launch': 3.0,
+    'start': 1.0,
+    'stop': 0.5,
+    'terminate': 0.5,
+}
+
+# No credentials or region lookups may leave the machine
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+import call_deadlines
+import ec2_pool
+import ec2_throttle
+import ec2_waiters
+import failover_metrics
+import inventory
+
+from ec2_stand_in import EC2StandIn
+
+
+# Number of sites in the multi-site scenario
+site_count = 50
+
+# The lab topology the handlers are written for: nsg-B owns the access
+# interface and the Elastic IP sits on its uplink
+def build_lab(stand_in, suffix = '', public_ip = '18.235.97.139'):
+    nsg_b = stand_in.add_instance('nsg-B' + suffix)
+    access = stand_in.add_interface('nsgb-access' + suffix, '10.0.1.10')
+    uplink_a = stand_in.add_interface('nsgb-uplink-a' + suffix, '10.0.0.10')
+    stand_in.add_interface('nsgb-uplink-b' + suffix, '10.0.0.11')
+    stand_in.attach(uplink_a, nsg_b, 0)
+    stand_in.attach(access, nsg_b, 1)
+    allocation_id = stand_in.add_address(public_ip)
+    stand_in.associate(allocation_id, uplink_a)
+
+
+# Site definitions of lab copies built with build_lab(stand_in, '-<n>')
+def lab_sites(count):
+    return [
+        {
+            'name': 'site-%d' % n,
+            'old_nsg_name': 'nsg-B-%d' % n,
+            'nsg_name': 'Resilient-NSG-%d' % n,
+            'uplink_name': 'nsgb-uplink-b-%d' % n,
+            'access_interface_name': 'nsgb-access-%d' % n,
+            'elastic_ip': '18.0.%d.%d' % (n // 250, n % 250 + 1),
+        }
+        for n in range(count)
+    ]
+
+
+# Answer EC2 from a fresh stand-in. The pooled client is built up front, as
+# in a warm container, so wall time measures the failover and not botocore
+# model loading. The rate limiter starts with full buckets, no latencies are
+# known to time hedged reads, no incident has been handled (so an earlier
+# scenario's do not turn this one's into duplicates), and there is no
+# inventory index unless the scenario builds one.
+def install_stand_in(latency, throttle, transitions):
+    ec2_pool.reset()
+    ec2_throttle.reset()
+    call_deadlines.reset()
+    os.environ['IDEMPOTENCY_DIR'] = tempfile.mkdtemp(prefix = 'failover-bench-')
+    os.environ.pop('INVENTORY', None)
+    os.environ['INVENTORY_DIR'] = tempfile.mkdtemp(prefix = 'failover-bench-inventory-')
+    os.environ['STRATEGY_HISTORY_DIR'] = tempfile.mkdtemp(prefix = 'failover-bench-history-')
+    inventory.inventories.clear()
+    stand_in = EC2StandIn(latency = latency, throttle = throttle, transitions = transitions,
+                          is_poll = ec2_waiters.polling)
+    stand_in.install(ec2_pool.get_session())
+    ec2_pool.get_client('ec2', os.environ['AWS_DEFAULT_REGION'])
+    return stand_in
+
+
+# Run a handler with its output captured; returns (RTO, wall time, error)
+def run_handler(handler, event = None):
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    started = time.time()
+    error = None
+    try:
+        handler(event or {}, None)
+    except BaseException as e: # exit_with_error raises SystemExit
+        error = sys.stdout.getvalue().strip().splitlines()[-1:] or [repr(e)]
+        error = error[0]
+    finally:
+        wall_time = time.time() - started
+        sys.stdout = stdout
+    return failover_metrics.recorder.rto, wall_time, error
+
+
+# Each scenario sets up the stand-in and returns the handler and event to time
+def scenario_failover(stand_in):
+    import nsg_resiliency
+    build_lab(stand_in)
+    return nsg_resiliency.lambda_handler, {}
+
+
+# A warm failover from a pool seeded by the pool maintenance handler
+def scenario_failover_warm(stand_in):
+    import nsg_resiliency
+    import standby_pool
+    build_lab(stand_in)
+    event = {'sites': [{'name': 'nsg-B', 'failover_mode': 'warm'}]}
+    latency, transitions = stand_in.latency, stand_in.transitions
+    stand_in.latency, stand_in.transitions = {}, {}
+    run_handler(standby_pool.lambda_handler, event)
+    stand_in.latency, stand_in.transitions = latency, transitions
+    del stand_in.calls[:]
+    return nsg_resiliency.lambda_handler, event
+
+
+# Pool maintenance after an AMI rotation: the standby of the old AMI is
+# replaced by one of the current AMI
+def scenario_standby_pool(stand_in):
+    import standby_pool
+    build_lab(stand_in)
+    stand_in.add_instance('Resilient-NSG-standby', 'stopped', tags = {
+        'StandbyPool': 'Resilient-NSG-standby',
+        'StandbyAmi': 'ami-00000000000000old',
+    })
+    return standby_pool.lambda_handler, {'sites': [{'name': 'nsg-B', 'failover_mode': 'warm'}]}
+
+
+# Pool maintenance after a refill that did not complete: the standby of the
+# current AMI it launched was left running, and is stopped so it can be
+# claimed
+def scenario_standby_pool_awake(stand_in):
+    import nsg_resiliency
+    import standby_pool
+    build_lab(stand_in)
+    stand_in.add_instance('Resilient-NSG-standby', 'running', tags = {
+        'StandbyPool': 'Resilient-NSG-standby',
+        'StandbyAmi': nsg_resiliency.default_site['snapshot_ami_id'],
+    })
+    return standby_pool.lambda_handler, {'sites': [{'name': 'nsg-B', 'failover_mode': 'warm'}]}
+
+
+def scenario_failover_sites(stand_in):
+    import nsg_resiliency
+    sites = lab_sites(site_count)
+    for n, site in enumerate(sites):
+        build_lab(stand_in, '-%d' % n, site['elastic_ip'])
+    return nsg_resiliency.lambda_handler, {'sites': sites}
+
+
+# State-change events of an AZ outage: every instance reports stopping and
+# then shutting-down
+def outage_events(stand_in):
+    return [
+        {
+            'source': 'aws.ec2',
+            'detail-type': 'EC2 Instance State-change Notification',
+            'time': '2026-01-01T00:00:00Z',
+            'region': os.environ['AWS_DEFAULT_REGION'],
+            'detail': {'instance-id': instance_id, 'state': state},
+        }
+        for state in ('stopping', 'shutting-down') for instance_id in sorted(stand_in.instances)
+    ]
+
+
+# An AZ outage of every site's NSG and an unrelated instance, whose events
+# come through the queue and are failed over in one batch
+def scenario_failover_batch(stand_in):
+    import batch_consumer
+    handler, event = scenario_failover_sites(stand_in)
+    stand_in.add_instance('app-server')
+    queue = batch_consumer.LocalQueue()
+    for outage_event in outage_events(stand_in):
+        queue.send(outage_event)
+    return lambda event, context: batch_consumer.consume(queue, context, event, len(queue)), event
+
+
+# The same outage handled by the failover daemon, warmed up before it
+def scenario_failover_daemon(stand_in):
+    import failover_daemon
+    import nsg_resiliency
+    from site_runner import load_sites
+    handler, event = scenario_failover_sites(stand_in)
+    stand_in.add_instance('app-server')
+    os.environ['INVENTORY'] = '1'
+    daemon = failover_daemon.FailoverDaemon(load_sites(event, nsg_resiliency.default_site), batch_window = 0)
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        daemon.warm()
+    finally:
+        sys.stdout = stdout
+    for outage_event in outage_events(stand_in):
+        daemon.submit(outage_event)
+    del stand_in.calls[:]
+    return lambda event, context: daemon.handle_next(0), event
+
+
+# A failover whose first interface lookup hangs; the hedged duplicate answers
+def scenario_failover_stall(stand_in):
+    import nsg_resiliency
+    build_lab(stand_in)
+    stand_in.stall('DescribeNetworkInterfaces', 8.0)
+    return nsg_resiliency.lambda_handler, {}
+
+
+# The multi-site failover in a warm container whose inventory index was
+# built before the outage
+def scenario_failover_inventory(stand_in):
+    handler, event = scenario_failover_sites(stand_in)
+    os.environ['INVENTORY'] = '1'
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        inventory.get_inventory(os.environ['AWS_DEFAULT_REGION'])
+    finally:
+        sys.stdout = stdout
+    del stand_in.calls[:]
+    return handler, event
+
+
+# A swap to a peer NSG that is already running on the new uplink. The access
+# interface moves to the peer, or, in the float variant, its secondary IPs do.
+def scenario_failover_swap(stand_in, float_ips = False):
+    import nsg_resiliency
+    build_lab(stand_in)
+    peer = stand_in.add_instance('nsg-B-peer')
+    for interface_id, interface in stand_in.interfaces.items():
+        if {'Key': 'Name', 'Value': 'nsgb-uplink-b'} in interface['TagSet']:
+            stand_in.attach(interface_id, peer, 0)
+        if {'Key': 'Name', 'Value': 'nsgb-access'} in interface['TagSet']:
+            interface['PrivateIpAddresses'].append({'PrivateIpAddress': '10.0.1.20', 'Primary': False})
+    site = {'name': 'nsg-B', 'failover_mode': 'swap', 'peer_name': 'nsg-B-peer'}
+    if float_ips:
+        stand_in.attach(stand_in.add_interface('nsgb-peer-access', '10.0.1.11'), peer, 1)
+        site['peer_access_interface_name'] = 'nsgb-peer-access'
+    return nsg_resiliency.lambda_handler, {'sites': [site]}
+
+
+def scenario_failover_swap_float(stand_in):
+    return scenario_failover_swap(stand_in, float_ips = True)
+
+
+# A swap to a peer that fails its status checks, which falls back to a cold
+# failover; the site lets the peer, which has the uplink as its primary
+# interface, be terminated
+def scenario_failover_swap_impaired(stand_in):
+    handler, event = scenario_failover_swap(stand_in)
+    event['sites'][0]['terminate_unhealthy_peer'] = True
+    for instance_id, instance in stand_in.instances.items():
+        if {'Key': 'Name', 'Value': 'nsg-B-peer'} in instance['Tags']:
+            stand_in.impair(instance_id)
+    return handler, event
+
+
+# A capacity shortage: the first choice instance type is out of capacity in
+# the interfaces' AZ and the second does not run the AMI's architecture
+def scenario_failover_capacity(stand_in):
+    import capacity_launcher
+    import nsg_resiliency
+    capacity_launcher.recent_failures.clear()
+    capacity_launcher.compatibility.clear()
+    build_lab(stand_in)
+    stand_in.add_image(nsg_resiliency.default_site['snapshot_ami_id'], [])
+    stand_in.no_capacity.add('c4.xlarge')
+    return nsg_resiliency.lambda_handler, {'sites': [{
+        'name': 'nsg-B',
+        'fallback_instance_types': ['c6g.xlarge', 'c5.xlarge'],
+    }]}
+
+
+# A hedged capacity shortage: capacity for three types is reserved at once;
+# the first choice is out of capacity and the second cannot be reserved at
+# all, so the NSG runs in the third's reservation. No reservation is left
+# active afterwards.
+def scenario_failover_capacity_hedge(stand_in):
+    import capacity_launcher
+    import nsg_resiliency
+    from errors import exit_with_error
+    capacity_launcher.recent_failures.clear()
+    capacity_launcher.compatibility.clear()
+    build_lab(stand_in)
+    stand_in.add_image(nsg_resiliency.default_site['snapshot_ami_id'], [])
+    stand_in.no_capacity.add('c4.xlarge')
+    stand_in.unreservable.add('c5.xlarge')
+
+    def hedged(event, context):
+        nsg_resiliency.lambda_handler(event, context)
+        active = sorted(r['CapacityReservationId'] for r in stand_in.reservations.values() if r['State'] == 'active')
+        if active:
+            exit_with_error("Capacity reservations left active: " + ", ".join(active))
+    return hedged, {'sites': [{
+        'name': 'nsg-B',
+        'fallback_instance_types': ['c5.xlarge', 'm5.xlarge'],
+        'capacity_hedge': 3,
+    }]}
+
+
+# A regional outage: us-east-1 does not answer, so the site is failed over
+# to the interfaces, Elastic IP and AMI copy staged in its DR region
+def scenario_failover_dr(stand_in):
+    import dr_region
+    import nsg_resiliency
+    build_lab(stand_in)
+    stand_in.add_interface('nsgb-uplink-b-dr', '10.1.0.11', 'us-west-2a')
+    stand_in.add_interface('nsgb-access-dr', '10.1.1.10', 'us-west-2a')
+    stand_in.add_address('34.208.0.10')
+    ami_id = nsg_resiliency.default_site['snapshot_ami_id']
+    stand_in.add_image('ami-00000000000000d01', [], {dr_region.source_tag: 'us-east-1/' + ami_id})
+    stand_in.unavailable_regions.add('us-east-1')
+    ec2_pool.get_client('ec2', 'us-west-2')
+    return nsg_resiliency.lambda_handler, {'sites': [{
+        'name': 'nsg-B',
+        'dr_region': 'us-west-2',
+        'dr_uplink_name': 'nsgb-uplink-b-dr',
+        'dr_access_interface_name': 'nsgb-access-dr',
+        'dr_elastic_ip': '34.208.0.10',
+    }]}
+
+
+# An adaptive site without a standby pool, whose history has cold launches
+# turning slow in its AZ and quick reboots; the selector picks a reboot
+def scenario_failover_adaptive(stand_in):
+    import nsg_resiliency
+    import strategy_history
+    build_lab(stand_in)
+    history = strategy_history.FileHistory(os.environ['AWS_DEFAULT_REGION'], os.environ['STRATEGY_HISTORY_DIR'])
+    history.record([(strategy_history.history_key('strategy', 'cold', 'c4.xlarge', 'us-east-1a'), 300.0, True)] * 10 +
+                   [(strategy_history.history_key('strategy', 'reboot', 'c4.xlarge', 'us-east-1a'), 20.0, True)] * 5)
+    return nsg_resiliency.lambda_handler, {'sites': [{
+        'name': 'nsg-B',
+        'failover_mode': 'adaptive',
+        'standby_pool_size': 0,
+    }]}
+
+
+# A failover recorded to a cassette against the stand-in, then replayed for
+# site_count synthetic sites (see cassette). The replayed calls are counted
+# as the stand-in's. A request the replay cannot match fails the scenario,
+# and so does a failover step that is not called once per site.
+def scenario_cassette_replay(stand_in):
+    import cassette
+    import nsg_resiliency
+    from errors import exit_with_error
+
+    # Record, through the session CASSETTE_RECORD sets up
+    build_lab(stand_in)
+    path = os.path.join(tempfile.mkdtemp(prefix = 'failover-bench-cassette-'), 'failover.jsonl')
+    os.environ['CASSETTE_RECORD'] = path
+    try:
+        ec2_pool.reset()
+        stand_in.install(ec2_pool.get_session())
+        rto, wall_time, error = run_handler(nsg_resiliency.lambda_handler, {})
+    finally:
+        os.environ.pop('CASSETTE_RECORD')
+    if error:
+        return (lambda event, context: exit_with_error("Recording failed: " + error)), {}
+    interactions = cassette.load(path)
+
+    # Replay, on a fresh session the stand-in does not answer
+    ec2_pool.reset()
+    ec2_throttle.reset()
+    call_deadlines.reset()
+    replayer = cassette.Replayer(interactions, site_count, is_poll = ec2_waiters.polling)
+    replayer.install(ec2_pool.get_session())
+    ec2_pool.get_client('ec2', os.environ['AWS_DEFAULT_REGION'])
+    run, handler_name = replayer.runs()[0]
+    del stand_in.calls[:]
+
+    def replay(event, context):
+        replayer.start_run(run)
+        try:
+            nsg_resiliency.lambda_handler(event, context)
+        finally:
+            stand_in.calls.extend(replayer.calls)
+        recorded = [i['operation'] for i in interactions if not i['operation'].startswith('Describe')]
+        replayed = [call[0] for call in replayer.calls if not call[0].startswith('Describe')]
+        for operation in sorted(set(recorded + replayed)):
+            if replayed.count(operation) != recorded.count(operation) * site_count:
+                exit_with_error("Replayed %d %s calls for %d sites, recorded %d for one" % (
+                    replayed.count(operation), operation, site_count, recorded.count(operation)))
+
+    return replay, {'sites': [replayer.site(n, nsg_resiliency.default_site) for n in range(site_count)]}
+
+
+# The health detector watching every site of the multi-site scenario, one of
+# which fails its instance status check
+def scenario_health_detector(stand_in):
+    import health_detector
+    sites = lab_sites(site_count)
+    for n, site in enumerate(sites):
+        build_lab(stand_in, '-%d' % n, site['elastic_ip'])
+    for instance_id, instance in stand_in.instances.items():
+        if {'Key': 'Name', 'Value': 'nsg-B-7'} in instance['Tags']:
+            stand_in.impair(instance_id)
+    return health_detector.lambda_handler, {'sites': sites, 'interval': 0.2, 'failure_threshold': 3, 'max_ticks': 5}
+
+
+def scenario_lab_reset(stand_in):
+    import lab_reset
+    import nsg_resiliency
+    build_lab(stand_in)
+    latency, transitions = stand_in.latency, stand_in.transitions
+    stand_in.latency, stand_in.transitions = {}, {}
+    run_handler(nsg_resiliency.lambda_handler)
+    stand_in.latency, stand_in.transitions = latency, transitions
+    del stand_in.calls[:]
+    return lab_reset.lambda_handler, {}
+
+
+# A reset of a lab that is already reset
+def scenario_lab_reset_again(stand_in):
+    handler, event = scenario_lab_reset(stand_in)
+    latency, transitions = stand_in.latency, stand_in.transitions
+    stand_in.latency, stand_in.transitions = {}, {}
+    run_handler(handler, event)
+    stand_in.latency, stand_in.transitions = latency, transitions
+    del stand_in.calls[:]
+    return handler, event
+
+
+scenarios = [
+    ('nsg_resiliency', scenario_failover),
+    ('nsg_resiliency_warm', scenario_failover_warm),
+    ('nsg_resiliency_sites', scenario_failover_sites),
+    ('nsg_resiliency_inventory', scenario_failover_inventory),
+    ('nsg_resiliency_batch', scenario_failover_batch),
+    ('nsg_resiliency_daemon', scenario_failover_daemon),
+    ('nsg_resiliency_dr', scenario_failover_dr),
+    ('nsg_resiliency_capacity', scenario_failover_capacity),
+    ('nsg_resiliency_capacity_hedge', scenario_failover_capacity_hedge),
+    ('nsg_resiliency_swap', scenario_failover_swap),
+    ('nsg_resiliency_swap_float', scenario_failover_swap_float),
+    ('nsg_resiliency_swap_impaired', scenario_failover_swap_impaired),
+    ('nsg_resiliency_stall', scenario_failover_stall),
+    ('nsg_resiliency_adaptive', scenario_failover_adaptive),
+    ('cassette_replay', scenario_cassette_replay),
+    ('standby_pool', scenario_standby_pool),
+    ('standby_pool_awake', scenario_standby_pool_awake),
+    ('health_detector', scenario_health_detector),
+    ('lab_reset', scenario_lab_reset),
+    ('lab_reset_again', scenario_lab_reset_again),
+]
+
+
+def run_scenarios(latency, throttle, transitions):
+    results = {}
+    for name, scenario in scenarios:
+        random.seed(name) # Same waiter jitter on every run
+        stand_in = install_stand_in(latency, throttle, transitions)
+        handler, event = scenario(stand_in)
+        rto, wall_time, error = run_handler(handler, event)
+        results[name] = {
+            'rto': round(rto, 3),
+            'wall_time': round(wall_time, 3),
+            'serial_latency': round(stand_in.serial_latency(), 3),
+            'total_calls': len(stand_in.calls),
+            'calls': stand_in.call_counts(),
+            'polls': stand_in.poll_counts(),
+            'error': error,
+        }
+    return results
+
+
+def print_results(results):
+    for name in sorted(results):
+        result = results[name]
+        print "%-20s rto %7.3fs  wall %7.3fs  serial %7.3fs  calls %3d%s" % (
+            name, result['rto'], result['wall_time'], result['serial_latency'], result['total_calls'],
+            "  ERROR: " + result['error'] if result['error'] else "")
+        for operation in sorted(result['calls']):
+            polls = ""
+            if result['polls'].get(operation):
+                polls = "  (%d polls)" % result['polls'][operation]
+            print "    %-28s %3d%s" % (operation, result['calls'][operation], polls)
+
+
+# Compare against the baseline; returns a list of regressions
+def check_baseline(results, baseline, max_slowdown):
+    regressions = []
+    for name in sorted(results):
+        result = results[name]
+        if result['error']:
+            regressions.append(name + ": failed: " + result['error'])
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        expected_polls = expected.get('polls', {})
+        for operation in sorted(result['calls']):
+            calls = result['calls'][operation] - result['polls'].get(operation, 0)
+            allowed_calls = expected['calls'].get(operation, 0) - expected_polls.get(operation, 0)
+            if calls > allowed_calls:
+                regressions.append("%s: %s calls %d > %d" % (name, operation, calls, allowed_calls))
+        limit = expected['rto'] * (1 + max_slowdown)
+        if result['rto'] > limit:
+            regressions.append("%s: RTO %.3fs > %.3fs" % (name, result['rto'], limit))
+    return regressions
+
+
+def parse_rates(values):
+    rates = {}
+    for value in values or []:
+        operation, rate = value.split('=')
+        rates[operation] = rate
+    return rates
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Offline failover benchmark")
+    parser.add_argument('--latency', action = 'append', metavar = 'OPERATION=SECONDS',
+                        help = "override the modeled latency of an operation ('*' for all)")
+    parser.add_argument('--throttle', action = 'append', metavar = 'OPERATION=CALLS',
+                        help = "throttle the first CALLS calls of an operation ('*' for all)")
+    parser.add_argument('--speedup', type = float, default = 1.0,
+                        help = "divide every modeled latency and transition time by this factor")
+    parser.add_argument('--max-slowdown', type = float, default = 0.25,
+                        help = "allowed RTO increase over the baseline (default 0.25)")
+    parser.add_argument('--update-baseline', action = 'store_true',
+                        help = "record the results as the new baseline")
+    args = parser.parse_args()
+
+    latency = dict(default_latency)
+    latency.update((k, float(v)) for k, v in parse_rates(args.latency).items())
+    latency = dict((k, v / args.speedup) for k, v in latency.items())
+    throttle = dict((k, int(v)) for k, v in parse_rates(args.throttle).items())
+    transitions = dict((k, v / args.speedup) for k, v in default_transitions.items())
+
+    results = run_scenarios(latency, throttle, transitions)
+    print_results(results)
+
+    if args.update_baseline:
+        with open(baseline_file, 'w') as f:
+            json.dump(results, f, indent = 4, separators = (',', ': '), sort_keys = True)
+            f.write("\n")
+        print "Baseline written to " + baseline_file
+        return 0
+
+    if not os.path.exists(baseline_file):
+        print "No baseline at " + baseline_file + "; run with --update-baseline"
+        return 0
+
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    if args.speedup != 1.0:
+        baseline = dict((name, dict(b, rto = b['rto'] / args.speedup)) for name, b in baseline.items())
+
+    regressions = check_baseline(results, baseline, args.max_slowdown)
+    for regression in regressions:
+        print "REGRESSION: " + regression
+    if regressions:
+        return 1
+    print "Benchmark ... [ SUCCESS ]"
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
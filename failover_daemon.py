@@ -0,0 +1,189 @@
+
+import argparse
+import json
+import os
+import SocketServer
+import sys
+import threading
+import time
+
+import inventory
+import nsg_resiliency
+
+from batch_consumer import LocalQueue, consume
+from ec2_pool import get_client
+from errors import exit_with_error
+from site_runner import load_sites
+
+# Long-running failover daemon, for running the failover on a host or
+# container of its own instead of as a Lambda. It does the Lambda's work once
+# at startup instead of on the failover's critical path: the pooled EC2
+# clients are built, their service models loaded and their connections
+# opened, and the inventory index of every site region is built and kept in
+# memory (unless INVENTORY=0 is set). A background thread keeps both warm:
+# idle connections are used every keepalive_interval seconds, and indexes
+# are rebuilt before they reach INVENTORY_MAX_AGE.
+#
+# Events are the EC2 state-change events of the rule. They are taken from a
+# LocalQueue, filled by submit() in process or by clients of the daemon's
+# socket, which takes one JSON event per line and answers each with
+# "QUEUED <message ID>" or "ERROR <reason>":
+#
+#   python failover_daemon.py --sites-file sites.json --socket /run/nsg-failover.sock
+#   python failover_daemon.py --sites-file sites.json --port 8470
+#
+# Events are handled by the batch consumer (see batch_consumer): events
+# arriving within batch_window seconds of each other are coalesced into one
+# failover pass, whose sites fail over at once. Passes run one at a time, so
+# each has its own metrics and budget; events arriving during a pass are
+# handled by the next one. Standby pools of warm failovers refill in the
+# background (see standby_pool), so the next pass does not wait for them.
+
+default_batch_window = 0.2
+default_batch_size = 1000
+keepalive_interval = 20
+
+class FailoverDaemon(object):
+
+    def __init__(self, sites, queue = None, batch_window = default_batch_window, batch_size = default_batch_size):
+        self.sites = sites
+        self.queue = queue or LocalQueue()
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.regions = sorted(set(site['region'] for site in sites) |
+                              set(site['dr_region'] for site in sites if site['dr_region']))
+        self.stopped = threading.Event()
+        self.passes = 0
+
+    # Build the clients, open their connections and build the indexes
+    def warm(self):
+        started = time.time()
+        for region in self.regions:
+            ec2 = get_client('ec2', region)
+            for operation_name in nsg_resiliency.failover_operations:
+                ec2.meta.service_model.operation_model(operation_name)
+            self.ping(region)
+            if inventory.enabled():
+                inventory.get_inventory(region)
+        msg = "Daemon warm for " + ", ".join(self.regions) + " (%.2fs) ... [ SUCCESS ]" % (time.time() - started)
+        print msg
+
+    def ping(self, region):
+        try:
+            get_client('ec2', region).describe_availability_zones()
+        except Exception as e:
+            print "Unable to reach EC2 in " + region + ". Exception: " + str(e)
+
+    # Keep connections open and indexes fresh until the daemon stops
+    def keep_warm(self):
+        max_age = float(os.environ.get('INVENTORY_MAX_AGE', inventory.default_max_age))
+        while not self.stopped.wait(keepalive_interval):
+            for region in self.regions:
+                if not inventory.enabled():
+                    self.ping(region)
+                    continue
+                try:
+                    index = inventory.get_inventory(region)
+                    if time.time() - index.built > max_age / 2:
+                        index.build()
+                        index.save()
+                    else:
+                        self.ping(region)
+                except SystemExit: # exit_with_error; the next lookup builds it
+                    pass
+
+    # Queue an event; returns its message ID
+    def submit(self, event):
+        return self.queue.send(event)
+
+    # Wait up to timeout seconds for events and handle them in one pass.
+    # Returns the batch consumer's response, or None if no event came.
+    def handle_next(self, timeout = None):
+        if not self.queue.wait(timeout):
+            return None
+        time.sleep(self.batch_window)
+        self.passes += 1
+        try:
+            return consume(self.queue, None, {'sites': self.sites}, self.batch_size)
+        except SystemExit: # exit_with_error; the batch's messages are queued again
+            print "Failover pass " + str(self.passes) + " did not complete"
+            return None
+
+    def run(self):
+        keeper = threading.Thread(target = self.keep_warm, name = 'keep-warm')
+        keeper.daemon = True
+        keeper.start()
+        while not self.stopped.is_set():
+            self.handle_next(timeout = 1)
+
+    def stop(self):
+        self.stopped.set()
+
+
+# One JSON event per line
+class EventHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError as e:
+                self.wfile.write("ERROR " + str(e) + "\n")
+                continue
+            self.wfile.write("QUEUED " + self.server.failover_daemon.submit(event) + "\n")
+
+
+class UnixEventServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class TCPEventServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# Serve the daemon's socket in a background thread; returns the server
+def serve(failover_daemon, socket_path = None, port = None, host = '127.0.0.1'):
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixEventServer(socket_path, EventHandler)
+    else:
+        server = TCPEventServer((host, port), EventHandler)
+    server.failover_daemon = failover_daemon
+    thread = threading.Thread(target = server.serve_forever, name = 'event-server')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run the NSG failover as a long-running daemon")
+    parser.add_argument('--sites-file', help = "JSON file of the sites to protect (default: the default site)")
+    listen = parser.add_mutually_exclusive_group(required = True)
+    listen.add_argument('--socket', help = "Unix socket to take events on")
+    listen.add_argument('--port', type = int, help = "TCP port on localhost to take events on")
+    parser.add_argument('--batch-window', type = float, default = default_batch_window,
+                        help = "seconds to wait for more events before a failover pass")
+    args = parser.parse_args()
+
+    os.environ.setdefault('INVENTORY', '1')
+    event = {'sites_file': args.sites_file} if args.sites_file else {}
+    failover_daemon = FailoverDaemon(load_sites(event, nsg_resiliency.default_site), batch_window = args.batch_window)
+    failover_daemon.warm()
+    server = serve(failover_daemon, args.socket, args.port)
+    print "Taking events on " + (args.socket or "port " + str(args.port)) + " ... [ SUCCESS ]"
+    try:
+        failover_daemon.run()
+    except KeyboardInterrupt:
+        failover_daemon.stop()
+    finally:
+        server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,244 @@
+
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+
+from call_deadlines import carry
+from ec2_throttle import current_attempt, throttle_codes
+
+# Latency instrumentation for the handlers. botocore before-call/after-call
+# hooks time every EC2 API call and count its retries (botocore's and those
+# of ec2_throttle, each of which is recorded as a call) and throttles, spans
+# time the handler steps, and the results are printed as CloudWatch Embedded
+# Metric Format (EMF) documents. CloudWatch extracts the metrics from the log
+# lines, so nothing is sent from the hot path.
+
+namespace = 'NSGResiliency'
+
+thread_local = threading.local()
+carry(thread_local) # API calls are attributed to the caller's span
+recorder = None
+cold_start = None
+
+
+# Measurements of one handler invocation
+class Recorder(object):
+
+    def __init__(self, handler_name):
+        self.handler_name = handler_name
+        self.started = time.time()
+        self.finished = None
+        self.lock = threading.Lock()
+        self.api_calls = []
+        self.spans = []
+
+    def add_api_call(self, call):
+        with self.lock:
+            self.api_calls.append(call)
+
+    def add_span(self, name, started, finished, error):
+        with self.lock:
+            self.spans.append({'name': name, 'started': started, 'finished': finished, 'error': error})
+
+    # End to end time of the invocation, up to when its metrics were emitted
+    @property
+    def rto(self):
+        return (self.finished or time.time()) - self.started
+
+
+# Start recording a new handler invocation
+def start_recording(handler_name):
+    global recorder
+    recorder = Recorder(handler_name)
+    return recorder
+
+
+# Record the import and init time of a cold start, in seconds, to be
+# reported with the next invocation
+def record_cold_start(import_time, init_time):
+    global cold_start
+    cold_start = {'import': import_time, 'init': init_time}
+
+
+def current_span():
+    stack = getattr(thread_local, 'spans', None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+# Time a block of handler code. API calls made in the block, from the same
+# thread, are attributed to it.
+@contextmanager
+def span(name):
+    stack = getattr(thread_local, 'spans', None)
+    if stack is None:
+        stack = thread_local.spans = []
+    stack.append(name)
+    started = time.time()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        stack.pop()
+        if recorder is not None:
+            recorder.add_span(name, started, time.time(), error)
+
+
+# Register the timing hooks on a boto3 session; every client created from it
+# afterwards is instrumented
+def instrument(session):
+    events = session.events
+    events.register('before-call.ec2', before_call)
+    events.register('needs-retry.ec2', needs_retry)
+    events.register('after-call.ec2', after_call)
+    events.register('after-call-error.ec2', after_call_error)
+
+
+def before_call(model, context, **kwargs):
+    context['metrics'] = {
+        'operation': model.name,
+        'started': time.time(),
+        'span': current_span(),
+        'throttles': 0,
+        'attempt': current_attempt(),
+    }
+
+
+def needs_retry(response, request_dict, **kwargs):
+    metrics = request_dict.get('context', {}).get('metrics')
+    if metrics is not None and response is not None:
+        if response[1].get('Error', {}).get('Code') in throttle_codes:
+            metrics['throttles'] += 1
+
+
+def after_call(http_response, parsed, model, context, **kwargs):
+    metadata = parsed.get('ResponseMetadata', {})
+    error_code = parsed.get('Error', {}).get('Code')
+    record_api_call(model.name, context, metadata.get('RetryAttempts', 0), error_code)
+
+
+def after_call_error(exception, context, **kwargs):
+    operation_name = context.get('metrics', {}).get('operation', 'Unknown')
+    record_api_call(operation_name, context, 0, type(exception).__name__)
+
+
+def record_api_call(operation_name, context, retries, error_code):
+    metrics = context.get('metrics')
+    if recorder is None or metrics is None:
+        return
+    throttles = metrics['throttles']
+    if error_code in throttle_codes:
+        throttles += 1
+    recorder.add_api_call({
+        'operation': operation_name,
+        'span': metrics['span'],
+        'started': metrics['started'],
+        'duration': time.time() - metrics['started'],
+        'retries': retries + metrics['attempt'],
+        'throttles': throttles,
+        'error': error_code,
+    })
+
+
+def milliseconds(seconds):
+    return round(seconds * 1000.0, 3)
+
+
+def emf_document(dimensions, metrics, values):
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [
+                {
+                    'Namespace': namespace,
+                    'Dimensions': [sorted(dimensions.keys())],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in metrics],
+                }
+            ],
+        },
+    }
+    document.update(dimensions)
+    document.update(values)
+    return document
+
+
+# Build the EMF documents of the current invocation: total RTO, one per step
+# and one per API operation. Durations are lists so CloudWatch can compute
+# p50/p99 across invocations. The first invocation of a container also gets
+# a ColdStart document with the import, init and first API call times.
+def emf_documents():
+    if recorder is None:
+        return []
+
+    handler = {'Handler': recorder.handler_name}
+    with recorder.lock:
+        api_calls = list(recorder.api_calls)
+        spans = list(recorder.spans)
+
+    documents = [
+        emf_document(handler,
+            [('RTO', 'Milliseconds'), ('ApiCalls', 'Count'), ('Retries', 'Count'), ('Throttles', 'Count')],
+            {
+                'RTO': milliseconds(recorder.rto),
+                'ApiCalls': len(api_calls),
+                'Retries': sum(c['retries'] for c in api_calls),
+                'Throttles': sum(c['throttles'] for c in api_calls),
+            })
+    ]
+
+    for s in spans:
+        dimensions = dict(handler, Step = s['name'])
+        documents.append(emf_document(dimensions,
+            [('StepDuration', 'Milliseconds'), ('StepErrors', 'Count')],
+            {
+                'StepDuration': milliseconds(s['finished'] - s['started']),
+                'StepErrors': 1 if s['error'] else 0,
+            }))
+
+    if cold_start is not None:
+        first_call = min(api_calls, key = lambda c: c['started']) if api_calls else None
+        values = {'InitDuration': milliseconds(cold_start['init'])}
+        if cold_start['import'] is not None:
+            values['ImportDuration'] = milliseconds(cold_start['import'])
+        if first_call is not None:
+            values['FirstCallDuration'] = milliseconds(first_call['duration'])
+        documents.append(emf_document(dict(handler, Phase = 'ColdStart'),
+            [(name, 'Milliseconds') for name in sorted(values)], values))
+
+    operations = sorted(set(c['operation'] for c in api_calls))
+    for operation in operations:
+        calls = [c for c in api_calls if c['operation'] == operation]
+        dimensions = dict(handler, Operation = operation)
+        documents.append(emf_document(dimensions,
+            [('ApiLatency', 'Milliseconds'), ('ApiCalls', 'Count'), ('Retries', 'Count'),
+             ('Throttles', 'Count'), ('ApiErrors', 'Count')],
+            {
+                'ApiLatency': [milliseconds(c['duration']) for c in calls],
+                'ApiCalls': len(calls),
+                'Retries': sum(c['retries'] for c in calls),
+                'Throttles': sum(c['throttles'] for c in calls),
+                'ApiErrors': len([c for c in calls if c['error']]),
+                'Steps': sorted(set(c['span'] for c in calls if c['span'])),
+            }))
+
+    return documents
+
+
+# Print the EMF documents of the current invocation, one log line each.
+# A cold start is reported with the first invocation only.
+def emit_metrics():
+    global cold_start
+    if recorder is not None and recorder.finished is None:
+        recorder.finished = time.time()
+    for document in emf_documents():
+        print json.dumps(document, sort_keys = True)
+    if recorder is not None and cold_start is not None:
+        print "Cold start: import %s, init %.3fs" % (
+            "%.3fs" % cold_start['import'] if cold_start['import'] is not None else "unknown", cold_start['init'])
+        cold_start = None
@@ -0,0 +1,139 @@
+
+import threading
+
+from ec2_pool import get_client
+from ec2_topology import Topology
+from errors import exit_with_error
+from site_runner import load_sites
+
+# Fast Snapshot Restore (FSR) for the failover AMI. Volumes created from a
+# snapshot are hydrated lazily from S3, so a new NSG launched from the AMI
+# runs against a cold disk for its first minutes. With FSR enabled for the
+# AMI's snapshots in the AZ the NSG launches in, its volumes are fully
+# initialized from the start.
+#
+# Sites opt in with 'fast_snapshot_restore': true. prestage() (and the
+# lambda_handler, meant to run on a schedule and after every AMI rotation)
+# keeps FSR enabled for each site's AMI in the AZ of its uplink interface.
+# At failover time the FSR state is checked, not assumed, and the site's
+# result reports how the new NSG's disk is hydrated:
+#   'fast-restore'  FSR is enabled for every snapshot of the AMI in the AZ
+#   'lazy'          it is not (yet), volumes hydrate on first read
+#   'standby'       a warm standby was started; its disk is already warm
+# NOTE: FSR is billed per snapshot and AZ while enabled, and the number of
+#       FSR-enabled snapshots per region is limited. Disable it for AMIs that
+#       were rotated out.
+
+lock = threading.Lock()
+snapshot_ids = {}
+
+# Snapshot IDs behind an AMI. They never change, so they are only looked
+# up once per container.
+def ami_snapshot_ids(region_name, ami_id):
+    with lock:
+        if (region_name, ami_id) in snapshot_ids:
+            return snapshot_ids[(region_name, ami_id)]
+
+    ec2 = get_client('ec2', region_name)
+    try:
+        image = ec2.describe_images(ImageIds = [ami_id])['Images'][0]
+    except Exception as e:
+        error = "Unable to describe AMI " + ami_id + ". Exception: " + str(e)
+        exit_with_error(error)
+
+    ids = [m['Ebs']['SnapshotId'] for m in image.get('BlockDeviceMappings', []) if 'SnapshotId' in m.get('Ebs', {})]
+    with lock:
+        snapshot_ids[(region_name, ami_id)] = ids
+    return ids
+
+
+# FSR state of every snapshot in every zone, as {(snapshot ID, zone): state}.
+# Pairs EC2 does not list are disabled.
+def get_fast_restore_states(region_name, snapshots, zones):
+    states = dict(((snapshot_id, zone), 'disabled') for snapshot_id in snapshots for zone in zones)
+    if not states:
+        return states
+
+    ec2 = get_client('ec2', region_name)
+    try:
+        paginator = ec2.get_paginator('describe_fast_snapshot_restores')
+        pages = paginator.paginate(
+            Filters = [
+                {
+                    'Name': 'snapshot-id',
+                    'Values': list(snapshots)
+                },
+                {
+                    'Name': 'availability-zone',
+                    'Values': list(zones)
+                }
+            ]
+        )
+        for page in pages:
+            for restore in page['FastSnapshotRestores']:
+                states[(restore['SnapshotId'], restore['AvailabilityZone'])] = restore['State']
+    except Exception as e:
+        error = "Unable to describe fast snapshot restores of " + ", ".join(snapshots) + ". Exception: " + str(e)
+        exit_with_error(error)
+    return states
+
+
+# How the disk of an NSG launched from the AMI in the zone gets hydrated
+def hydration_status(region_name, ami_id, zone):
+    snapshots = ami_snapshot_ids(region_name, ami_id)
+    states = get_fast_restore_states(region_name, snapshots, [zone])
+    not_ready = sorted((s, state) for (s, z), state in states.items() if state != 'enabled')
+    for snapshot_id, state in not_ready:
+        print "Fast snapshot restore of " + snapshot_id + " in " + zone + " is " + state + ", volume hydrates lazily"
+    if not snapshots or not_ready:
+        return 'lazy'
+    return 'fast-restore'
+
+
+# Enable FSR for the AMI's snapshots in every zone where it is not enabled
+# or on its way. Returns the FSR states.
+def prestage(region_name, ami_id, zones):
+    snapshots = ami_snapshot_ids(region_name, ami_id)
+    states = get_fast_restore_states(region_name, snapshots, zones)
+    missing = [(s, z) for (s, z), state in sorted(states.items()) if state in ('disabling', 'disabled')]
+
+    if missing:
+        ec2 = get_client('ec2', region_name)
+        try:
+            response = ec2.enable_fast_snapshot_restores(
+                AvailabilityZones = sorted(set(z for s, z in missing)),
+                SourceSnapshotIds = sorted(set(s for s, z in missing))
+            )
+        except Exception as e:
+            error = "Unable to enable fast snapshot restore for AMI " + ami_id + ". Exception: " + str(e)
+            exit_with_error(error)
+
+        for restore in response.get('Successful', []):
+            states[(restore['SnapshotId'], restore['AvailabilityZone'])] = restore['State']
+        for failure in response.get('Unsuccessful', []):
+            for item in failure.get('FastSnapshotRestoreStateErrors', []):
+                error = item.get('Error', {})
+                print "Fast snapshot restore of " + failure['SnapshotId'] + " in " + item['AvailabilityZone'] + \
+                      " not enabled: " + str(error.get('Message'))
+
+    for (snapshot_id, zone), state in sorted(states.items()):
+        msg = "Fast snapshot restore of " + snapshot_id + " in " + zone + " ... [ " + state.upper() + " ]"
+        print msg
+    return states
+
+
+# Lambda callback: prestage the AMI of every site that opted in
+def lambda_handler(event, context):
+    import nsg_resiliency # Only for the site defaults
+    sites = [site for site in load_sites(event, nsg_resiliency.default_site) if site['fast_snapshot_restore']]
+
+    results = {}
+    for region in sorted(set(site['region'] for site in sites)):
+        region_sites = [site for site in sites if site['region'] == region]
+        topology = Topology(region, interface_names = [site['uplink_name'] for site in region_sites])
+        for ami_id in sorted(set(site['snapshot_ami_id'] for site in region_sites)):
+            zones = sorted(set(topology.interface(site['uplink_name'])['AvailabilityZone']
+                               for site in region_sites if site['snapshot_ami_id'] == ami_id))
+            states = prestage(region, ami_id, zones)
+            results[region + '/' + ami_id] = dict((s + '/' + z, state) for (s, z), state in states.items())
+    return results
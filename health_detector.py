@@ -0,0 +1,267 @@
+
+import json
+import time
+import_started = time.time()
+
+import batch_consumer
+import failover_metrics
+import nsg_resiliency
+
+from cold_start import prewarm
+from ec2_pool import get_client
+from ec2_topology import Topology, gone_states
+from site_runner import load_sites
+
+# Health detector: an alternative trigger to the EC2 state-change rule. It
+# polls the system and instance status checks of every protected NSG, one
+# batched describe_instance_status call per region and tick, and fails a
+# site over as soon as its NSG fails a number of consecutive checks. Unlike
+# the state-change rule it also catches NSGs that are hung but running, and
+# it does not wait for event delivery.
+#
+# Run it on a schedule (e.g. every minute) with the sites to protect:
+#   {"sites": [...], "interval": 5, "failure_threshold": 3, "duration": 55}
+# The Lambda timeout must cover the duration plus a failover. Failure counts
+# are kept across warm invocations.
+
+default_interval = 5
+default_failure_threshold = 3
+default_duration = 55
+
+# Seconds between lookups of the protected instances, so replaced or reset
+# NSGs are picked up
+refresh_interval = 60
+
+# Most instance IDs describe_instance_status takes in one call
+max_status_ids = 100
+
+detectors = {}
+
+# Whether an instance status (None if EC2 returned none) passes. Booting
+# instances and checks still initializing count as passing.
+def is_healthy(status):
+    if status is None:
+        return False
+    if status['InstanceState']['Name'] not in ('pending', 'running'):
+        return False
+    for check in ('InstanceStatus', 'SystemStatus'):
+        if (status.get(check, {}).get('Status') == 'impaired'):
+            return False
+    return True
+
+
+def is_live(topology, instance_name):
+    instance = topology.instances.get(instance_name)
+    return instance is not None and instance['State']['Name'] not in gone_states
+
+
+# Whether a site's traffic has moved off its old NSG in the site's region:
+# its new NSG is up, or a swap moved its Elastic IP to the uplink on its peer
+def failed_over(topology, site):
+    if is_live(topology, site['nsg_name']):
+        return True
+    if not site['peer_name'] or not is_live(topology, site['peer_name']):
+        return False
+    uplink = topology.interfaces.get(site['uplink_name'])
+    address = topology.addresses.get(site['elastic_ip'])
+    return uplink is not None and address is not None and \
+           address.get('NetworkInterfaceId') == uplink['NetworkInterfaceId'] and \
+           uplink.get('Attachment', {}).get('InstanceId') == topology.instance_id(site['peer_name'])
+
+
+class HealthDetector(object):
+
+    def __init__(self, sites, failure_threshold = default_failure_threshold):
+        self.sites = sites
+        self.failure_threshold = failure_threshold
+        self.failures = dict((site['name'], 0) for site in sites)
+        self.instance_ids = {}
+        self.resolved = None
+
+    # Look up the instance ID of every site's NSG. Sites whose traffic has
+    # moved off the old NSG (see failed_over) are not watched. Sites of a
+    # region that cannot be looked up keep the instance they had, and the
+    # lookup is tried again on the next tick.
+    def resolve(self):
+        instance_ids = {}
+        complete = True
+        for region in sorted(set(site['region'] for site in self.sites)):
+            region_sites = [site for site in self.sites if site['region'] == region]
+            swap_sites = [site for site in region_sites if site['peer_name']]
+            try:
+                topology = Topology(region,
+                    instance_names = [site[key] for site in region_sites
+                                      for key in ('old_nsg_name', 'nsg_name', 'peer_name') if site[key]],
+                    interface_names = [site['uplink_name'] for site in swap_sites],
+                    elastic_ips = [site['elastic_ip'] for site in swap_sites])
+            except SystemExit: # exit_with_error
+                print "Unable to look up sites in " + region + ", skipped"
+                complete = False
+                instance_ids.update((site['name'], self.instance_ids[site['name']]) for site in region_sites
+                                    if site['name'] in self.instance_ids)
+                continue
+            for site in region_sites:
+                if failed_over(topology, site):
+                    continue
+                old_nsg = topology.instances.get(site['old_nsg_name'])
+                instance_ids[site['name']] = old_nsg['InstanceId'] if old_nsg is not None else None
+
+        dr_sites = [site for site in self.sites if site['dr_region'] and site['name'] in instance_ids]
+        for dr_region in sorted(set(site['dr_region'] for site in dr_sites)):
+            region_sites = [site for site in dr_sites if site['dr_region'] == dr_region]
+            try:
+                topology = Topology(dr_region, instance_names = [site['nsg_name'] for site in region_sites])
+            except SystemExit: # exit_with_error
+                print "Unable to look up sites in " + dr_region + ", skipped"
+                complete = False
+                continue
+            for site in region_sites:
+                if is_live(topology, site['nsg_name']):
+                    del instance_ids[site['name']]
+
+        for name in self.failures:
+            if instance_ids.get(name) != self.instance_ids.get(name):
+                self.failures[name] = 0
+        self.instance_ids = instance_ids
+        self.resolved = time.time() if complete else None
+
+    # Status of every watched instance, one call per region and 100
+    # instances, and the regions whose status could not be described
+    def statuses(self):
+        statuses = {}
+        skipped = set()
+        for region in sorted(set(site['region'] for site in self.sites)):
+            instance_ids = sorted(set(self.instance_ids[site['name']] for site in self.sites
+                                      if site['region'] == region and self.instance_ids.get(site['name'])))
+            ec2 = get_client('ec2', region)
+            try:
+                paginator = ec2.get_paginator('describe_instance_status')
+                for i in range(0, len(instance_ids), max_status_ids):
+                    pages = paginator.paginate(InstanceIds = instance_ids[i:i + max_status_ids],
+                                               IncludeAllInstances = True)
+                    for page in pages:
+                        for status in page['InstanceStatuses']:
+                            statuses[status['InstanceId']] = status
+            except Exception as e:
+                print "Unable to describe instance status in " + region + ", skipped. Exception: " + str(e)
+                skipped.add(region)
+        return statuses, skipped
+
+    # Check every watched site once; returns (site, instance ID, instance
+    # state) of the sites that just reached the failure threshold. The ID is
+    # None if the site's NSG was not found, and the state None if EC2
+    # returned no status for it. Sites of a region whose status could not be
+    # described are left as they are until the next tick.
+    def check(self):
+        if self.resolved is None or time.time() - self.resolved > refresh_interval:
+            self.resolve()
+
+        statuses, skipped = self.statuses()
+        failed = []
+        for site in self.sites:
+            if site['name'] not in self.instance_ids or site['region'] in skipped:
+                continue
+            instance_id = self.instance_ids[site['name']]
+            status = statuses.get(instance_id)
+            if is_healthy(status):
+                self.failures[site['name']] = 0
+                continue
+
+            self.failures[site['name']] += 1
+            print "Site " + site['name'] + " failed health check " + str(self.failures[site['name']]) + \
+                  " of " + str(self.failure_threshold)
+            if (self.failures[site['name']] >= self.failure_threshold):
+                state = status['InstanceState']['Name'] if status is not None else None
+                failed.append((site, instance_id, state))
+                del self.instance_ids[site['name']]
+        return failed
+
+
+# State-change event of an NSG, as the EC2 state-change rule sends it. An
+# instance EC2 returned no status for is gone.
+def state_event(site, instance_id, state):
+    return {
+        'source': 'aws.ec2',
+        'detail-type': 'EC2 Instance State-change Notification',
+        'region': site['region'],
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'detail': {'instance-id': instance_id, 'state': state or 'terminated'},
+    }
+
+
+# Fail sites over, given (site, instance ID, instance state) triples. Each
+# NSG gets a state-change event of its own, and the events are handled in
+# one pass by the batch consumer, so a state-change event for the same
+# outage is handled as a duplicate of it (see idempotency). Sites whose NSG
+# was not found have no instance to key an incident on and fail over
+# through the failover handler. A failed failover is logged and left for the
+# next invocation, which watches the site again.
+def fail_over(failed, context):
+    found = [(site, instance_id, state) for site, instance_id, state in failed if instance_id is not None]
+    missing = [site for site, instance_id, state in failed if instance_id is None]
+    results = []
+    recorder = failover_metrics.recorder # The failover records its own metrics
+    try:
+        if found:
+            records = [{'messageId': instance_id, 'body': json.dumps(state_event(site, instance_id, state))}
+                       for site, instance_id, state in found]
+            event = {'sites': [site for site, instance_id, state in found], 'Records': records}
+            response = batch_consumer.handle_batch(event, context)
+            results.extend(response.get('sites', []))
+        if missing:
+            response = nsg_resiliency.lambda_handler({'sites': missing}, context)
+            results.extend(response['sites'])
+    except SystemExit: # exit_with_error
+        print "Failover of " + ", ".join(site['name'] for site, instance_id, state in failed) + " did not complete"
+        return None
+    finally:
+        failover_metrics.recorder = recorder
+
+    incomplete = [result['site'] for result in results if result['status'] != 'succeeded']
+    if incomplete:
+        print "Failover of " + ", ".join(incomplete) + " did not complete"
+    return {'sites': results}
+
+
+# Lambda callback
+def lambda_handler(event, context):
+    sites = load_sites(event, nsg_resiliency.default_site)
+    interval = event.get('interval', default_interval)
+    duration = event.get('duration', default_duration)
+    max_ticks = event.get('max_ticks')
+    failure_threshold = event.get('failure_threshold', default_failure_threshold)
+
+    key = (tuple(sorted(site['name'] for site in sites)), failure_threshold)
+    detector = detectors.get(key)
+    if detector is None:
+        detector = detectors[key] = HealthDetector(sites, failure_threshold)
+
+    started = time.time()
+    ticks = 0
+    failed_over = []
+    failover_metrics.start_recording('health_detector')
+    try:
+        while max_ticks is None or ticks < max_ticks:
+            tick_started = time.time()
+            with failover_metrics.span('health_check'):
+                failed = detector.check()
+            ticks += 1
+            if failed:
+                fail_over(failed, context)
+                failed_over.extend(site['name'] for site, instance_id, state in failed)
+
+            if (time.time() + interval - started > duration):
+                break
+            if context is not None and context.get_remaining_time_in_millis() < interval * 1000:
+                break
+            time.sleep(max(0, interval - (time.time() - tick_started)))
+    finally:
+        failover_metrics.emit_metrics()
+        nsg_resiliency.wait_for_standby_refills(context)
+
+    return {'ticks': ticks, 'failed_over': failed_over}
+
+
+# Lambda INIT phase: get the client ready for the checks and the failover
+prewarm(__name__, nsg_resiliency.default_site['region'],
+        nsg_resiliency.failover_operations, import_started = import_started)
@@ -0,0 +1,223 @@
+
+import calendar
+import errno
+import json
+import os
+import time
+
+from ec2_pool import get_client
+from errors import exit_with_error
+
+# Idempotent event processing. The state-change rule matches both
+# shutting-down and stopping, so one outage can invoke the handler several
+# times. The first invocation for an incident, keyed on the instance ID and a
+# time window, takes a lock record in a store and does the work; duplicates
+# find the record and either return at once or wait for its result.
+#
+# Records live in a DynamoDB table (conditional writes) when IDEMPOTENCY_TABLE
+# is set, and otherwise in files under IDEMPOTENCY_DIR, which is only shared
+# by invocations on the same host and meant for local testing. Set
+# IDEMPOTENCY_WAIT to make duplicates wait for the first run's result.
+#
+# Record: {'key', 'owner', 'status', 'expires', 'result'} where status is
+# 'in_progress', 'succeeded' or 'failed'. A failed or expired record can be
+# taken over, so a crashed or failed run does not block a retry.
+
+default_window = 900
+default_lease = 900
+default_directory = '/tmp/nsg-resiliency-incidents'
+poll_interval = 0.5
+
+# Key of the incident an EC2 state-change event belongs to, or None for
+# events that are not state changes (manual or test invocations)
+# NOTE: Windows are fixed, so events either side of a window boundary are
+#       two incidents
+def incident_key(event, window = default_window):
+    detail = event.get('detail') or {}
+    instance_id = detail.get('instance-id')
+    if instance_id is None:
+        return None
+    if 'time' in event:
+        seconds = calendar.timegm(time.strptime(event['time'], '%Y-%m-%dT%H:%M:%SZ'))
+    else:
+        seconds = time.time()
+    return instance_id + '/' + str(int(seconds // window))
+
+
+# Lock records kept as one JSON file per key in a directory
+class FileStore(object):
+
+    def __init__(self, directory = default_directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key.replace('/', '_') + '.json')
+
+    def get(self, key):
+        try:
+            with open(self.path(key)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def write(self, record):
+        temporary = self.path(record['key']) + '.' + record['owner']
+        with open(temporary, 'w') as f:
+            json.dump(record, f)
+        os.rename(temporary, self.path(record['key']))
+
+    # Create the record unless a live one exists; True if this owner got it
+    def acquire(self, key, owner, lease):
+        record = self.get(key)
+        if record is not None and record['status'] != 'failed' and record['expires'] > time.time():
+            return False
+        if record is not None:
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+        try:
+            fd = os.open(self.path(key), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'key': key, 'owner': owner, 'status': 'in_progress',
+                       'expires': time.time() + lease, 'result': None}, f)
+        return True
+
+    def complete(self, key, owner, status, result):
+        record = self.get(key)
+        if record is None or record['owner'] != owner:
+            return
+        self.write(dict(record, status = status, result = result))
+
+
+# Lock records kept in a DynamoDB table with a string hash key 'key'
+class TableStore(object):
+
+    def __init__(self, table_name, region_name):
+        self.table_name = table_name
+        self.region_name = region_name
+
+    def get(self, key):
+        dynamodb = get_client('dynamodb', self.region_name)
+        try:
+            item = dynamodb.get_item(
+                TableName = self.table_name,
+                Key = {'key': {'S': key}},
+                ConsistentRead = True
+            ).get('Item')
+        except Exception as e:
+            error = "Unable to read incident " + key + ". Exception: " + str(e)
+            exit_with_error(error)
+        if item is None:
+            return None
+        return {
+            'key': key,
+            'owner': item['owner']['S'],
+            'status': item['status']['S'],
+            'expires': float(item['expires']['N']),
+            'result': json.loads(item['result']['S']) if 'result' in item else None,
+        }
+
+    def acquire(self, key, owner, lease):
+        dynamodb = get_client('dynamodb', self.region_name)
+        now = time.time()
+        try:
+            dynamodb.put_item(
+                TableName = self.table_name,
+                Item = {
+                    'key': {'S': key},
+                    'owner': {'S': owner},
+                    'status': {'S': 'in_progress'},
+                    'expires': {'N': repr(now + lease)}
+                },
+                ConditionExpression = 'attribute_not_exists(#k) OR #s = :failed OR #e < :now',
+                ExpressionAttributeNames = {'#k': 'key', '#s': 'status', '#e': 'expires'},
+                ExpressionAttributeValues = {':failed': {'S': 'failed'}, ':now': {'N': repr(now)}}
+            )
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                return False
+            error = "Unable to lock incident " + key + ". Exception: " + str(e)
+            exit_with_error(error)
+        return True
+
+    def complete(self, key, owner, status, result):
+        dynamodb = get_client('dynamodb', self.region_name)
+        try:
+            dynamodb.update_item(
+                TableName = self.table_name,
+                Key = {'key': {'S': key}},
+                UpdateExpression = 'SET #s = :status, #r = :result',
+                ConditionExpression = '#o = :owner',
+                ExpressionAttributeNames = {'#s': 'status', '#r': 'result', '#o': 'owner'},
+                ExpressionAttributeValues = {
+                    ':status': {'S': status},
+                    ':result': {'S': json.dumps(result)},
+                    ':owner': {'S': owner}
+                }
+            )
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                return
+            error = "Unable to record incident " + key + ". Exception: " + str(e)
+            exit_with_error(error)
+
+
+# Store chosen by the environment
+def get_store(region_name):
+    table_name = os.environ.get('IDEMPOTENCY_TABLE')
+    if table_name:
+        return TableStore(table_name, region_name)
+    return FileStore(os.environ.get('IDEMPOTENCY_DIR', default_directory))
+
+
+# Wait for the run holding the incident to finish; returns its record
+def wait_for_record(store, key, timeout):
+    deadline = time.time() + timeout
+    while True:
+        record = store.get(key)
+        if record is None or record['status'] != 'in_progress' or time.time() > deadline:
+            return record
+        time.sleep(poll_interval)
+
+
+# Run action() once per incident of the event. Duplicates return a
+# {'duplicate_of', 'status', 'result'} dict instead of running it.
+def run_once(event, context, action, store, window = default_window, wait = None):
+    key = incident_key(event, window)
+    if key is None:
+        return action()
+
+    owner = getattr(context, 'aws_request_id', None)
+    if owner is None:
+        import uuid # Slow to import, and Lambda always gives a request ID
+        owner = str(uuid.uuid4())
+    lease = default_lease
+    if context is not None:
+        lease = context.get_remaining_time_in_millis() / 1000.0
+    if wait is None:
+        wait = bool(os.environ.get('IDEMPOTENCY_WAIT'))
+
+    if not store.acquire(key, owner, lease):
+        record = store.get(key)
+        if wait and record is not None:
+            record = wait_for_record(store, key, lease)
+        record = record or {'owner': None, 'status': 'unknown', 'result': None}
+        msg = "Incident " + key + " already handled by " + str(record['owner']) + " ... [ " + record['status'].upper() + " ]"
+        print msg
+        return {'duplicate_of': record['owner'], 'status': record['status'], 'result': record['result']}
+
+    try:
+        result = action()
+    except BaseException: # exit_with_error raises SystemExit
+        store.complete(key, owner, 'failed', None)
+        raise
+    store.complete(key, owner, 'succeeded', result)
+    return result
@@ -0,0 +1,248 @@
+
+import json
+import os
+import threading
+import time
+
+from ec2_pool import get_client
+from ec2_topology import Topology, get_name_tag, gone_states, instance_states
+from errors import exit_with_error
+
+# Inventory index of a region's instances, interfaces and Elastic IPs, so the
+# failover hot path finds its topology without describe calls. The index is
+# built from unfiltered, paginated describes and kept on disk (INVENTORY_DIR,
+# one JSON file per region), so it survives warm invocations and is loaded,
+# not rebuilt, by the next one. It is indexed by Name tag, ID and public IP.
+#
+# It is kept current incrementally:
+#   - EC2 state-change events (the ones the failover handler is invoked with)
+#     update the state of the instance they name
+#   - names the handlers change (failed over or reset sites) are marked
+#     stale, and names the index does not know are misses; both are confirmed
+#     with one targeted describe per resource type on their next lookup
+#   - the whole index is rebuilt once it is older than INVENTORY_MAX_AGE
+#     seconds, to pick up changes made outside the handlers
+#
+# The index is only trusted for IDs: interfaces and Elastic IPs are described
+# again right before they are detached, disassociated or have IPs moved (see
+# ec2_topology.Topology.indexed).
+#
+# Enabled with INVENTORY=1; otherwise get_topology() describes every time.
+# NOTE: The index is per container, a new container builds it once
+
+default_directory = '/tmp/nsg-resiliency-inventory'
+default_max_age = 3600
+
+# Most results per describe page
+page_size = 1000
+
+lock = threading.RLock()
+inventories = {}
+
+def enabled():
+    return os.environ.get('INVENTORY', '0') != '0'
+
+
+class Inventory(object):
+
+    def __init__(self, region_name, path = None):
+        self.region_name = region_name
+        self.path = path
+        self.built = None
+        self.instances = {}
+        self.interfaces = {}
+        self.addresses = {}
+        # Names confirmed absent, and names to confirm before use
+        self.absent = {'instance': set(), 'interface': set(), 'address': set()}
+        self.stale = {'instance': set(), 'interface': set(), 'address': set()}
+        self.reindex()
+
+    # Derived indexes, rebuilt from the descriptions
+    def reindex(self):
+        self.instance_names = {}
+        for instance in self.instances.values():
+            name = get_name_tag(instance)
+            current = self.instance_names.get(name)
+            if current is None or (self.instances[current]['State']['Name'] in gone_states and
+                                   instance['State']['Name'] not in gone_states):
+                self.instance_names[name] = instance['InstanceId']
+        self.interface_names = {}
+        for interface_id, interface in sorted(self.interfaces.items()):
+            self.interface_names.setdefault(get_name_tag(interface), interface_id)
+        self.public_ips = dict((a['PublicIp'], allocation_id) for allocation_id, a in self.addresses.items())
+
+    # Describe everything, a page at a time
+    def build(self):
+        ec2 = get_client('ec2', self.region_name)
+        instances = {}
+        interfaces = {}
+        addresses = {}
+        try:
+            for page in ec2.get_paginator('describe_instances').paginate(PaginationConfig = {'PageSize': page_size}):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        instances[instance['InstanceId']] = instance
+            paginator = ec2.get_paginator('describe_network_interfaces')
+            for page in paginator.paginate(PaginationConfig = {'PageSize': page_size}):
+                for interface in page['NetworkInterfaces']:
+                    interfaces[interface['NetworkInterfaceId']] = interface
+            for address in ec2.describe_addresses()['Addresses']:
+                addresses[address['AllocationId']] = address
+        except Exception as e:
+            error = "Unable to build the inventory of " + self.region_name + ". Exception: " + str(e)
+            exit_with_error(error)
+
+        with lock:
+            self.instances, self.interfaces, self.addresses = instances, interfaces, addresses
+            for kind in self.stale:
+                self.stale[kind].clear()
+                self.absent[kind].clear()
+            self.built = time.time()
+            self.reindex()
+        print "Inventory of " + self.region_name + ": " + str(len(instances)) + " instances, " + \
+              str(len(interfaces)) + " interfaces, " + str(len(addresses)) + " Elastic IPs ... [ SUCCESS ]"
+
+    # Apply an EC2 state-change event; True if the index changed. Events
+    # without an instance state EC2 reports are ignored.
+    def apply_event(self, event):
+        detail = event.get('detail') or {}
+        state = detail.get('state')
+        if state not in instance_states or not detail.get('instance-id'):
+            return False
+        with lock:
+            instance = self.instances.get(detail['instance-id'])
+            if instance is None or instance['State']['Name'] == state:
+                return False
+            instance['State'] = dict(instance['State'], Name = state)
+            self.reindex()
+        return True
+
+    # Mark names as changed, so they are confirmed before their next use
+    def invalidate(self, instance_names = (), interface_names = (), elastic_ips = ()):
+        with lock:
+            for kind, names in (('instance', instance_names), ('interface', interface_names),
+                                ('address', elastic_ips)):
+                self.stale[kind].update(names)
+                self.absent[kind].difference_update(names)
+
+    # Names that have to be described: stale ones, and misses
+    def unconfirmed(self, kind, names, index):
+        return sorted(set(n for n in names if n in self.stale[kind] or
+                          (n not in index and n not in self.absent[kind])))
+
+    # Topology of the named resources, describing only stale names and misses.
+    # Returns (topology, True if the index changed).
+    def topology(self, instance_names = (), interface_names = (), elastic_ips = ()):
+        with lock:
+            missing = (self.unconfirmed('instance', instance_names, self.instance_names),
+                       self.unconfirmed('interface', interface_names, self.interface_names),
+                       self.unconfirmed('address', elastic_ips, self.public_ips))
+        changed = any(missing)
+        if changed:
+            confirmed = Topology(self.region_name, *missing)
+            with lock:
+                for instance in confirmed.instances.values():
+                    self.instances[instance['InstanceId']] = instance
+                for interface in confirmed.interfaces.values():
+                    self.interfaces[interface['NetworkInterfaceId']] = interface
+                for address in confirmed.addresses.values():
+                    self.addresses[address['AllocationId']] = address
+                for kind, names, found in (('instance', missing[0], confirmed.instances),
+                                           ('interface', missing[1], confirmed.interfaces),
+                                           ('address', missing[2], confirmed.addresses)):
+                    self.stale[kind].difference_update(names)
+                    self.absent[kind].update(n for n in names if n not in found)
+                self.reindex()
+
+        topology = Topology(self.region_name)
+        topology.indexed = True
+        with lock:
+            for name in instance_names:
+                if name in self.instance_names:
+                    topology.instances[name] = self.instances[self.instance_names[name]]
+            for name in interface_names:
+                if name in self.interface_names:
+                    topology.interfaces[name] = self.interfaces[self.interface_names[name]]
+            for public_ip in elastic_ips:
+                if public_ip in self.public_ips:
+                    topology.addresses[public_ip] = self.addresses[self.public_ips[public_ip]]
+        return topology, changed
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return False
+        self.built = saved['built']
+        self.instances = saved['instances']
+        self.interfaces = saved['interfaces']
+        self.addresses = saved['addresses']
+        for kind in self.stale:
+            self.stale[kind] = set(saved['stale'][kind])
+            self.absent[kind] = set(saved['absent'][kind])
+        self.reindex()
+        return True
+
+    def save(self):
+        with lock:
+            saved = {
+                'built': self.built,
+                'instances': self.instances,
+                'interfaces': self.interfaces,
+                'addresses': self.addresses,
+                'stale': dict((kind, sorted(names)) for kind, names in self.stale.items()),
+                'absent': dict((kind, sorted(names)) for kind, names in self.absent.items()),
+            }
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(saved, f, default = str) # Launch and attach times
+            os.rename(temporary, self.path)
+
+
+# The inventory of a region: kept in memory by a warm container, loaded from
+# disk otherwise, and built if there is none or it is too old
+def get_inventory(region_name):
+    max_age = float(os.environ.get('INVENTORY_MAX_AGE', default_max_age))
+    with lock:
+        inventory = inventories.get(region_name)
+        if inventory is None:
+            directory = os.environ.get('INVENTORY_DIR', default_directory)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            inventory = Inventory(region_name, os.path.join(directory, region_name + '.json'))
+            inventory.load()
+            inventories[region_name] = inventory
+    if inventory.built is None or time.time() - inventory.built > max_age:
+        inventory.build()
+        inventory.save()
+    return inventory
+
+
+# Topology of the named resources, from the inventory if it is enabled
+def get_topology(region_name, instance_names = (), interface_names = (), elastic_ips = ()):
+    if not enabled():
+        return Topology(region_name, instance_names, interface_names, elastic_ips)
+    inventory = get_inventory(region_name)
+    topology, changed = inventory.topology(instance_names, interface_names, elastic_ips)
+    if changed:
+        inventory.save()
+    return topology
+
+
+# Apply state-change events to the region's inventory, if it is enabled
+def apply_events(region_name, events):
+    if not enabled():
+        return
+    inventory = get_inventory(region_name)
+    changed = [inventory.apply_event(event) for event in events]
+    if any(changed):
+        inventory.save()
+
+
+# Mark names changed by a handler as stale, if the inventory is enabled
+def invalidate(region_name, instance_names = (), interface_names = (), elastic_ips = ()):
+    if enabled():
+        inventory = get_inventory(region_name)
+        inventory.invalidate(instance_names, interface_names, elastic_ips)
+        inventory.save()
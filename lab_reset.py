@@ -1,291 +1,166 @@
 
-import boto3
-import time
-import pprint
 import os
+import time
+import_started = time.time()
 
-region = 'us-east-1'
-instance_type = 'c4.xlarge'
-security_group_id = 'sg-0509dc08db7a2036a'
-
-
-def exit_with_error(error):
-    print "ERROR: " + error
-    exit (1)
-
-# Get Instance ID from a given Instance Name
-# NOTE: Returns the first instance ID in case of multiple instances with
-#       the same name
-def get_instance_id(instance_name):
-    ec2 = boto3.client('ec2')
-    response = ec2.describe_instances(
-        Filters = [
-            {
-                'Name': 'tag:Name',
-                'Values': [instance_name]
-            }
-        ]
-    )
-    try:
-        instance_id = response['Reservations'][0]['Instances'][0]['InstanceId']
-    except Exception as e:
-        error = "Unable to get instance " + instance_name + " ID. Exception: " + str(e)
-        exit_with_error(error)
-
-    return instance_id
-
-
-# Get Interface ID from a given Interface Name
-# NOTE: Returns the first interface ID in case of multiple interfaces with
-#       the same name
-def get_interface_id(interface_name):
-    ec2 = boto3.client('ec2')
-    response = ec2.describe_network_interfaces(
-        Filters = [
-            {
-                'Name': 'tag:Name',
-                'Values': [interface_name]
-            }
-        ]
-    )
-    try:
-        interface_id = response['NetworkInterfaces'][0]['NetworkInterfaceId']
-    except Exception as e:
-        error = "Unable to get interface " + interface_name + " ID. Exception: " + str(e)
-        exit_with_error(error)
+from cold_start import prewarm
+from ec2_pool import get_client
+from ec2_topology import filter_chunks, get_name_tag
+from errors import exit_with_error
+from failover_metrics import emit_metrics, start_recording
+from step_graph import report_steps, run_steps
 
-    return interface_id
-
-
-# Get Interface Private IP from a given Interface Name
-# NOTE: Returns the first Private IP
-def get_private_ip(interface_name):
-    ec2 = boto3.client('ec2')
-    response = ec2.describe_network_interfaces(
-        Filters = [
-            {
-                'Name': 'tag:Name',
-                'Values': [interface_name]
-            }
-        ]
-    )
-    try:
-        private_ip = response['NetworkInterfaces'][0]['PrivateIpAddress']
-    except Exception as e:
-        error = "Unable to get interface " + interface_name + " private IP. Exception: " + str(e)
-        exit_with_error(error)
+import reconciler
 
-    return private_ip
+region = 'us-east-1'
 
 
-# Get association ID of an Elastic IP
-def get_association_id(elastic_ip):
-    ec2 = boto3.client('ec2')
+# Get the live instances selected by name and/or tags, e.g.
+#   get_instances(['nsg-A', 'nsg-B'])
+#   get_instances(tags = {'Classroom': 'cr-12'})
+# with one paginated describe per 200 names.
+# NOTE: Every live instance with a given name is selected, and terminated
+#       instances are left out
+def get_instances(instance_names = None, tags = None):
+    if not instance_names and not tags:
+        exit_with_error("No instance names or tags given")
+
+    filters = [
+        {
+            'Name': 'instance-state-name',
+            'Values': ['pending', 'running', 'stopping', 'stopped']
+        }
+    ]
+    for key, value in sorted((tags or {}).items()):
+        filters.append({'Name': 'tag:' + key, 'Values': value if isinstance(value, list) else [value]})
+
+    name_chunks = [None]
+    if instance_names:
+        name_chunks = filter_chunks(instance_names)
+
+    ec2 = get_client('ec2', region)
+    instances = []
     try:
-        response = ec2.describe_addresses(
-            Filters = [
-                {
-                    'Name': 'public-ip',
-                    'Values': [elastic_ip]
-                }
-            ]
-        )
-        association_id = response['Addresses'][0]['AssociationId']
+        paginator = ec2.get_paginator('describe_instances')
+        for names in name_chunks:
+            name_filter = [{'Name': 'tag:Name', 'Values': names}] if names else []
+            for page in paginator.paginate(Filters = filters + name_filter):
+                for reservation in page['Reservations']:
+                    instances.extend(reservation['Instances'])
     except Exception as e:
-        error = "Unable to get association ID for Elastic IP: " + elastic_ip + ". Exception: " + str(e)
+        error = "Unable to describe instances. Exception: " + str(e)
         exit_with_error(error)
 
-    return association_id
-
-
-# Get allocation ID of an Elastic IP
-def get_allocation_id(elastic_ip):
-    ec2 = boto3.client('ec2')
-    try:
-        response = ec2.describe_addresses(
-            Filters = [
-                {
-                    'Name': 'public-ip',
-                    'Values': [elastic_ip]
-                }
-            ]
-        )
-        allocation_id = response['Addresses'][0]['AllocationId']
-    except Exception as e:
-        error = "Unable to get allocation ID for Elastic IP: " + elastic_ip + ". Exception: " + str(e)
-        exit_with_error(error)
+    if instance_names:
+        found = set(get_name_tag(i) for i in instances)
+        missing = [name for name in instance_names if name not in found]
+        if missing:
+            exit_with_error("Unable to get instance " + ", ".join(missing) + " ID. Instance not found")
 
-    return allocation_id
+    return instances
 
 
-# Power OFF instance
-def power_off_instance(instance_name):
-    instance_id = get_instance_id(instance_name)
-    instance = ""
-    state = ""
-    try:
-        ec2 = boto3.resource('ec2')
-        instance = ec2.Instance(instance_id)
-        state = instance.state['Name']
-    except Exception as e:
-        error = "Exception while fetching instance state: " + str(e)
-        exit_with_error(error)
+# Power OFF every instance selected by name and/or tags
+def power_off_instances(instance_names = None, tags = None, wait = True):
+    reconciler.power_off_instances(region, get_instances(instance_names, tags), wait)
 
-    if (state != 'stopped'):
-        try:
-            ec2 = boto3.client('ec2', region_name = region)
-            ec2.stop_instances(InstanceIds=[instance_id])
-        except Exception as e:
-            error = "Cannot stop instance " + instance_name + ". Exception: " + str(e)
-            exit_with_error(error)
-
-    msg = "Instance " + instance_name + " Power OFF ...[ SUCCESS ]"
-    print msg
-    return
-
-
-# Detach an interface. Doesnt matter which Instance its associated with.
-# NOTE: Assumes its a secondary interface
-def detach_interface(interface_name):
-    interface_id = get_interface_id(interface_name)
-    ec2 = boto3.resource('ec2')
-    try:
-        access_interface = ec2.NetworkInterface(interface_id)
-    except Exception as e:
-        error = "Unable to get interface " + interface_name + " with ID " + interface_id + " resource. Exception " + str(e)
-        exit_with_error(error)
 
-    try:
-        if (access_interface.status == "in-use"):
-            access_interface.detach(False, True) # Dryrun, Force
-    except Exception as e:
-        error = "Unable to detach interface " + interface_name + " with ID " + interface_id + ". Exception: " + str(e)
-        exit_with_error(error)
+# Power ON every instance selected by name and/or tags
+def power_on_instances(instance_names = None, tags = None, wait = True):
+    reconciler.power_on_instances(region, get_instances(instance_names, tags), wait)
 
-    if (access_interface.status == "in-use"):
-        time.sleep(5)
 
-    msg = " Detach Network Interface : " + interface_name + " ... [ SUCCESS ]"
-    print msg
-    return
+# Terminate every instance selected by name and/or tags
+def terminate_instances(instance_names = None, tags = None, wait = False):
+    reconciler.terminate_instances(region, get_instances(instance_names, tags), wait)
 
 
-# Disassociate an Elastic IP from an instance/interface
-def disassociate_elastic_ip(elastic_ip):
-    association_id = get_association_id(elastic_ip)
+# Fleet operations of the handler
+fleet_operations = {
+    'power_off': power_off_instances,
+    'power_on': power_on_instances,
+    'terminate': terminate_instances,
+}
 
-    ec2 = boto3.client('ec2')
-    try:
-        response = ec2.disassociate_address(AssociationId=association_id)
-    except Exception as e:
-        error = "Unable to disassociate elastic IP " + elastic_ip + ". Exception: " + str(e)
-        exit_with_error(error)
 
-    msg = "Disassociate Elastic IP " + elastic_ip + " ... [ SUCCESS ]"
-    print msg
-    return
+# Where the lab should be after a reset: the access interface and Elastic IP
+# back on nsg-B, nsg-B running and Resilient-NSG gone
+lab_target = {
+    'instances': {
+        'nsg-B': 'running',
+        'Resilient-NSG': 'terminated',
+    },
+    'attachments': {
+        'nsgb-access': ('nsg-B', 1),
+    },
+    'addresses': {
+        '18.235.97.139': 'nsgb-uplink-a',
+    },
+}
 
 
-# Associate an Elastic IP to an Instance/Interface
-def associate_elastic_ip(elastic_ip, interface_name):
-    allocation_id = get_allocation_id(elastic_ip)
-    interface_id = get_interface_id(interface_name)
-    private_ip = get_private_ip(interface_name)
+# Lambda callback
+# Send {"plan_only": true} to print the steps a reset would take and return
+# their names without changing anything.
+# Send {"fleet": "power_off" | "power_on" | "terminate"} with "instance_names"
+# and/or "tags" to change the state of many labs at once instead, e.g. to
+# power off a classroom:
+#   {"fleet": "power_off", "tags": {"Classroom": "cr-12"}}
+def lambda_handler(event, context):
+    if 'fleet' in event:
+        return handle_fleet(event)
 
-    ec2 = boto3.client('ec2')
+    start_recording('lab_reset')
     try:
-        response = ec2.associate_address(
-            AllocationId = allocation_id,
-            NetworkInterfaceId = interface_id,
-            PrivateIpAddress = private_ip
-        )
-    except Exception as e:
-        error = "Unable to associate elastic IP " + elastic_ip + " with interface " + interface_name + ". Exception: " + str(e)
-        exit_with_error(error)
-   
-    msg = "Associate Elastic IP " + elastic_ip + " to Interface " + interface_name + " ... [ SUCCESS ]"
-    print msg 
-    return
+        steps = reset_lab(plan_only = bool(event.get('plan_only')))
+    finally:
+        emit_metrics()
 
+    if event.get('plan_only'):
+        return [step.name for step in steps]
+    return "Success!"
 
-# Attach interface to an instance
-def attach_interface_to_instance(interface_name, instance_name):
-    interface_id = get_interface_id(interface_name)
-    instance_id = get_instance_id(instance_name)
 
-    ec2 = boto3.resource('ec2')
-    network_interface = ec2.NetworkInterface(interface_id)
+def handle_fleet(event):
+    operation = fleet_operations.get(event['fleet'])
+    if operation is None:
+        exit_with_error("Unknown fleet operation " + str(event['fleet']) + ", expected one of " +
+                        ", ".join(sorted(fleet_operations)))
+    start_recording('lab_reset')
     try:
-        response = network_interface.attach(
-            DeviceIndex = 1, # We know its not primary
-            DryRun = False,
-            InstanceId = instance_id
-        )
-    except Exception as e:
-        error = "Unable to attach interface " + interface_name + " to instance " + instance_name + ". Exception: " + str(e)
-        exit_with_error(error)
-
-    msg = "Attach Interface " + interface_name + " to Instance " + instance_name + " ... [ SUCCESS ]"
-    print msg
-    return
-
-
-# Power ON instance
-def power_on_instance(instance_name):
-    instance_id = get_instance_id(instance_name)
+        operation(event.get('instance_names'), event.get('tags'))
+    finally:
+        emit_metrics()
+    return "Success!"
 
-    try:
-        ec2 = boto3.resource('ec2')
-        instance = ec2.Instance(instance_id)
-        state = instance.state['Name']
-    except Exception as e:
-        error = "Exception while fetching instance state: " + str(e)
-        exit_with_error(error)
 
-    if (state != 'running'):
+# Reconcile the lab with lab_target. Only what has drifted is changed, so
+# resetting a lab that is already reset costs a single snapshot. nsg-B is
+# only started once it has its access interface back, and Resilient-NSG is
+# only terminated once the access interface is off it. The reset sites are
+# confirmed by the next failover if the inventory index is enabled.
+def reset_lab(plan_only = False):
+    topology = reconciler.snapshot(region, lab_target)
+    steps = reconciler.plan(topology, lab_target)
+    reconciler.print_plan(steps)
+    if not plan_only and steps:
         try:
-            ec2 = boto3.client('ec2', region_name = region)
-            ec2.start_instances(InstanceIds=[instance_id])
-        except Exception as e:
-            error = "Cannot start instance " + instance_name + ". Exception: " + str(e)
-            exit_with_error(error)    
-
-    msg = "Power ON of instance " + instance_name + " ... [ SUCCESS ]"
-    print msg
-    return
-
-
-# Terminate an instance
-def terminate_instance(instance_name):
-    instance_id = get_instance_id(instance_name)
-    try:
-        ec2 = boto3.resource('ec2')
-        instance = ec2.Instance(instance_id)
-        state = instance.state['Name']
-    except Exception as e:
-        error = "Exception while fetching instance state: " + str(e)
-        exit_with_error(error)
-
-    try:
-         ec2 = boto3.client('ec2', region_name = region)
-         ec2.terminate_instances(InstanceIds=[instance_id])
-    except Exception as e:
-        error = "Cannot mark instance " + instance_name + " with instance ID " + instance_id + " for termination. Exception: " + str(e)
-        exit_with_error(error)
-
-    msg = "Termination of instance " + instance_name + " ... [ SUCCESS ]"
-    print msg
-    return
-
-
-# Lambda callback
-def lambda_handler(event, context):
-    detach_interface('nsgb-access')
-    disassociate_elastic_ip('18.235.97.139')
-    associate_elastic_ip('18.235.97.139', 'nsgb-uplink-a')
-    attach_interface_to_instance('nsgb-access', 'nsg-B')
-    power_on_instance('nsg-B')
-    power_off_instance('Resilient-NSG')
-    terminate_instance('Resilient-NSG')
-    return "Success!"
-
+            report_steps(run_steps(steps))
+        finally:
+            if os.environ.get('INVENTORY', '0') != '0':
+                from inventory import invalidate # Only loaded if the index is enabled (see inventory.enabled)
+                invalidate(region, lab_target['instances'].keys(),
+                           lab_target['attachments'].keys() + lab_target['addresses'].values(),
+                           lab_target['addresses'].keys())
+    return steps
+
+
+# EC2 operations a reset makes
+reset_operations = [
+    'DescribeInstances', 'DescribeNetworkInterfaces', 'DescribeAddresses', 'DetachNetworkInterface',
+    'DisassociateAddress', 'AssociateAddress', 'AttachNetworkInterface', 'StartInstances',
+    'StopInstances', 'TerminateInstances',
+]
+
+# Lambda INIT phase: get the client ready before the first event
+prewarm(__name__, region, reset_operations, import_started = import_started)
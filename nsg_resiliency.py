@@ -1,139 +1,42 @@
 
-import boto3
 import time
-import pprint
-import os
-
-def exit_with_error(error):
-    print "ERROR: " + error
-    exit (1)
-
-# Get Instance ID from a given Instance Name
-# NOTE: Returns the first instance ID in case of multiple instances with
-#       the same name
-def get_instance_id(instance_name):
-    ec2 = boto3.client('ec2')
-    response = ec2.describe_instances(
-        Filters = [
-            {
-                'Name': 'tag:Name',
-                'Values': [instance_name]
-            }
-        ]
-    )
-    try:
-        instance_id = response['Reservations'][0]['Instances'][0]['InstanceId']
-    except Exception as e:
-        error = "Unable to get instance " + instance_name + " ID. Exception: " + str(e)
-        exit_with_error(error)
-
-    return instance_id
-
-
-# Get Interface ID from a given Interface Name
-# NOTE: Returns the first interface ID in case of multiple interfaces with
-#       the same name
-def get_interface_id(interface_name):
-    ec2 = boto3.client('ec2')
-    response = ec2.describe_network_interfaces(
-        Filters = [
-            {
-                'Name': 'tag:Name',
-                'Values': [interface_name]
-            }
-        ]
-    )
-    try:
-        interface_id = response['NetworkInterfaces'][0]['NetworkInterfaceId']
-    except Exception as e:
-        error = "Unable to get interface " + interface_name + " ID. Exception: " + str(e)
-        exit_with_error(error)
-
-    return interface_id
-
-
-# Get Interface Private IP from a given Interface Name
-# NOTE: Returns the first Private IP
-def get_private_ip(interface_name):
-    ec2 = boto3.client('ec2')
-    response = ec2.describe_network_interfaces(
-        Filters = [
-            {
-                'Name': 'tag:Name',
-                'Values': [interface_name]
-            }
-        ]
-    )
-    try:
-        private_ip = response['NetworkInterfaces'][0]['PrivateIpAddress']
-    except Exception as e:
-        error = "Unable to get interface " + interface_name + " private IP. Exception: " + str(e)
-        exit_with_error(error)
-
-    return private_ip
-
-
-# Get association ID of an Elastic IP
-def get_association_id(elastic_ip):
-    ec2 = boto3.client('ec2')
-    try:
-        response = ec2.describe_addresses(
-            Filters = [
-                {
-                    'Name': 'public-ip',
-                    'Values': [elastic_ip]
-                }
-            ]
-        )
-        association_id = response['Addresses'][0]['AssociationId']
-    except Exception as e:
-        error = "Unable to get association ID for Elastic IP: " + elastic_ip + ". Exception: " + str(e)
-        exit_with_error(error)
-
-    return association_id
-
-
-# Get allocation ID of an Elastic IP
-def get_allocation_id(elastic_ip):
-    ec2 = boto3.client('ec2')
-    try:
-        response = ec2.describe_addresses(
-            Filters = [
-                {
-                    'Name': 'public-ip',
-                    'Values': [elastic_ip]
-                }
-            ]
-        )
-        allocation_id = response['Addresses'][0]['AllocationId']
-    except Exception as e:
-        error = "Unable to get allocation ID for Elastic IP: " + elastic_ip + ". Exception: " + str(e)
-        exit_with_error(error)
-
-    return allocation_id
+import_started = time.time()
 
+import hashlib
+import os
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cold_start import prewarm, take_prefetched
+from call_deadlines import budget, reserve
+from ec2_pool import get_client
+from errors import exit_with_error
+from failover_metrics import emit_metrics, span, start_recording
+from idempotency import get_store, incident_key, run_once
+from ec2_topology import Topology, gone_states
+from ec2_waiters import wait_for_address_association, wait_for_instance_state
+from ec2_waiters import wait_for_interface_attachment, wait_for_interface_status
+from site_runner import load_sites, report_sites, run_sites
+from step_graph import Step, report_steps, run_steps
 
 # Power OFF instance
-def power_off_instance(instance_name, region_name):
-    instance_id = get_instance_id(instance_name)
-    instance = ""
-    state = ""
-    try:
-        ec2 = boto3.resource('ec2')
-        instance = ec2.Instance(instance_id)
-        state = instance.state['Name']
-    except Exception as e:
-        error = "Exception while fetching instance state: " + str(e)
-        exit_with_error(error)
+# NOTE: Waits until the instance is stopped unless wait is False
+def power_off_instance(topology, instance_name, wait = True):
+    instance_id = topology.instance_id(instance_name)
+    state = topology.instance_state(instance_name)
 
     if (state != 'stopped'):
+        ec2 = get_client('ec2', topology.region_name)
         try:
-            ec2 = boto3.client('ec2', region_name = region_name)
             ec2.stop_instances(InstanceIds=[instance_id])
         except Exception as e:
             error = "Cannot stop instance " + instance_name + ". Exception: " + str(e)
             exit_with_error(error)
 
+        if wait:
+            wait_for_instance_state(ec2, [instance_id], 'stopped')
+
     msg = "Instance " + instance_name + " Power OFF ...[ SUCCESS ]"
     print msg
     return
@@ -141,24 +44,25 @@ def power_off_instance(instance_name, region_name):
 
 # Detach an interface. Doesnt matter which Instance its associated with.
 # NOTE: Assumes its a secondary interface
-def detach_interface(interface_name):
-    interface_id = get_interface_id(interface_name)
-    ec2 = boto3.resource('ec2')
-    try:
-        access_interface = ec2.NetworkInterface(interface_id)
-    except Exception as e:
-        error = "Unable to get interface " + interface_name + " with ID " + interface_id + " resource. Exception " + str(e)
-        exit_with_error(error)
+def detach_interface(topology, interface_name):
+    topology.refresh_interface(interface_name)
+    interface_id = topology.interface_id(interface_name)
+    status = topology.interface_status(interface_name)
 
+    ec2 = get_client('ec2', topology.region_name)
     try:
-        if (access_interface.status == "in-use"):
-            access_interface.detach(False, True) # Dryrun, Force
+        if (status == "in-use"):
+            ec2.detach_network_interface(
+                AttachmentId = topology.attachment_id(interface_name),
+                DryRun = False,
+                Force = True
+            )
     except Exception as e:
         error = "Unable to detach interface " + interface_name + " with ID " + interface_id + ". Exception: " + str(e)
         exit_with_error(error)
 
-    if (access_interface.status == "in-use"):
-        time.sleep(5)
+    if status in ("in-use", "detaching"):
+        wait_for_interface_status(ec2, [interface_id], 'available')
 
     msg = " Detach Network Interface : " + interface_name + " ... [ SUCCESS ]"
     print msg
@@ -166,10 +70,11 @@ def detach_interface(interface_name):
 
 
 # Disassociate an Elastic IP from an instance/interface
-def disassociate_elastic_ip(elastic_ip):
-    association_id = get_association_id(elastic_ip)
+def disassociate_elastic_ip(topology, elastic_ip):
+    topology.refresh_address(elastic_ip)
+    association_id = topology.association_id(elastic_ip)
 
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2', topology.region_name)
     try:
         response = ec2.disassociate_address(AssociationId=association_id)
     except Exception as e:
@@ -182,21 +87,30 @@ def disassociate_elastic_ip(elastic_ip):
 
 
 # Associate an Elastic IP to an Instance/Interface
-def associate_elastic_ip(elastic_ip, interface_name):
-    allocation_id = get_allocation_id(elastic_ip)
-    interface_id = get_interface_id(interface_name)
-    private_ip = get_private_ip(interface_name)
-
-    ec2 = boto3.client('ec2')
+# NOTE: With allow_reassociation, an Elastic IP still associated elsewhere is
+#       moved in the same call, without disassociating it first
+def associate_elastic_ip(topology, elastic_ip, interface_name, allow_reassociation = False):
+    allocation_id = topology.allocation_id(elastic_ip)
+    interface_id = topology.interface_id(interface_name)
+    private_ip = topology.private_ip(interface_name)
+
+    options = {}
+    if allow_reassociation:
+        options['AllowReassociation'] = True
+
+    ec2 = get_client('ec2', topology.region_name)
     try:
         response = ec2.associate_address(
             AllocationId = allocation_id,
             NetworkInterfaceId = interface_id,
-            PrivateIpAddress = private_ip
+            PrivateIpAddress = private_ip,
+            **options
         )
     except Exception as e:
         error = "Unable to associate elastic IP " + elastic_ip + " with interface " + interface_name + ". Exception: " + str(e)
         exit_with_error(error)
+
+    wait_for_address_association(ec2, allocation_id, interface_id)
    
     msg = "Associate Elastic IP " + elastic_ip + " to Interface " + interface_name + " ... [ SUCCESS ]"
     print msg 
@@ -204,68 +118,106 @@ def associate_elastic_ip(elastic_ip, interface_name):
 
 
 # Attach interface to an instance
-def attach_interface_to_instance(interface_name, instance_name):
-    interface_id = get_interface_id(interface_name)
-    instance_id = get_instance_id(instance_name)
+def attach_interface_to_instance(topology, interface_name, instance_name, device_index = 1):
+    interface_id = topology.interface_id(interface_name)
+    instance_id = topology.instance_id(instance_name)
 
-    ec2 = boto3.resource('ec2')
-    network_interface = ec2.NetworkInterface(interface_id)
+    ec2 = get_client('ec2', topology.region_name)
     try:
-        response = network_interface.attach(
-            DeviceIndex = 1, # We know its not primary
+        response = ec2.attach_network_interface(
+            DeviceIndex = device_index, # We know its not primary
             DryRun = False,
-            InstanceId = instance_id
+            InstanceId = instance_id,
+            NetworkInterfaceId = interface_id
         )
     except Exception as e:
         error = "Unable to attach interface " + interface_name + " to instance " + instance_name + ". Exception: " + str(e)
         exit_with_error(error)
 
+    wait_for_interface_attachment(ec2, [interface_id], 'attached')
+
     msg = "Attach Interface " + interface_name + " to Instance " + instance_name + " ... [ SUCCESS ]"
     print msg
     return
 
 
-# Power ON instance
-def power_on_instance(instance_name, region_name):
-    instance_id = get_instance_id(instance_name)
+# Move the secondary private IPs of an interface to another interface, in
+# one call and without detaching anything
+def float_private_ips(topology, interface_name, target_interface_name):
+    topology.refresh_interface(interface_name)
+    interface = topology.interface(interface_name)
+    private_ips = [ip['PrivateIpAddress'] for ip in interface.get('PrivateIpAddresses', []) if not ip.get('Primary')]
+    if not private_ips:
+        exit_with_error("Interface " + interface_name + " has no secondary private IPs to move")
+    target_interface_id = topology.interface_id(target_interface_name)
 
+    ec2 = get_client('ec2', topology.region_name)
     try:
-        ec2 = boto3.resource('ec2')
-        instance = ec2.Instance(instance_id)
-        state = instance.state['Name']
+        ec2.assign_private_ip_addresses(
+            NetworkInterfaceId = target_interface_id,
+            PrivateIpAddresses = private_ips,
+            AllowReassignment = True
+        )
     except Exception as e:
-        error = "Exception while fetching instance state: " + str(e)
+        error = "Unable to move private IPs of " + interface_name + " to " + target_interface_name + ". Exception: " + str(e)
         exit_with_error(error)
 
+    msg = "Move private IPs " + ", ".join(private_ips) + " to Interface " + target_interface_name + " ... [ SUCCESS ]"
+    print msg
+    return
+
+
+# Power ON instance
+# NOTE: Waits until the instance is running unless wait is False
+def power_on_instance(topology, instance_name, wait = True):
+    instance_id = topology.instance_id(instance_name)
+    state = topology.instance_state(instance_name)
+
     if (state != 'running'):
+        ec2 = get_client('ec2', topology.region_name)
         try:
-            ec2 = boto3.client('ec2', region_name = region_name)
             ec2.start_instances(InstanceIds=[instance_id])
         except Exception as e:
             error = "Cannot start instance " + instance_name + ". Exception: " + str(e)
             exit_with_error(error)    
 
+        if wait:
+            wait_for_instance_state(ec2, [instance_id], 'running')
+
     msg = "Power ON of instance " + instance_name + " ... [ SUCCESS ]"
     print msg
     return
 
-def reboot_instance(instance_name, region):
-    power_off_instance(instance_name, region)
-    power_on_instance(instance_name, region)
-
-# Terminate an instance
-def terminate_instance(instance_name, region_name):
-    instance_id = get_instance_id(instance_name)
+# Whether an instance is running and passes its status checks. Checks still
+# initializing count as passing.
+def instance_healthy(topology, instance_name):
+    instance_id = topology.instance_id(instance_name)
+    ec2 = get_client('ec2', topology.region_name)
     try:
-        ec2 = boto3.resource('ec2')
-        instance = ec2.Instance(instance_id)
-        state = instance.state['Name']
+        response = ec2.describe_instance_status(InstanceIds = [instance_id], IncludeAllInstances = True)
     except Exception as e:
-        error = "Exception while fetching instance state: " + str(e)
+        error = "Unable to describe status of instance " + instance_name + ". Exception: " + str(e)
         exit_with_error(error)
 
+    for status in response['InstanceStatuses']:
+        if (status['InstanceState']['Name'] != 'running'):
+            return False
+        return all(status.get(check, {}).get('Status') != 'impaired' for check in ('InstanceStatus', 'SystemStatus'))
+    return False
+
+
+def reboot_instance(topology, instance_name):
+    power_off_instance(topology, instance_name)
+    instance = topology.instance(instance_name)
+    topology.add_instance(instance_name, dict(instance, State = dict(instance['State'], Name = 'stopped')))
+    power_on_instance(topology, instance_name)
+
+# Terminate an instance
+def terminate_instance(topology, instance_name):
+    instance_id = topology.instance_id(instance_name)
+
     try:
-         ec2 = boto3.client('ec2', region_name = region)
+         ec2 = get_client('ec2', topology.region_name)
          ec2.terminate_instances(InstanceIds=[instance_id])
     except Exception as e:
         error = "Cannot mark instance " + instance_name + " with instance ID " + instance_id + " for termination. Exception: " + str(e)
@@ -276,14 +228,51 @@ def terminate_instance(instance_name, region_name):
     return
 
 
-# Create Instance from Snapshot
+# Free an interface held by an instance that is being replaced: detach it,
+# or, if it is the instance's primary interface, terminate the instance when
+# terminate is set and fail otherwise
+def release_interface(topology, interface_name, instance_name, terminate = False):
+    topology.refresh_interface(interface_name)
+    attachment = topology.interface(interface_name).get('Attachment', {})
+    if attachment.get('InstanceId') != topology.instance_id(instance_name):
+        return
+    if (attachment.get('DeviceIndex') == 0):
+        if not terminate:
+            exit_with_error("Interface " + interface_name + " is the primary interface of " + instance_name +
+                            ", which is not terminated unless the site sets terminate_unhealthy_peer")
+        terminate_instance(topology, instance_name)
+        ec2 = get_client('ec2', topology.region_name)
+        wait_for_interface_status(ec2, [topology.interface_id(interface_name)], 'available')
+    else:
+        detach_interface(topology, interface_name)
+
+
+# Create Instance from Snapshot and return its instance ID
 # NOTE: Creates with only the primary interface
-def create_instance(region_name, ami_id, instance_type, primary_interface_name, secondary_interface_name, instance_name):
-    primary_eni = get_interface_id(primary_interface_name)
-    secondary_eni = get_interface_id(secondary_interface_name)
-    ec2 = boto3.client('ec2', region_name)
-    try:
-        response = ec2.run_instances(
+# NOTE: Waits until the instance is running unless wait is False
+# NOTE: A retry with the same client_token returns the instance launched
+#       before instead of launching another one
+# NOTE: Falls back to fallback_types, in order, if there is no capacity for
+#       instance_type (see capacity_launcher)
+def create_instance(topology, ami_id, instance_type, primary_interface_name, secondary_interface_name, instance_name,
+                    wait = True, client_token = None, fallback_types = (), hedge = 0):
+    primary_eni = topology.interface_id(primary_interface_name)
+    secondary_eni = topology.interface_id(secondary_interface_name)
+    zone = topology.interface(primary_interface_name)['AvailabilityZone']
+    ec2 = get_client('ec2', topology.region_name)
+
+    # Without a journal, a token of this launch still makes its retries safe
+    # (see ec2_throttle)
+    if client_token is None:
+        client_token = hashlib.sha1(os.urandom(20)).hexdigest()
+
+    def run(instance_type, reservation_id):
+        options = {'ClientToken': hashlib.sha1(client_token + '/' + instance_type).hexdigest()}
+        if reservation_id is not None:
+            options['CapacityReservationSpecification'] = {
+                'CapacityReservationTarget': {'CapacityReservationId': reservation_id}
+            }
+        return ec2.run_instances(
             BlockDeviceMappings = [
                 {
                     'DeviceName': '/dev/sda1',
@@ -304,16 +293,21 @@ def create_instance(region_name, ami_id, instance_type, primary_interface_name,
                     'NetworkInterfaceId': secondary_eni,
                 }
             ],
+            **options
         )
+
+    from capacity_launcher import launch # Only launches need it
+    try:
+        response = launch(topology.region_name, zone, ami_id, [instance_type] + list(fallback_types), run, hedge)
     except Exception as e:
         error = "Unable to create new instnace. Exception: " + str(e)
-        error_with_exception(error)
+        exit_with_error(error)
 
     try:
         instance_id = response['Instances'][0]['InstanceId']
-        resource = boto3.resource('ec2')
-        instance = resource.Instance(instance_id)
-        tag = instance.create_tags(Tags = [
+        ec2.create_tags(
+            Resources = [instance_id],
+            Tags = [
                 {
                     'Key': 'Name',
                     'Value': instance_name 
@@ -324,28 +318,619 @@ def create_instance(region_name, ami_id, instance_type, primary_interface_name,
         error = "Unable to change instance name. Exception: " + str(e)
         exit_with_error(error)
 
-    print ("New Instance Creation ... [ SUCCESS ]")
-    return
+    if wait:
+        wait_for_instance_state(ec2, [instance_id], 'running')
 
+    print ("New Instance Creation ... [ SUCCESS ]")
+    return instance_id
 
-# Lambda callback
-def lambda_handler(event, context):
 
-    region = 'us-east-1'
-    instance_type = 'c4.xlarge'
-    security_group_id = 'sg-0509dc08db7a2036a'
-    snapshot_ami_id = 'ami-0a29943124c318e2b'
-    nsg_name = 'Resilient-NSG'
-    uplink_name = 'nsgb-uplink-b'
-    elastic_IP = '18.235.97.139'
-    access_interface_name = 'nsgb-access'
-    old_nsg_name = 'nsg-B'
+# Site definition defaults. A site given in the event or in a sites file only
+# needs the keys that differ (see site_runner.load_sites).
+default_site = {
+    'name': 'nsg-B',
+    'region': 'us-east-1',
+    'instance_type': 'c4.xlarge',
+    'security_group_id': 'sg-0509dc08db7a2036a',
+    'snapshot_ami_id': 'ami-0a29943124c318e2b',
+    'nsg_name': 'Resilient-NSG',
+    'uplink_name': 'nsgb-uplink-b',
+    'elastic_ip': '18.235.97.139',
+    'access_interface_name': 'nsgb-access',
+    'old_nsg_name': 'nsg-B',
+    # 'cold' launches the new NSG from the AMI, 'warm' starts a standby,
+    # 'swap' moves traffic to peer_name, an NSG that is already running,
+    # 'reboot' stops and starts the old NSG, and 'adaptive' picks the one of
+    # adaptive_strategies with the lowest expected RTO (see strategy_history)
+    'failover_mode': 'cold',
+    'adaptive_strategies': ['swap', 'warm', 'reboot', 'cold'],
+    'standby_pool_size': 1,
+    # Check (and report) Fast Snapshot Restore of the AMI on cold launches;
+    # fast_restore.lambda_handler keeps it enabled
+    'fast_snapshot_restore': False,
+    # Instance types to fall back to, in order, when there is no capacity for
+    # instance_type, and how many of them to reserve capacity for at once
+    # (see capacity_launcher)
+    'fallback_instance_types': [],
+    'capacity_hedge': 0,
+    # Swap failovers: the running peer, with uplink_name as its uplink. The
+    # access interface is moved to the peer at peer_access_device_index, or,
+    # with peer_access_interface_name, its secondary private IPs are moved to
+    # that interface of the peer instead.
+    'peer_name': None,
+    'peer_access_device_index': 1,
+    'peer_access_interface_name': None,
+    # A swap to an unhealthy peer falls back to a cold failover, which needs
+    # the uplink back from the peer. If it is the peer's primary interface,
+    # the peer is terminated only with terminate_unhealthy_peer set;
+    # otherwise the site fails.
+    'terminate_unhealthy_peer': False,
+    # Cross-region DR: the region to fail over to when the site's region is
+    # impaired, with interfaces (by default named like the site's) and an
+    # Elastic IP created there ahead of time; dr_region.lambda_handler keeps
+    # the AMI copied there
+    'dr_region': None,
+    'dr_uplink_name': None,
+    'dr_access_interface_name': None,
+    'dr_elastic_ip': None,
+}
+
+# Most sites failed over at once
+max_concurrent_sites = 16
+
+# Seconds of state-change events that count as one incident
+incident_window = 900
 
-    detach_interface(access_interface_name)
-    disassociate_elastic_ip(elastic_IP)
-    associate_elastic_ip(elastic_IP, uplink_name)
-    create_instance(region, snapshot_ami_id, instance_type, uplink_name, access_interface_name, nsg_name)
-    power_off_instance(old_nsg_name, region)
 
-    return "Success!"
+# Lambda callback
+# A state-change event is handled once per instance and incident window;
+# duplicate events for the same outage return the first run's outcome. The
+# failover runs within the invocation's remaining time (see call_deadlines).
+def lambda_handler(event, context):
+    store = get_store(default_site['region'])
+    try:
+        with budget(context):
+            return run_once(event, context, lambda: handle_failover(event), store, incident_window)
+    finally:
+        wait_for_standby_refills(context)
+
+
+# Let the standby pool refills of the invocation finish before Lambda freezes
+# the container (see standby_pool), within the invocation's remaining time
+# less the reserve the handler needs to return
+def wait_for_standby_refills(context):
+    standby_pool = sys.modules.get('standby_pool') # Only loaded by warm failovers
+    if standby_pool is None:
+        return
+    timeout = None
+    if context is not None:
+        timeout = max(0, context.get_remaining_time_in_millis() / 1000.0 - reserve)
+    standby_pool.wait_for_refills(timeout = timeout)
+
+
+# A retry of an incident resumes each site's failover from its journal (see
+# step_journal). Manual invocations are journaled if they name an 'incident'.
+# Sites of impaired regions are failed over to their DR region.
+def handle_failover(event):
+    defaults = dict(default_site, failover_mode = event.get('failover_mode', default_site['failover_mode']))
+    sites = load_sites(event, defaults)
+    incident = incident_key(event, incident_window) or event.get('incident')
+
+    results = failover_pass(sites, [event], lambda topologies, impaired: [(site, incident) for site in sites])
+    report_sites(results)
+    return {'sites': results}
+
+
+# Fail sites over in one pass for a list of events: the events are applied
+# to the inventory and the topologies of all sites are looked up once, then
+# select(topologies, impaired) picks the sites to fail over, as a list of
+# (site, incident) where the incident (or None) journals the site's steps.
+# Returns a result per selected site, in the order selected.
+def failover_pass(sites, events, select):
+    start_recording('nsg_resiliency')
+    try:
+        impaired = set()
+        if inventory_enabled():
+            from inventory import apply_events
+            for region in sorted(set(event.get('region', default_site['region']) for event in events)):
+                apply_events(region, [e for e in events if e.get('region', default_site['region']) == region])
+        for event in events:
+            if event.get('impaired_regions') or (event.get('source') == 'aws.health'):
+                from dr_region import impaired_regions # Only region outages need it
+                impaired.update(impaired_regions(event))
+        topologies, dr_topologies, impaired = site_topologies(sites, impaired)
+        selected = select(topologies, impaired)
+        incidents = dict((site['name'], incident) for site, incident in selected)
+        sites = [site for site, incident in selected]
+        journal = None
+        if any(incidents.values()):
+            from step_journal import get_journal # Only incidents are journaled
+            journal = get_journal(default_site['region'])
+        results = run_sites(sites, lambda site: site_failover(site, topologies, dr_topologies, impaired,
+                                                              journal, incidents[site['name']]),
+                            max_concurrent_sites)
+    finally:
+        emit_metrics()
+
+    # Whatever the outcome, the failed over sites' resources have changed
+    if inventory_enabled():
+        from inventory import invalidate
+        for region in sorted(set(site['region'] for site in sites)):
+            invalidate(region, *topology_names([site for site in sites if site['region'] == region]))
+        for dr_region, dr_sites in sorted(sites_by_dr_region(sites, impaired).items()):
+            invalidate(dr_region, *dr_topology_names(dr_sites))
+
+    for result in results:
+        value = result.pop('value') or {}
+        result['hydration'] = value.get('hydration')
+        result['region'] = value.get('region')
+        result['strategy'] = value.get('strategy')
+    return results
+
+
+# Shared lookups: one topology per region covering every site in it, from
+# the inventory index if it is enabled (see inventory). A region whose
+# lookups fail is impaired, and the sites there that have a DR region get a
+# topology of their resources in it. Regions are looked up in parallel.
+# Returns ({region: topology}, {DR region: topology}, impaired regions);
+# regions that could not be looked up have no topology.
+def site_topologies(sites, impaired = ()):
+    impaired = set(impaired)
+    with span('topology'):
+        regions = sorted(set(site['region'] for site in sites) - impaired)
+        topologies = load_topologies(dict(
+            (region, topology_names([site for site in sites if site['region'] == region])) for region in regions))
+        impaired.update(region for region in regions if region not in topologies)
+
+        dr_topologies = load_topologies(dict(
+            (dr_region, dr_topology_names(dr_sites)) for dr_region, dr_sites in sites_by_dr_region(sites, impaired).items()))
+    return topologies, dr_topologies, impaired
+
+
+# Whether the inventory index is enabled (see inventory.enabled), checked
+# without loading it
+def inventory_enabled():
+    return os.environ.get('INVENTORY', '0') != '0'
+
+
+# Topology of a region's named resources, from the inventory index if it is
+# enabled
+def get_topology(region_name, instance_names = (), interface_names = (), elastic_ips = ()):
+    if not inventory_enabled():
+        return Topology(region_name, instance_names, interface_names, elastic_ips)
+    import inventory
+    return inventory.get_topology(region_name, instance_names, interface_names, elastic_ips)
+
+
+# Topologies of regions given {region: names}, looked up in parallel
+def load_topologies(names):
+    def load(region):
+        try:
+            return take_prefetched(region, *names[region]) or get_topology(region, *names[region])
+        except SystemExit: # exit_with_error
+            print "Unable to look up sites in " + region + ", region is impaired"
+            return None
+
+    if not names:
+        return {}
+    executor = ThreadPoolExecutor(max_workers = len(names))
+    try:
+        topologies = dict(zip(sorted(names), executor.map(load, sorted(names))))
+    finally:
+        executor.shutdown(wait = True)
+    return dict((region, topology) for region, topology in topologies.items() if topology is not None)
+
+
+# Instance names, interface names and Elastic IPs of a topology for sites.
+# The new NSG is only there if a failover was interrupted.
+def topology_names(sites):
+    return ([site[key] for site in sites for key in ('old_nsg_name', 'nsg_name', 'peer_name') if site[key]],
+            [site[key] for site in sites for key in ('uplink_name', 'access_interface_name',
+                                                     'peer_access_interface_name') if site[key]],
+            [site['elastic_ip'] for site in sites])
+
+
+# Sites of impaired regions that have a DR region, by DR region
+def sites_by_dr_region(sites, impaired):
+    by_region = {}
+    for site in sites:
+        if site['region'] in impaired and site['dr_region']:
+            by_region.setdefault(site['dr_region'], []).append(site)
+    return by_region
+
+
+# Instance names, interface names and Elastic IPs of sites in their DR region
+def dr_topology_names(sites):
+    from dr_region import dr_names # Only DR failovers need it
+    names = [dr_names(site) for site in sites]
+    return ([site['nsg_name'] for site in sites],
+            [n for uplink, access, eip in names for n in (uplink, access)],
+            [eip for uplink, access, eip in names if eip])
+
+
+# Fail a site over in its region, or in its DR region if its region is
+# impaired, and record how long it took (see strategy_history)
+def site_failover(site, topologies, dr_topologies, impaired, journal, incident):
+    if site['region'] not in impaired:
+        topology = topologies[site['region']].copy()
+        strategy = site['failover_mode']
+        uplink_name = site['uplink_name']
+    elif not site['dr_region']:
+        exit_with_error("Region " + site['region'] + " of site " + site['name'] + " is impaired and it has no DR region")
+    elif site['dr_region'] not in dr_topologies:
+        exit_with_error("DR region " + site['dr_region'] + " of site " + site['name'] + " is impaired too")
+    else:
+        from dr_region import dr_names # Only DR failovers need it
+        topology = dr_topologies[site['dr_region']].copy()
+        strategy = 'dr'
+        uplink_name = dr_names(site)[0]
+
+    zone = interface_zone(topology, uplink_name)
+    if (strategy == 'adaptive'):
+        strategy = adaptive_strategy(site, topology, zone, journal, incident)
+    from strategy_history import record_runs
+    # The failover sets the mode it falls back to, if any, so the run is
+    # recorded under the strategy that actually ran
+    site = dict(site, failover_mode = strategy)
+    started = time.time()
+    try:
+        value = strategy_failovers[strategy](site, topology, journal, incident)
+    except BaseException: # exit_with_error raises SystemExit
+        record_runs(topology.region_name, site['instance_type'], zone,
+                    [('strategy', site['failover_mode'], time.time() - started, False)], default_site['region'])
+        raise
+
+    runs = [('strategy', site['failover_mode'], time.time() - started, True)]
+    if not value.pop('resumed'):
+        record_runs(topology.region_name, site['instance_type'], zone, runs + value.pop('step_runs'),
+                    default_site['region'])
+    value['strategy'] = site['failover_mode']
+    return value
+
+
+# Availability zone of a site's interface, if it is known
+def interface_zone(topology, interface_name):
+    return topology.interfaces.get(interface_name, {}).get('AvailabilityZone')
+
+
+# Strategies an adaptive site can fail over with in its region
+def feasible_strategies(site, topology):
+    peer = topology.instances.get(site['peer_name']) if site['peer_name'] else None
+    old_nsg = topology.instances.get(site['old_nsg_name'])
+    feasible = {
+        'swap': peer is not None and peer['State']['Name'] == 'running',
+        'warm': 'warm' in site['adaptive_strategies'] and standby_ready(site, topology),
+        'reboot': old_nsg is not None and old_nsg['State']['Name'] not in gone_states,
+        'cold': True,
+    }
+    return [strategy for strategy in site['adaptive_strategies'] if feasible.get(strategy)]
+
+
+# Whether a site's standby pool has a standby of the current AMI to claim
+def standby_ready(site, topology):
+    uplink = topology.interfaces.get(site['uplink_name'])
+    if site['standby_pool_size'] <= 0 or uplink is None:
+        return False
+    from standby_pool import site_pool # Only warm failovers need it
+    return bool(site_pool(site, uplink['SubnetId']).ready())
+
+
+# Strategy of an adaptive site: the one of lowest expected RTO by the
+# region's history. With a journal, the choice is journaled, so a retry of
+# the incident resumes the same strategy.
+def adaptive_strategy(site, topology, zone, journal, incident):
+    if journal is not None:
+        entry = journal.load(journal_key(site, incident) + '/strategy').get('select_strategy')
+        if entry is not None and entry['status'] == 'succeeded':
+            print "Strategy for site " + site['name'] + ": " + entry['value'] + " ... [ RESUMED ]"
+            return entry['value']
+
+    from strategy_history import get_history, report_selection, select_strategy # Only adaptive sites need them
+    entries = get_history(topology.region_name, default_site['region']).load()
+    strategy, estimates = select_strategy(entries, feasible_strategies(site, topology), site['instance_type'], zone)
+    report_selection(site['name'], site['instance_type'], zone, estimates, strategy)
+    if journal is not None:
+        journal.record(journal_key(site, incident) + '/strategy', 'select_strategy', 'succeeded', strategy)
+    return strategy
+
+
+# Runs of the steps that ran, for the history, as (kind, name, duration,
+# succeeded)
+def step_runs(results):
+    return [('step', result.name, result.duration, result.status == 'succeeded')
+            for result in results if result.duration is not None]
+
+
+# Journal key of a site's failover for an incident
+def journal_key(site, incident):
+    return site['name'] + '/' + hashlib.sha1(incident).hexdigest()
+
+
+# Replace the old NSG of a site with a new instance and move its interfaces
+# and Elastic IP over. Returns {'hydration', 'region', 'resumed',
+# 'step_runs'}: how the new NSG's disk is hydrated (see fast_restore), the
+# region it runs in, whether the run resumed a journal, and its step runs
+# (see step_runs). A warm failover refills its standby pool in the
+# background (see standby_pool), and sets the site's failover_mode to cold
+# if it has to launch because no standby was ready.
+# NOTE: With a journal, the steps are journaled under the incident and a
+#       failover of the same incident resumes from them
+def failover(site, topology, journal = None, incident = None):
+    nsg_name = site['nsg_name']
+    uplink_name = site['uplink_name']
+    access_interface_name = site['access_interface_name']
+    elastic_ip = site['elastic_ip']
+    old_nsg_name = site['old_nsg_name']
+
+    key = None
+    entries = {}
+    client_token = None
+    if journal is not None:
+        key = journal_key(site, incident)
+        entries = journal.load(key)
+        client_token = hashlib.sha1(key + '/create_instance').hexdigest()
+
+    # The new NSG of an interrupted failover, if it got that far
+    new_nsg = topology.instances.get(nsg_name)
+    if not entries or new_nsg is None or new_nsg['State']['Name'] in gone_states:
+        new_nsg = None
+        topology.instances.pop(nsg_name, None)
+
+    standby = None
+    warm = (site['failover_mode'] == 'warm') and 'create_instance' not in entries
+    if warm and new_nsg is not None:
+        standby = new_nsg # Claimed by the interrupted run
+    elif warm:
+        from standby_pool import refill_later, site_pool # Only warm failovers need it
+        pool = site_pool(site, topology.interface(uplink_name)['SubnetId'])
+        standby = pool.claim(nsg_name)
+        if standby is None:
+            print "No standby ready in pool " + pool.pool_name + ", falling back to cold launch"
+            site['failover_mode'] = 'cold'
+        else:
+            topology.add_instance(nsg_name, standby)
+        # Seed or rotate a pool that missed, as well as refill one that hit
+        refill_later(pool)
+
+    # Independent steps run in parallel; the new NSG only needs the access
+    # interface to be free
+    steps = [
+        Step('detach_interface',
+             lambda: detach_interface(topology, access_interface_name)),
+        Step('disassociate_elastic_ip',
+             lambda: disassociate_elastic_ip(topology, elastic_ip)),
+        Step('associate_elastic_ip',
+             lambda: associate_elastic_ip(topology, elastic_ip, uplink_name),
+             depends_on = ['disassociate_elastic_ip']),
+        Step('power_off_instance',
+             lambda: power_off_instance(topology, old_nsg_name)),
+    ]
+    if standby is None:
+        steps += [
+            Step('create_instance',
+                 lambda: create_instance(topology, site['snapshot_ami_id'], site['instance_type'],
+                                         uplink_name, access_interface_name, nsg_name,
+                                         client_token = client_token,
+                                         fallback_types = site['fallback_instance_types'],
+                                         hedge = site['capacity_hedge']),
+                 depends_on = ['detach_interface']),
+        ]
+        if site['fast_snapshot_restore']:
+            import fast_restore
+            steps += [
+                Step('check_fast_restore',
+                     lambda: fast_restore.hydration_status(site['region'], site['snapshot_ami_id'],
+                                                           topology.interface(uplink_name)['AvailabilityZone'])),
+            ]
+    else:
+        steps += [
+            Step('attach_uplink_interface',
+                 lambda: attach_interface_to_instance(topology, uplink_name, nsg_name, 1)),
+            Step('attach_access_interface',
+                 lambda: attach_interface_to_instance(topology, access_interface_name, nsg_name, 2),
+                 depends_on = ['detach_interface']),
+            Step('power_on_instance',
+                 lambda: power_on_instance(topology, nsg_name),
+                 depends_on = ['attach_uplink_interface', 'attach_access_interface']),
+        ]
+    if journal is not None:
+        from step_journal import journal_steps # Only incidents are journaled
+        steps = journal_steps(journal, key, steps, failover_checks(site, topology, new_nsg), entries)
+    results = run_steps(steps)
+    report_steps(results)
+
+    hydration = 'lazy'
+    if standby is not None:
+        hydration = 'standby'
+    for result in results:
+        if (result.name == 'check_fast_restore'):
+            hydration = result.value
+    return {'hydration': hydration, 'region': site['region'],
+            'resumed': bool(entries), 'step_runs': step_runs(results)}
+
+
+# Move a site's traffic to its running peer: the Elastic IP is reassociated
+# with the peer's uplink in one call, and the access interface (or its
+# private IPs) moves to the peer. Nothing boots. The old NSG is stopped as a
+# fence, without waiting for it. A peer that is not running or fails its
+# status checks is not swapped to: the uplink is taken from it and the site
+# fails over cold instead, with its failover_mode set to cold. A swap
+# already under way is resumed as is. Returns like failover().
+# NOTE: With a journal, the fallback is journaled, so a retry of the
+#       incident resumes the cold failover
+def swap_failover(site, topology, journal = None, incident = None):
+    peer_name = site['peer_name']
+    uplink_name = site['uplink_name']
+    access_interface_name = site['access_interface_name']
+    peer_access_interface_name = site['peer_access_interface_name']
+    elastic_ip = site['elastic_ip']
+    if not peer_name:
+        exit_with_error("Site " + site['name'] + " has no peer_name to swap to")
+
+    entries = {}
+    fallback = False
+    if journal is not None:
+        key = journal_key(site, incident)
+        entries = journal.load(key)
+        fallback = 'check_peer' in journal.load(key + '/swap')
+    if not fallback and not entries and not instance_healthy(topology, peer_name):
+        print "Peer " + peer_name + " of site " + site['name'] + " is not healthy, falling back to cold failover"
+        if journal is not None:
+            journal.record(key + '/swap', 'check_peer', 'succeeded', 'cold')
+        fallback = True
+    if fallback:
+        release_interface(topology, uplink_name, peer_name, site['terminate_unhealthy_peer'])
+        site['failover_mode'] = 'cold'
+        return failover(site, topology, journal, incident)
+
+    steps = [
+        Step('reassociate_elastic_ip',
+             lambda: associate_elastic_ip(topology, elastic_ip, uplink_name, allow_reassociation = True)),
+        Step('power_off_instance',
+             lambda: power_off_instance(topology, site['old_nsg_name'], wait = False)),
+    ]
+    if peer_access_interface_name:
+        steps += [
+            Step('float_private_ips',
+                 lambda: float_private_ips(topology, access_interface_name, peer_access_interface_name)),
+        ]
+    else:
+        steps += [
+            Step('detach_interface',
+                 lambda: detach_interface(topology, access_interface_name)),
+            Step('attach_access_interface',
+                 lambda: attach_interface_to_instance(topology, access_interface_name, peer_name,
+                                                      site['peer_access_device_index']),
+                 depends_on = ['detach_interface']),
+        ]
 
+    if journal is not None:
+        peer_id = topology.instance_id(peer_name)
+        uplink_id = topology.interface_id(uplink_name)
+        access = topology.interface(access_interface_name)
+        moved_ips = [ip['PrivateIpAddress'] for ip in access.get('PrivateIpAddresses', []) if not ip.get('Primary')]
+        checks = {
+            'reassociate_elastic_ip': lambda: (topology.address(elastic_ip).get('NetworkInterfaceId') == uplink_id, None),
+            'detach_interface': lambda: (access.get('Attachment', {}).get('InstanceId') in (None, peer_id) and
+                                         access['Status'] != 'detaching', None),
+            'attach_access_interface': lambda: (access.get('Attachment', {}).get('InstanceId') == peer_id, None),
+            'float_private_ips': lambda: (not moved_ips, None), # Moved IPs are gone from the access interface
+        }
+        from step_journal import journal_steps # Only incidents are journaled
+        steps = journal_steps(journal, key, steps, checks, entries)
+    results = run_steps(steps)
+    report_steps(results)
+    return {'hydration': 'peer', 'region': site['region'],
+            'resumed': bool(entries), 'step_runs': step_runs(results)}
+
+
+# Stop and start a site's old NSG in place, on the interfaces and Elastic IP
+# it already has. Returns like failover().
+def reboot_failover(site, topology, journal = None, incident = None):
+    steps = [
+        Step('reboot_instance',
+             lambda: reboot_instance(topology, site['old_nsg_name'])),
+    ]
+    entries = {}
+    if journal is not None:
+        key = journal_key(site, incident)
+        entries = journal.load(key)
+        from step_journal import journal_steps # Only incidents are journaled
+        steps = journal_steps(journal, key, steps, None, entries)
+    results = run_steps(steps)
+    report_steps(results)
+    return {'hydration': 'in_place', 'region': site['region'],
+            'resumed': bool(entries), 'step_runs': step_runs(results)}
+
+
+# Launch a site's new NSG in its DR region from the AMI copy there, on the
+# pre-created DR interfaces, and move the DR Elastic IP to it (see dr_region).
+# The impaired region is not touched. Returns like failover().
+def dr_failover(site, topology, journal = None, incident = None):
+    from dr_region import copied_ami_id, dr_names # Only DR failovers need it
+    dr_region = site['dr_region']
+    nsg_name = site['nsg_name']
+    uplink_name, access_interface_name, elastic_ip = dr_names(site)
+    if not elastic_ip:
+        exit_with_error("Site " + site['name'] + " has no dr_elastic_ip")
+
+    key = None
+    entries = {}
+    client_token = None
+    if journal is not None:
+        key = journal_key(site, incident)
+        entries = journal.load(key)
+        client_token = hashlib.sha1(key + '/dr_create_instance').hexdigest()
+
+    # Both steps only need what was staged, so they run in parallel
+    steps = [
+        Step('dr_create_instance',
+             lambda: create_instance(topology, copied_ami_id(dr_region, site['region'], site['snapshot_ami_id']),
+                                     site['instance_type'], uplink_name, access_interface_name, nsg_name,
+                                     client_token = client_token,
+                                     fallback_types = site['fallback_instance_types'],
+                                     hedge = site['capacity_hedge'])),
+        Step('dr_associate_elastic_ip',
+             lambda: associate_elastic_ip(topology, elastic_ip, uplink_name)),
+    ]
+    if journal is not None:
+        new_nsg = topology.instances.get(nsg_name)
+        new_nsg_id = new_nsg['InstanceId'] if new_nsg is not None and new_nsg['State']['Name'] not in gone_states else None
+        uplink_id = topology.interface_id(uplink_name)
+        checks = {
+            'dr_create_instance': lambda: (new_nsg_id is not None, new_nsg_id),
+            'dr_associate_elastic_ip': lambda: (topology.address(elastic_ip).get('NetworkInterfaceId') == uplink_id, None),
+        }
+        from step_journal import journal_steps # Only incidents are journaled
+        steps = journal_steps(journal, key, steps, checks, entries)
+    results = run_steps(steps)
+    report_steps(results)
+    return {'hydration': 'lazy', 'region': dr_region,
+            'resumed': bool(entries), 'step_runs': step_runs(results)}
+
+
+# Failover of each strategy
+strategy_failovers = {
+    'cold': failover,
+    'warm': failover,
+    'swap': swap_failover,
+    'reboot': reboot_failover,
+    'dr': dr_failover,
+}
+
+
+# Checks of the failover steps an interrupted run started, against the
+# topology fetched by the retry: (done, value) per step. Steps that are
+# safe to run again (power on/off, FSR check) have none.
+def failover_checks(site, topology, new_nsg):
+    old_nsg_id = topology.instance_id(site['old_nsg_name'])
+    uplink_id = topology.interface_id(site['uplink_name'])
+    access = topology.interface(site['access_interface_name'])
+    address = topology.address(site['elastic_ip'])
+    new_nsg_id = new_nsg['InstanceId'] if new_nsg is not None else None
+
+    def attached_to_new_nsg(interface_name):
+        return new_nsg_id is not None and \
+               topology.interface(interface_name).get('Attachment', {}).get('InstanceId') == new_nsg_id
+
+    return {
+        'detach_interface': lambda: (access.get('Attachment', {}).get('InstanceId') != old_nsg_id and
+                                     access['Status'] != 'detaching', None),
+        'disassociate_elastic_ip': lambda: (address.get('AssociationId') is None or
+                                            address.get('NetworkInterfaceId') == uplink_id, None),
+        'associate_elastic_ip': lambda: (address.get('NetworkInterfaceId') == uplink_id, None),
+        'create_instance': lambda: (new_nsg_id is not None, new_nsg_id),
+        'attach_uplink_interface': lambda: (attached_to_new_nsg(site['uplink_name']), None),
+        'attach_access_interface': lambda: (attached_to_new_nsg(site['access_interface_name']), None),
+    }
+
+
+# EC2 operations a failover makes
+failover_operations = [
+    'DescribeInstances', 'DescribeNetworkInterfaces', 'DescribeAddresses', 'DetachNetworkInterface',
+    'DisassociateAddress', 'AssociateAddress', 'RunInstances', 'CreateTags', 'StopInstances',
+    'StartInstances', 'AttachNetworkInterface', 'AssignPrivateIpAddresses', 'DescribeInstanceStatus',
+]
+
+# Lambda INIT phase: get the default site's client ready before the first event
+prewarm(__name__, default_site['region'], failover_operations, *topology_names([default_site]), import_started = import_started)
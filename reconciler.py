@@ -0,0 +1,185 @@
+
+import nsg_resiliency
+
+from ec2_pool import get_client
+from ec2_topology import Topology, filter_chunks, get_name_tag, gone_states
+from ec2_waiters import wait_all, wait_for_instance_state
+from errors import exit_with_error
+from step_graph import Step
+
+# Desired-state reconciliation. A target declares where things should be:
+#   {
+#       'instances': {'nsg-B': 'running', 'Resilient-NSG': 'terminated'},
+#       'attachments': {'nsgb-access': ('nsg-B', 1)},  # interface: (instance, device index)
+#       'addresses': {'18.235.97.139': 'nsgb-uplink-a'},  # Elastic IP: interface
+#   }
+# plan() diffs it against one topology snapshot and returns only the steps
+# needed to get there, ordered by their dependencies, so reconciling a target
+# that is already reached makes no mutating call. Instances are started,
+# stopped and terminated in batches, one step per operation, with as many
+# IDs per request as the API allows.
+
+# Most instance IDs sent in one request
+max_instance_ids = 1000
+
+# Snapshot of every resource a target names
+def snapshot(region_name, target):
+    instances = set(target.get('instances', {}))
+    instances.update(instance for instance, device_index in target.get('attachments', {}).values())
+    interfaces = set(target.get('attachments', {}))
+    interfaces.update(target.get('addresses', {}).values())
+    return Topology(region_name, sorted(instances), sorted(interfaces), sorted(target.get('addresses', {})))
+
+
+# Live instance description of a name, or None
+def live_instance(topology, instance_name):
+    instance = topology.instances.get(instance_name)
+    if instance is None or instance['State']['Name'] in gone_states:
+        return None
+    return instance
+
+
+# Wait for instances to reach a state, a chunk of IDs per waiter
+def wait_for_instances(ec2, instance_ids, state):
+    wait_all(*[lambda chunk = chunk: wait_for_instance_state(ec2, chunk, state)
+               for chunk in filter_chunks(instance_ids, max_instance_ids)])
+
+
+# Send a state change to every instance not already in (or on its way to)
+# the target state, chunked to the API's request size. Waits for the target
+# state unless wait is False.
+def change_instance_states(region_name, instances, operation, target_state, skip_states, wait):
+    instance_ids = [i['InstanceId'] for i in instances if i['State']['Name'] not in skip_states]
+    waiting_ids = [i['InstanceId'] for i in instances if i['State']['Name'] != target_state]
+    ec2 = get_client('ec2', region_name)
+
+    # Instances still on their way to stopped cannot be started yet
+    stopping_ids = [i['InstanceId'] for i in instances if i['State']['Name'] == 'stopping']
+    if (operation == 'start_instances') and stopping_ids:
+        wait_for_instances(ec2, stopping_ids, 'stopped')
+
+    for chunk in filter_chunks(instance_ids, max_instance_ids):
+        try:
+            getattr(ec2, operation)(InstanceIds = chunk)
+        except Exception as e:
+            error = "Cannot " + operation + " for " + ", ".join(chunk) + ". Exception: " + str(e)
+            exit_with_error(error)
+
+    if wait and waiting_ids:
+        wait_for_instances(ec2, waiting_ids, target_state)
+
+
+# Power OFF instances, given by their descriptions
+def power_off_instances(region_name, instances, wait = True):
+    change_instance_states(region_name, instances, 'stop_instances', 'stopped', ('stopping', 'stopped'), wait)
+    for instance in instances:
+        msg = "Instance " + str(get_name_tag(instance)) + " Power OFF ...[ SUCCESS ]"
+        print msg
+
+
+# Power ON instances, given by their descriptions
+def power_on_instances(region_name, instances, wait = True):
+    change_instance_states(region_name, instances, 'start_instances', 'running', ('pending', 'running'), wait)
+    for instance in instances:
+        msg = "Power ON of instance " + str(get_name_tag(instance)) + " ... [ SUCCESS ]"
+        print msg
+
+
+# Terminate instances, given by their descriptions
+def terminate_instances(region_name, instances, wait = False):
+    change_instance_states(region_name, instances, 'terminate_instances', 'terminated',
+                           ('shutting-down', 'terminated'), wait)
+    for instance in instances:
+        msg = "Termination of instance " + str(get_name_tag(instance)) + " ... [ SUCCESS ]"
+        print msg
+
+
+# Steps that take the snapshot to the target
+def plan(topology, target):
+    steps = []
+    detaching = {} # instance ID: detach steps of interfaces leaving it
+    attaching = {} # instance name: attach steps of interfaces joining it
+
+    for interface_name, (instance_name, device_index) in sorted(target.get('attachments', {}).items()):
+        instance = live_instance(topology, instance_name)
+        if instance is None:
+            exit_with_error("Unable to get instance " + instance_name + " ID. Instance not found")
+        interface = topology.interface(interface_name)
+        attached_to = interface.get('Attachment', {}).get('InstanceId') if interface['Status'] == 'in-use' else None
+        if (attached_to == instance['InstanceId']):
+            continue
+
+        depends_on = []
+        if attached_to is not None:
+            name = 'detach_interface:' + interface_name
+            steps.append(Step(name, lambda i = interface_name: nsg_resiliency.detach_interface(topology, i)))
+            detaching.setdefault(attached_to, []).append(name)
+            depends_on = [name]
+
+        name = 'attach_interface_to_instance:' + interface_name
+        steps.append(Step(name,
+                          lambda i = interface_name, n = instance_name, d = device_index:
+                              nsg_resiliency.attach_interface_to_instance(topology, i, n, d),
+                          depends_on = depends_on))
+        attaching.setdefault(instance_name, []).append(name)
+
+    for elastic_ip, interface_name in sorted(target.get('addresses', {}).items()):
+        address = topology.address(elastic_ip)
+        if (address.get('NetworkInterfaceId') == topology.interface_id(interface_name)):
+            continue
+
+        depends_on = []
+        if address.get('AssociationId') is not None:
+            name = 'disassociate_elastic_ip:' + elastic_ip
+            steps.append(Step(name, lambda e = elastic_ip: nsg_resiliency.disassociate_elastic_ip(topology, e)))
+            depends_on = [name]
+
+        steps.append(Step('associate_elastic_ip:' + elastic_ip,
+                          lambda e = elastic_ip, i = interface_name: nsg_resiliency.associate_elastic_ip(topology, e, i),
+                          depends_on = depends_on))
+
+    # Instances to change, per batch operation, and the steps they wait for
+    batches = {'terminate_instances': [], 'power_on_instances': [], 'power_off_instances': []}
+    waits = {'terminate_instances': [], 'power_on_instances': [], 'power_off_instances': []}
+    for instance_name, state in sorted(target.get('instances', {}).items()):
+        instance = live_instance(topology, instance_name)
+        if (state == 'terminated'):
+            if instance is not None:
+                batches['terminate_instances'].append(instance)
+                waits['terminate_instances'] += detaching.get(instance['InstanceId'], [])
+            continue
+
+        if instance is None:
+            exit_with_error("Unable to get instance " + instance_name + " ID. Instance not found")
+        current = instance['State']['Name']
+        if (state == 'running') and current not in ('pending', 'running'):
+            batches['power_on_instances'].append(instance)
+            waits['power_on_instances'] += attaching.get(instance_name, [])
+        elif (state == 'stopped') and current not in ('stopping', 'stopped'):
+            batches['power_off_instances'].append(instance)
+            waits['power_off_instances'] += detaching.get(instance['InstanceId'], [])
+
+    actions = {
+        'terminate_instances': terminate_instances,
+        'power_on_instances': power_on_instances,
+        'power_off_instances': power_off_instances,
+    }
+    for name in sorted(batches):
+        if batches[name]:
+            names = ",".join(get_name_tag(i) for i in batches[name])
+            steps.append(Step(name + ':' + names,
+                              lambda a = actions[name], b = batches[name]: a(topology.region_name, b),
+                              depends_on = sorted(set(waits[name]))))
+
+    return steps
+
+
+# Print a plan, one step per line with the steps it waits for
+def print_plan(steps):
+    if not steps:
+        print "Plan: nothing to change"
+    for step in steps:
+        after = ""
+        if step.depends_on:
+            after = " (after " + ", ".join(step.depends_on) + ")"
+        print "Plan: " + step.name + after
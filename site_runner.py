@@ -0,0 +1,100 @@
+
+import json
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from call_deadlines import deadline_after
+from errors import exit_with_error
+from failover_metrics import span
+
+# Default number of sites handled at once, and seconds a site may take
+default_max_concurrency = 16
+default_site_timeout = 600
+
+# Build the site definitions of an invocation. Sites come from the event,
+# either inline:
+#   {"sites": [{"name": "site-1", "old_nsg_name": "nsg-B-1", ...}, ...]}
+# or from a JSON file shipped with the function:
+#   {"sites_file": "sites.json"}
+# and each one only needs the keys that differ from the defaults. An event
+# without sites runs the single default site.
+def load_sites(event, defaults):
+    if 'sites' in event:
+        definitions = event['sites']
+    elif 'sites_file' in event:
+        try:
+            with open(event['sites_file']) as f:
+                definitions = json.load(f)
+        except Exception as e:
+            error = "Unable to load sites from " + event['sites_file'] + ". Exception: " + str(e)
+            exit_with_error(error)
+    else:
+        definitions = [{}]
+
+    sites = []
+    for definition in definitions:
+        site = dict(defaults)
+        site.update(definition)
+        site.setdefault('timeout', default_site_timeout)
+        if 'name' not in site:
+            exit_with_error("Site definition without a name: " + json.dumps(definition))
+        sites.append(site)
+
+    names = [site['name'] for site in sites]
+    if len(set(names)) != len(names):
+        exit_with_error("Duplicate site names: " + ", ".join(names))
+    return sites
+
+
+# Outcome of a site: 'succeeded', 'failed' or 'timed_out'
+def site_result(site, status, started, value = None):
+    duration = None
+    if started is not None:
+        duration = round(time.time() - started, 3)
+    return {'site': site['name'], 'status': status, 'duration': duration, 'value': value}
+
+
+# Run action(site) for every site, at most max_concurrency at a time. A site
+# that fails does not stop the others. Each site runs with a deadline of its
+# 'timeout' (call_deadlines), which its steps, waiters and API calls check,
+# so a site that runs out of time stops on its own and is reported as timed
+# out. Returns a result per site, in the order given, once every site has
+# stopped.
+def run_sites(sites, action, max_concurrency = default_max_concurrency):
+    def run_site(site):
+        started = time.time()
+        try:
+            with deadline_after(site['timeout']):
+                with span('site'):
+                    value = action(site)
+        except BaseException: # exit_with_error raises SystemExit
+            if (time.time() - started >= site['timeout']):
+                return site_result(site, 'timed_out', started)
+            return site_result(site, 'failed', started)
+        return site_result(site, 'succeeded', started, value)
+
+    executor = ThreadPoolExecutor(max_workers = max_concurrency)
+    try:
+        futures = [executor.submit(run_site, site) for site in sites]
+    finally:
+        executor.shutdown(wait = True)
+
+    return [future.result() for future in futures]
+
+
+# Print one line per site
+def print_sites(results):
+    for result in results:
+        duration = ""
+        if result['duration'] is not None:
+            duration = " (%.2fs)" % result['duration']
+        print "Site " + result['site'] + duration + " ... [ " + result['status'].upper() + " ]"
+
+
+# Print one line per site and fail if any site did not succeed
+def report_sites(results):
+    print_sites(results)
+    failed = [result['site'] for result in results if result['status'] != 'succeeded']
+    if failed:
+        exit_with_error("Sites did not complete: " + ", ".join(failed))
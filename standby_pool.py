@@ -0,0 +1,256 @@
+
+import hashlib
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+
+from ec2_pool import get_client
+from ec2_topology import Topology
+from ec2_waiters import wait_for_instance_state
+from errors import exit_with_error
+from failover_metrics import emit_metrics, span, start_recording
+from site_runner import load_sites
+
+# Pools refilled at once in the background
+refill_workers = 4
+
+lock = threading.Lock()
+refill_executor = None
+queued_refills = {}
+refills = set()
+
+# Return the value of a tag of an EC2 resource description
+def get_tag(description, key):
+    for tag in description.get('Tags', []):
+        if (tag['Key'] == key):
+            return tag['Value']
+    return None
+
+
+# Pool of stopped, pre-tagged NSG instances built from the current failover
+# AMI. A warm failover claims one, attaches the uplink and access interfaces
+# and starts it, instead of paying for run_instances, scheduling and a first
+# boot. Standbys are marked with the StandbyPool tag (set to "claimed" once
+# taken) and the AMI they were built from in StandbyAmi, so standbys of an
+# older AMI are rotated out on refill. A failover refills its site's pool in
+# the background after every claim, hit or miss; lambda_handler, meant to run
+# on a schedule and after every AMI rotation, seeds and rotates the pools of
+# every site that can fail over warm.
+# Refills run on a background executor (refill_later), off the failover
+# path: a failover pass does not wait for standbys to launch and stop. A
+# Lambda handler waits for them (wait_for_refills) once its work is done, as
+# the container is frozen when it returns; the daemon does not.
+# NOTE: Standbys boot on their own primary interface in the given subnet; the
+#       uplink and access interfaces are attached as devices 1 and 2
+# NOTE: Claims are not atomic. Two failovers running at the same time for the
+#       same pool can pick the same standby.
+class StandbyPool(object):
+
+    def __init__(self, region_name, pool_name, ami_id, instance_type, subnet_id, security_group_ids, size = 1):
+        self.region_name = region_name
+        self.pool_name = pool_name
+        self.ami_id = ami_id
+        self.instance_type = instance_type
+        self.subnet_id = subnet_id
+        self.security_group_ids = list(security_group_ids)
+        self.size = size
+
+    # All standbys of the pool that are not claimed or going away
+    def standbys(self):
+        ec2 = get_client('ec2', self.region_name)
+        try:
+            paginator = ec2.get_paginator('describe_instances')
+            pages = paginator.paginate(
+                Filters = [
+                    {
+                        'Name': 'tag:StandbyPool',
+                        'Values': [self.pool_name]
+                    },
+                    {
+                        'Name': 'instance-state-name',
+                        'Values': ['pending', 'running', 'stopping', 'stopped']
+                    }
+                ]
+            )
+            return [i for page in pages for r in page['Reservations'] for i in r['Instances']]
+        except Exception as e:
+            error = "Unable to list standbys of pool " + self.pool_name + ". Exception: " + str(e)
+            exit_with_error(error)
+
+    # Stopped standbys of the current AMI
+    def ready(self):
+        return [i for i in self.standbys()
+                if i['State']['Name'] == 'stopped' and get_tag(i, 'StandbyAmi') == self.ami_id]
+
+    # Take a stopped standby of the current AMI out of the pool and name it.
+    # Returns the instance description, or None if no standby is ready.
+    def claim(self, instance_name):
+        ready = self.ready()
+        if not ready:
+            return None
+
+        instance = ready[0]
+        ec2 = get_client('ec2', self.region_name)
+        try:
+            ec2.create_tags(
+                Resources = [instance['InstanceId']],
+                Tags = [
+                    {'Key': 'Name', 'Value': instance_name},
+                    {'Key': 'StandbyPool', 'Value': 'claimed'}
+                ]
+            )
+        except Exception as e:
+            error = "Unable to claim standby " + instance['InstanceId'] + ". Exception: " + str(e)
+            exit_with_error(error)
+
+        msg = "Claim standby " + instance['InstanceId'] + " from pool " + self.pool_name + " ... [ SUCCESS ]"
+        print msg
+        return instance
+
+    # Terminate standbys of an older AMI, launch new ones until the pool is
+    # back to its size, and boot and stop them. Standbys of the current AMI
+    # that are not stopped (e.g. left running by a refill that did not
+    # complete) are stopped with them, so they can be claimed.
+    def refill(self):
+        ec2 = get_client('ec2', self.region_name)
+        standbys = self.standbys()
+        stale = [i['InstanceId'] for i in standbys if get_tag(i, 'StandbyAmi') != self.ami_id]
+        awake = [i['InstanceId'] for i in standbys
+                 if get_tag(i, 'StandbyAmi') == self.ami_id and i['State']['Name'] in ('pending', 'running')]
+        missing = self.size - (len(standbys) - len(stale))
+
+        if stale:
+            try:
+                ec2.terminate_instances(InstanceIds = stale)
+            except Exception as e:
+                error = "Unable to rotate standbys " + ", ".join(stale) + ". Exception: " + str(e)
+                exit_with_error(error)
+
+        instance_ids = []
+        if (missing > 0):
+            try:
+                response = ec2.run_instances(
+                    BlockDeviceMappings = [
+                        {
+                            'DeviceName': '/dev/sda1',
+                            'Ebs': { 'DeleteOnTermination': True }
+                        }
+                    ],
+                    ImageId = self.ami_id,
+                    InstanceType = self.instance_type,
+                    MinCount = missing,
+                    MaxCount = missing,
+                    ClientToken = hashlib.sha1(os.urandom(20)).hexdigest(),
+                    SubnetId = self.subnet_id,
+                    SecurityGroupIds = self.security_group_ids,
+                    TagSpecifications = [
+                        {
+                            'ResourceType': 'instance',
+                            'Tags': [
+                                {'Key': 'Name', 'Value': self.pool_name},
+                                {'Key': 'StandbyPool', 'Value': self.pool_name},
+                                {'Key': 'StandbyAmi', 'Value': self.ami_id}
+                            ]
+                        }
+                    ]
+                )
+                instance_ids = [i['InstanceId'] for i in response['Instances']]
+            except Exception as e:
+                error = "Unable to launch standbys for pool " + self.pool_name + ". Exception: " + str(e)
+                exit_with_error(error)
+
+        # Boot once so the first start at failover time is a warm one
+        booting = awake + instance_ids
+        if not booting:
+            return
+        wait_for_instance_state(ec2, booting, 'running')
+        try:
+            ec2.stop_instances(InstanceIds = booting)
+        except Exception as e:
+            error = "Unable to stop standbys " + ", ".join(booting) + ". Exception: " + str(e)
+            exit_with_error(error)
+        wait_for_instance_state(ec2, booting, 'stopped')
+
+        if awake:
+            msg = "Stop standbys " + ", ".join(awake) + " of pool " + self.pool_name + " ... [ SUCCESS ]"
+            print msg
+        if instance_ids:
+            msg = "Refill standby pool " + self.pool_name + " with " + str(missing) + " instances ... [ SUCCESS ]"
+            print msg
+
+
+# Refill a pool on the background executor. A pool whose refill is queued
+# and not started yet is not queued again. Returns the refill's future.
+def refill_later(pool):
+    global refill_executor
+    key = (pool.region_name, pool.pool_name)
+
+    def run():
+        with lock:
+            queued_refills.pop(key, None)
+        try:
+            with span('refill_standby_pool'):
+                pool.refill()
+        except BaseException: # exit_with_error raises SystemExit
+            print "Refill of standby pool " + pool.pool_name + " did not complete"
+
+    def forget(future):
+        with lock:
+            refills.discard(future)
+
+    with lock:
+        if key in queued_refills:
+            return queued_refills[key]
+        if refill_executor is None:
+            refill_executor = ThreadPoolExecutor(max_workers = refill_workers)
+        future = queued_refills[key] = refill_executor.submit(run)
+        refills.add(future)
+    future.add_done_callback(forget)
+    return future
+
+
+# Wait up to timeout seconds for the refills queued or running
+def wait_for_refills(timeout = None):
+    with lock:
+        futures = list(refills)
+    if futures:
+        wait_futures(futures, timeout = timeout)
+
+
+# Standby pool of a site, in the subnet of its uplink interface
+def site_pool(site, subnet_id):
+    return StandbyPool(site['region'], site['nsg_name'] + '-standby', site['snapshot_ami_id'], site['instance_type'],
+                       subnet_id, [site['security_group_id']], site['standby_pool_size'])
+
+
+# Sites that can fail over warm and have a pool
+def warm_sites(sites):
+    return [site for site in sites if site['standby_pool_size'] > 0 and
+            (site['failover_mode'] == 'warm' or
+             site['failover_mode'] == 'adaptive' and 'warm' in site['adaptive_strategies'])]
+
+
+# Lambda callback: seed the pool of every site that can fail over warm and
+# replace standbys of an older AMI. Returns the ready standbys per pool.
+def lambda_handler(event, context):
+    import nsg_resiliency # Only for the site defaults
+    sites = warm_sites(load_sites(event, nsg_resiliency.default_site))
+
+    start_recording('standby_pool')
+    results = {}
+    try:
+        for region in sorted(set(site['region'] for site in sites)):
+            region_sites = [site for site in sites if site['region'] == region]
+            topology = Topology(region, interface_names = [site['uplink_name'] for site in region_sites])
+            for site in region_sites:
+                pool = site_pool(site, topology.interface(site['uplink_name'])['SubnetId'])
+                pool.refill()
+                ready = len(pool.ready())
+                msg = "Standby pool " + pool.pool_name + ": " + str(ready) + " of " + str(pool.size) + " ready ... [ SUCCESS ]"
+                print msg
+                results[pool.pool_name] = ready
+    finally:
+        emit_metrics()
+    return results
@@ -0,0 +1,135 @@
+
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+
+from call_deadlines import bind, remaining
+from errors import exit_with_error
+from failover_metrics import span
+
+# Default number of steps run at once
+default_max_workers = 4
+
+# A named handler step and the names of the steps it has to wait for
+class Step(object):
+
+    def __init__(self, name, action, depends_on = ()):
+        self.name = name
+        self.action = action
+        self.depends_on = list(depends_on)
+
+
+# Outcome of a step: 'succeeded', 'failed' or 'cancelled'
+class StepResult(object):
+
+    def __init__(self, name, status, value = None, error = None, started = None, finished = None):
+        self.name = name
+        self.status = status
+        self.value = value
+        self.error = error
+        self.started = started
+        self.finished = finished
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+
+# Make sure every dependency exists and the steps form a DAG
+def check_graph(steps):
+    names = [step.name for step in steps]
+    if len(set(names)) != len(names):
+        exit_with_error("Duplicate step names: " + ", ".join(names))
+
+    by_name = dict((step.name, step) for step in steps)
+    for step in steps:
+        for dependency in step.depends_on:
+            if dependency not in by_name:
+                exit_with_error("Step " + step.name + " depends on unknown step " + dependency)
+
+    visited = set()
+    in_progress = set()
+    def visit(name):
+        if name in in_progress:
+            exit_with_error("Dependency cycle through step " + name)
+        if name not in visited:
+            in_progress.add(name)
+            for dependency in by_name[name].depends_on:
+                visit(dependency)
+            in_progress.discard(name)
+            visited.add(name)
+    for name in names:
+        visit(name)
+
+
+# A step is not started once the failover budget or the caller's deadline
+# is spent (call_deadlines)
+def run_step(step):
+    started = time.time()
+    try:
+        left = remaining()
+        if left is not None and (left <= 0):
+            exit_with_error("Deadline passed before step " + step.name)
+        with span(step.name):
+            value = step.action()
+    except BaseException as e: # exit_with_error raises SystemExit
+        return StepResult(step.name, 'failed', error = e, started = started, finished = time.time())
+    return StepResult(step.name, 'succeeded', value = value, started = started, finished = time.time())
+
+
+# Run the steps on a bounded thread pool, each as soon as all of its
+# dependencies have succeeded, so the total time follows the critical path.
+# On the first failure no further step is started; queued steps are cancelled
+# and steps already running are allowed to finish. Steps run within the
+# caller's deadline, and none is started once it has passed.
+# Returns a StepResult per step, in declaration order.
+def run_steps(steps, max_workers = default_max_workers):
+    check_graph(steps)
+
+    results = {}
+    running = {}
+    failed = False
+    executor = ThreadPoolExecutor(max_workers = max_workers)
+    try:
+        while True:
+            if not failed:
+                for step in steps:
+                    if step.name in results or step.name in running.values():
+                        continue
+                    if all(results.get(d) is not None and results[d].status == 'succeeded' for d in step.depends_on):
+                        running[executor.submit(bind(run_step), step)] = step.name
+
+            if not running:
+                break
+
+            done, pending = wait_futures(list(running), return_when = FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.cancelled():
+                    results[name] = StepResult(name, 'cancelled')
+                    continue
+                results[name] = future.result()
+                if (results[name].status == 'failed') and not failed:
+                    failed = True
+                    for other in list(running):
+                        other.cancel()
+    finally:
+        executor.shutdown(wait = True)
+
+    return [results.get(step.name) or StepResult(step.name, 'cancelled') for step in steps]
+
+
+# Print one line per step and fail if any step did not succeed
+def report_steps(results):
+    for result in results:
+        duration = ""
+        if result.duration is not None:
+            duration = " (%.2fs)" % result.duration
+        print "Step " + result.name + duration + " ... [ " + result.status.upper() + " ]"
+
+    failed = [result.name for result in results if result.status != 'succeeded']
+    if failed:
+        exit_with_error("Steps did not complete: " + ", ".join(failed))
@@ -0,0 +1,141 @@
+
+import json
+import os
+import threading
+import time
+
+from ec2_pool import get_client
+from errors import exit_with_error
+from idempotency import default_directory
+from step_graph import Step
+
+# Write-ahead journal of failover steps, so a failover retried after a crash
+# or timeout resumes where it stopped instead of starting over. Before a step
+# runs its intent is recorded ('started'), and once it succeeds its outcome
+# ('succeeded' and the step's value). On a retry of the same incident:
+#   - succeeded steps are not run again; their recorded value is returned
+#   - started steps may or may not have taken effect, so their check looks
+#     at the fresh topology; if it shows the step done, the step is recorded
+#     as succeeded, otherwise it runs again
+#   - steps never started run as usual
+#
+# Journals live next to the incident records (see idempotency): in the
+# IDEMPOTENCY_TABLE DynamoDB table under the key 'journal/<key>', or in files
+# under IDEMPOTENCY_DIR.
+#
+# Journal: {step name: {'status', 'value', 'updated'}}
+
+# Journals kept as one JSON file per key in a directory
+class FileJournal(object):
+
+    def __init__(self, directory = default_directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, 'journal_' + key.replace('/', '_') + '.json')
+
+    def load(self, key):
+        try:
+            with open(self.path(key)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def record(self, key, step_name, status, value = None):
+        with self.lock:
+            entries = self.load(key)
+            entries[step_name] = {'status': status, 'value': value, 'updated': time.time()}
+            temporary = self.path(key) + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(entries, f)
+            os.rename(temporary, self.path(key))
+
+
+# Journals kept as one DynamoDB item per key, one attribute per step
+class TableJournal(object):
+
+    def __init__(self, table_name, region_name):
+        self.table_name = table_name
+        self.region_name = region_name
+
+    def load(self, key):
+        dynamodb = get_client('dynamodb', self.region_name)
+        try:
+            item = dynamodb.get_item(
+                TableName = self.table_name,
+                Key = {'key': {'S': 'journal/' + key}},
+                ConsistentRead = True
+            ).get('Item') or {}
+        except Exception as e:
+            error = "Unable to read journal " + key + ". Exception: " + str(e)
+            exit_with_error(error)
+        return dict((name[5:], json.loads(value['S'])) for name, value in item.items() if name.startswith('step:'))
+
+    def record(self, key, step_name, status, value = None):
+        dynamodb = get_client('dynamodb', self.region_name)
+        entry = {'status': status, 'value': value, 'updated': time.time()}
+        try:
+            dynamodb.update_item(
+                TableName = self.table_name,
+                Key = {'key': {'S': 'journal/' + key}},
+                UpdateExpression = 'SET #s = :entry',
+                ExpressionAttributeNames = {'#s': 'step:' + step_name},
+                ExpressionAttributeValues = {':entry': {'S': json.dumps(entry)}}
+            )
+        except Exception as e:
+            error = "Unable to journal step " + step_name + " of " + key + ". Exception: " + str(e)
+            exit_with_error(error)
+
+
+# Journal chosen by the environment, the same way as the incident store
+def get_journal(region_name):
+    table_name = os.environ.get('IDEMPOTENCY_TABLE')
+    if table_name:
+        return TableJournal(table_name, region_name)
+    return FileJournal(os.environ.get('IDEMPOTENCY_DIR', default_directory))
+
+
+def journaled_action(journal, key, step, check):
+    def run():
+        if check is not None:
+            done, value = check()
+            if done:
+                journal.record(key, step.name, 'succeeded', value)
+                print "Step " + step.name + " found done by the interrupted run ... [ SKIPPED ]"
+                return value
+        journal.record(key, step.name, 'started')
+        value = step.action()
+        journal.record(key, step.name, 'succeeded', value)
+        return value
+    return run
+
+
+def recorded_value(step_name, value):
+    def run():
+        print "Step " + step_name + " done by the interrupted run ... [ SKIPPED ]"
+        return value
+    return run
+
+
+# Wrap steps so they are journaled under key and resume from the journal.
+# checks maps a step name to a function returning (done, value) from state
+# fetched by this run; steps without one are run again if they were started.
+# Step values must be JSON serializable. Pass the journal's entries if they
+# were already loaded.
+def journal_steps(journal, key, steps, checks = None, entries = None):
+    checks = checks or {}
+    if entries is None:
+        entries = journal.load(key)
+    journaled = []
+    for step in steps:
+        entry = entries.get(step.name)
+        if entry is not None and entry['status'] == 'succeeded':
+            action = recorded_value(step.name, entry['value'])
+        else:
+            check = checks.get(step.name) if entry is not None else None
+            action = journaled_action(journal, key, step, check)
+        journaled.append(Step(step.name, action, step.depends_on))
+    return journaled
@@ -0,0 +1,234 @@
+
+import json
+import os
+import threading
+import time
+
+from ec2_pool import get_client
+from errors import exit_with_error
+from site_runner import load_sites
+
+# Rolling history of failover timings, and the strategy selector of sites in
+# 'adaptive' failover mode. Every failover records, per instance type and
+# AZ, how long its strategy and each of its steps took and whether they
+# succeeded:
+#   strategy/<name>/<instance type>/<AZ>   'swap', 'warm', 'reboot', 'cold', 'dr'
+#   step/<name>/<instance type>/<AZ>       create_instance, power_on_instance, ...
+# An entry is a run count and exponentially weighted moving averages (weight
+# alpha) of the duration of successful runs and of the success rate, so it
+# stays small and recent failovers count most: launches turning slow in one
+# AZ show up within a few failovers. Runs resumed from a journal are not
+# recorded, as they only did part of the work.
+#
+# An adaptive site fails over with the feasible strategy of lowest expected
+# RTO, its duration estimate divided by its success rate (a failed attempt
+# costs another one). Estimates start at prior_durations and
+# prior_success_rates, which weigh as much as prior_weight runs, and move to
+# the measurements as runs come in. A strategy is feasible when:
+#   swap     the site's peer_name is running
+#   warm     the site's standby pool has a stopped standby of the current AMI
+#   reboot   the old NSG can be started again (it is not terminating)
+#   cold     always
+# Only the strategy that actually ran is recorded: a warm failover whose
+# standby is gone by the time it claims one, or a swap to a peer that fails
+# its status checks, runs and counts as a cold one.
+#
+# Histories live next to the incident records (see idempotency): in the
+# IDEMPOTENCY_TABLE DynamoDB table under the key 'history/<region>', or in
+# files under STRATEGY_HISTORY_DIR. lambda_handler reports the estimates for
+# the sites' instance types.
+
+default_directory = '/tmp/nsg-resiliency-history'
+
+alpha = 0.2
+max_count = 1000
+
+prior_durations = {'swap': 5.0, 'warm': 45.0, 'reboot': 90.0, 'cold': 120.0, 'dr': 180.0}
+prior_success_rates = {'swap': 0.95, 'warm': 0.9, 'reboot': 0.7, 'cold': 0.95, 'dr': 0.9}
+prior_weight = 2
+min_success_rate = 0.05
+
+lock = threading.Lock()
+
+def history_key(kind, name, instance_type, zone):
+    return '/'.join((kind, name, instance_type, zone or 'unknown'))
+
+
+# Entry updated with a run
+def updated_entry(entry, duration, succeeded):
+    entry = dict(entry or {'count': 0, 'duration': None, 'success': None})
+    outcome = 1.0 if succeeded else 0.0
+    if entry['success'] is None:
+        entry['success'] = outcome
+    else:
+        entry['success'] += alpha * (outcome - entry['success'])
+    if succeeded and entry['duration'] is None:
+        entry['duration'] = duration
+    elif succeeded:
+        entry['duration'] += alpha * (duration - entry['duration'])
+    entry['count'] = min(max_count, entry['count'] + 1)
+    entry['updated'] = time.time()
+    return entry
+
+
+# Histories kept as one JSON file per region in a directory
+class FileHistory(object):
+
+    def __init__(self, region_name, directory = default_directory):
+        self.region_name = region_name
+        self.path = os.path.join(directory, region_name + '.json')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    # Record runs, as (key, duration, succeeded)
+    def record(self, runs):
+        with lock:
+            entries = self.load()
+            for key, duration, succeeded in runs:
+                entries[key] = updated_entry(entries.get(key), duration, succeeded)
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(entries, f)
+            os.rename(temporary, self.path)
+
+
+# Histories kept as one DynamoDB item per region, one attribute per entry
+class TableHistory(object):
+
+    def __init__(self, table_name, region_name, table_region_name):
+        self.table_name = table_name
+        self.region_name = region_name
+        self.table_region_name = table_region_name
+
+    def load(self):
+        dynamodb = get_client('dynamodb', self.table_region_name)
+        try:
+            item = dynamodb.get_item(
+                TableName = self.table_name,
+                Key = {'key': {'S': 'history/' + self.region_name}},
+                ConsistentRead = True
+            ).get('Item') or {}
+        except Exception as e:
+            error = "Unable to read the failover history of " + self.region_name + ". Exception: " + str(e)
+            exit_with_error(error)
+        return dict((name, json.loads(value['S'])) for name, value in item.items() if name != 'key')
+
+    # Record runs, as (key, duration, succeeded). Runs recorded at the same
+    # time by another failover can be lost, which only costs a sample.
+    def record(self, runs):
+        entries = self.load()
+        names = {}
+        values = {}
+        for n, (key, duration, succeeded) in enumerate(runs):
+            entries[key] = updated_entry(entries.get(key), duration, succeeded)
+            names['#e%d' % n] = key
+            values[':e%d' % n] = {'S': json.dumps(entries[key])}
+        dynamodb = get_client('dynamodb', self.table_region_name)
+        try:
+            dynamodb.update_item(
+                TableName = self.table_name,
+                Key = {'key': {'S': 'history/' + self.region_name}},
+                UpdateExpression = 'SET ' + ', '.join('#e%d = :e%d' % (n, n) for n in range(len(runs))),
+                ExpressionAttributeNames = names,
+                ExpressionAttributeValues = values
+            )
+        except Exception as e:
+            error = "Unable to record the failover history of " + self.region_name + ". Exception: " + str(e)
+            exit_with_error(error)
+
+
+# History of a region, chosen by the environment the same way as the incident
+# store; a table lives in table_region_name
+def get_history(region_name, table_region_name = None):
+    table_name = os.environ.get('IDEMPOTENCY_TABLE')
+    if table_name:
+        return TableHistory(table_name, region_name, table_region_name or region_name)
+    return FileHistory(region_name, os.environ.get('STRATEGY_HISTORY_DIR', default_directory))
+
+
+# Estimate of a strategy or step: {'duration', 'success', 'runs', 'expected'}
+def estimate(entries, kind, name, instance_type, zone):
+    entry = entries.get(history_key(kind, name, instance_type, zone)) or {}
+    runs = entry.get('count', 0)
+    prior_duration = prior_durations.get(name)
+    prior_success = prior_success_rates.get(name, 1.0)
+
+    duration = entry.get('duration')
+    if duration is None:
+        duration = prior_duration
+    elif prior_duration is not None:
+        duration = (prior_duration * prior_weight + duration * runs) / (prior_weight + runs)
+    success = prior_success
+    if entry.get('success') is not None:
+        success = (prior_success * prior_weight + entry['success'] * runs) / (prior_weight + runs)
+
+    expected = None
+    if duration is not None:
+        expected = duration / max(min_success_rate, success)
+    return {'duration': duration, 'success': success, 'runs': runs, 'expected': expected}
+
+
+# The strategy of lowest expected RTO among the candidates; returns it and
+# the estimates of all candidates as [(strategy, estimate)]
+def select_strategy(entries, candidates, instance_type, zone):
+    if not candidates:
+        exit_with_error("No feasible failover strategy for " + instance_type + " in " + str(zone))
+    estimates = [(strategy, estimate(entries, 'strategy', strategy, instance_type, zone)) for strategy in candidates]
+    best = min(estimates, key = lambda e: e[1]['expected'])
+    return best[0], estimates
+
+
+def format_estimate(name, e):
+    if e['expected'] is None:
+        return "%-24s expected     n/a  (%d runs)" % (name, e['runs'])
+    return "%-24s expected %7.1fs  (duration %.1fs, success %.2f, %d runs)" % (
+        name, e['expected'], e['duration'], e['success'], e['runs'])
+
+
+# Print the estimates of a site's strategy selection
+def report_selection(site_name, instance_type, zone, estimates, strategy):
+    print "Strategy estimates for site " + site_name + " (" + instance_type + " in " + str(zone) + "):"
+    for name, e in sorted(estimates, key = lambda e: e[1]['expected']):
+        print "  " + format_estimate(name, e)
+    print "Strategy for site " + site_name + ": " + strategy + " ... [ SELECTED ]"
+
+
+# Record a failover's runs in the region's history, as (kind, name,
+# duration, succeeded). Recording must not fail a failover.
+def record_runs(region_name, instance_type, zone, runs, table_region_name = None):
+    if not runs:
+        return
+    try:
+        get_history(region_name, table_region_name).record(
+            [(history_key(kind, name, instance_type, zone), duration, succeeded)
+             for kind, name, duration, succeeded in runs])
+    except BaseException as e: # exit_with_error raises SystemExit
+        print "Unable to record failover timings in " + region_name + ". Exception: " + str(e)
+
+
+# Lambda callback: report the estimates of every strategy and step recorded
+# for the sites' regions and instance types
+def lambda_handler(event, context):
+    import nsg_resiliency # Only for the site defaults
+    sites = load_sites(event, nsg_resiliency.default_site)
+
+    estimates = []
+    for region_name in sorted(set(site['region'] for site in sites)):
+        entries = get_history(region_name, nsg_resiliency.default_site['region']).load()
+        instance_types = set(site['instance_type'] for site in sites if site['region'] == region_name)
+        for key in sorted(entries):
+            kind, name, instance_type, zone = key.split('/', 3)
+            if instance_type not in instance_types:
+                continue
+            e = estimate(entries, kind, name, instance_type, zone)
+            print region_name + " " + instance_type + " " + zone + " " + kind + " " + format_estimate(name, e)
+            estimates.append(dict(e, region = region_name, instance_type = instance_type, zone = zone,
+                                  kind = kind, name = name))
+    return {'estimates': estimates}